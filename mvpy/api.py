@@ -8,7 +8,8 @@ Created on Wed Sep 11 22:00:28 2019
 
 
 from mvpy.utils.base_utils import (csd, corr, check_type, cov, masked_invalid,#analysis:ignore
-                                  center, standardize, valid_overlap)
+                                  center, standardize, valid_overlap,
+                                  compress_rows)
 from mvpy.models.mv_rand import vine_corr, multi_rand
 from mvpy.utils.linalg_utils import (blockwise_inv, chol, whiten, diag2,  #analysis:ignore
                                     fprime, fprime_cs, hess_approx, inv_sqrth,
@@ -29,11 +30,12 @@ from mvpy.models.sem2 import GLSSEM, parse_formula #analysis:ignore
 from mvpy.models.mlsem import MLSEM #analysis:ignore
 from mvpy.models.clm import CLM#analysis:ignore
 from mvpy.models.factor_analysis import EFA, CFA, FactorAnalysis#analysis:ignore
-from mvpy.models.lmm import LMM#analysis:ignore
+from mvpy.models.lmm import LMM, KroneckerLMM#analysis:ignore
 from mvpy.models.lvcorr import (polychorr, polyserial, tetra, mixed_corr, Polychoric,#analysis:ignore
                                 Polyserial)#analysis:ignore
 from mvpy.models.lm import LM, OLS, MassUnivariate, RLS, Huber, Bisquare#analysis:ignore
-from mvpy.models.glm3 import (GLM, Binomial, Gamma, Gaussian, InverseGaussian, #analysis:ignore
+from mvpy.models.glm3 import (GLM, ChunkedGLM, BatchGLM, Binomial, Gamma, #analysis:ignore
+                              Gaussian, InverseGaussian,#analysis:ignore
                                Poisson,#analysis:ignore
                               CloglogLink, IdentityLink, LogComplementLink, #analysis:ignore
                               LogitLink, LogLink, NegativeBinomialLink, PowerLink,#analysis:ignore
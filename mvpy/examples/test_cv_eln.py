@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed May 27 10:51:43 2020
+
+@author: lukepinkel
+"""
+
+import numpy as np # analysis:ignore
+from mvpy.models import penalized_regression as pr # analysis:ignore
+
+# Checks the cross validated error curve of cv_eln against a loop over the
+# same folds that fits eln_path on each training set and scores the held out
+# observations, and that the parallel folds (n_jobs>1) give the same curve
+
+if __name__=='__main__':
+    np.random.seed(533)
+    n_folds = 5
+    for n_obs, n_feats in [(400, 30), (120, 300)]:
+        X = np.random.normal(size=(n_obs, n_feats)) \
+            * np.random.uniform(0.5, 3, n_feats) \
+            + np.random.normal(size=n_feats)
+        # a constant column, which cv_eln drops before fitting
+        X[:, -1] = 2.0
+        b = np.zeros(n_feats)
+        b[:6] = np.random.normal(size=6)
+        y = X.dot(b) + np.random.normal(size=n_obs) * 2 + 5
+        res, lambda_min, lambda_1se, betas = pr.cv_eln(X, y, n_folds=n_folds,
+                                                       seed=1, n_lambdas=50)
+        res_par = pr.cv_eln(X, y, n_folds=n_folds, seed=1, n_lambdas=50,
+                            n_jobs=3)[0]
+
+        folds = pr._cv_folds(n_obs, n_folds, seed=1)
+        lambdas = res.index.values
+        errors = []
+        for k in range(n_folds):
+            train = folds!=k
+            Xt, yt = X[train][:, :-1], y[train]
+            B, _, _ = pr.eln_path(Xt, yt, alpha=0.5, lambdas=lambdas)
+            xm, xs = Xt.mean(axis=0), Xt.std(axis=0)
+            Zv = (X[~train][:, :-1] - xm) / xs
+            yhat = yt.mean() + yt.std() * Zv.dot(B.T)
+            errors.append(np.mean((y[~train][:, None] - yhat)**2, axis=0))
+        cv_mean = np.mean(errors, axis=0)
+        print(n_obs, n_feats, lambda_min, lambda_1se)
+        print(np.allclose(res['cv_mean'].values, cv_mean))
+        print(np.allclose(res.values, res_par.values))
+    print(res.head())
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue May 26 16:05:19 2020
+
+@author: lukepinkel
+"""
+
+import numpy as np # analysis:ignore
+import pandas as pd # analysis:ignore
+import mvpy.api as mv # analysis:ignore
+
+# Checks that BatchGLM, fitting many responses against one design, reproduces
+# the estimates, standard errors and fit statistics of a GLM fit to each
+# response column separately
+
+np.random.seed(530)
+n_obs, n_resp = 2000, 50
+x = np.random.normal(size=(n_obs, 3))
+df = pd.DataFrame(x, columns=['x1', 'x2', 'x3'])
+B = np.random.normal(size=(4, n_resp)) * 0.3
+eta = np.column_stack([np.ones(n_obs), x]).dot(B)
+cases = {'binomial':(mv.Binomial(),
+                     np.random.binomial(1, 1.0/(1.0+np.exp(-eta)))*1.0, 'M'),
+         'poisson':(mv.Poisson(), np.random.poisson(np.exp(eta))*1.0, 'M'),
+         'gamma':(mv.Gamma(link=mv.LogLink),
+                  np.random.gamma(2.0, np.exp(eta)/2.0), 'M'),
+         'gammaNR':(mv.Gamma(link=mv.LogLink),
+                    np.random.gamma(2.0, np.exp(eta)/2.0), 'NR'),
+         'gaussian':(mv.Gaussian(),
+                     eta+np.random.normal(size=(n_obs, n_resp)), 'M')}
+
+for name, (fam, Y, scale) in cases.items():
+    Y = pd.DataFrame(Y, columns=['y%i'%j for j in range(n_resp)])
+    batch = mv.BatchGLM("~x1+x2+x3", df, fam, scale_estimator=scale, Y=Y)
+    batch.fit()
+    params, se, stats = [], [], []
+    for j in range(n_resp):
+        data = df.copy()
+        data['y'] = Y['y%i'%j]
+        model = mv.GLM("y~x1+x2+x3", data, fam, scale_estimator=scale)
+        model.fit()
+        res = batch.res.loc['y%i'%j]
+        params.append(np.allclose(res['params'].values, model.beta))
+        se.append(np.allclose(res['SE'].values, model.se_theta[:4]))
+        stats_j = model.sumstats.iloc[:, 0][['aic', 'deviance']]
+        stats.append(np.allclose(batch.sumstats[['aic', 'deviance']].iloc[j],
+                                 stats_j))
+    print(name, batch.converged.all(), batch.n_iter.max())
+    print(np.all(params), np.all(se), np.all(stats))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue May 26 15:02:31 2020
+
+@author: lukepinkel
+"""
+
+import os # analysis:ignore
+import tempfile # analysis:ignore
+import numpy as np # analysis:ignore
+import pandas as pd # analysis:ignore
+import mvpy.api as mv # analysis:ignore
+
+# Checks that ChunkedGLM, fit by IRLS over row blocks of a memory mapped
+# design, reproduces the in-memory GLM for several families and both scale
+# estimators, and that the different ways of supplying the blocks agree
+
+np.random.seed(528)
+n_obs = 20000
+x = np.random.normal(size=(n_obs, 3))
+df = pd.DataFrame(x, columns=['x1', 'x2', 'x3'])
+eta = 0.3 + x.dot(np.array([0.2, -0.3, 0.1]))
+df['yb'] = np.random.binomial(1, 1.0/(1.0+np.exp(-eta)))
+df['yp'] = np.random.poisson(np.exp(eta))
+df['yg'] = np.random.gamma(2.0, np.exp(eta)/2.0)
+df['yn'] = eta + np.random.normal(size=n_obs)
+X = np.column_stack([np.ones(n_obs), x])
+
+fname = os.path.join(tempfile.mkdtemp(), 'X.npy')
+np.save(fname, X)
+
+cases = [('yb', mv.Binomial(), 'M'),
+         ('yp', mv.Poisson(), 'M'),
+         ('yg', mv.Gamma(link=mv.LogLink), 'M'),
+         ('yg', mv.Gamma(link=mv.LogLink), 'NR'),
+         ('yn', mv.Gaussian(), 'M'),
+         ('yn', mv.Gaussian(), 'NR')]
+
+for yvar, fam, scale in cases:
+    model = mv.GLM(yvar+"~x1+x2+x3", df, fam, scale_estimator=scale)
+    model.fit()
+    Xm = np.load(fname, mmap_mode='r')
+    chunked = mv.ChunkedGLM((Xm, df[yvar].values), fam,
+                            scale_estimator=scale, chunksize=3000)
+    chunked.fit()
+    print(yvar, scale, np.max(np.abs(model.res.values-chunked.res.values)))
+    print(np.allclose(model.res.values, chunked.res.values))
+    print(np.allclose(model.sumstats.values, chunked.sumstats.values))
+    print(np.allclose(model.vcov_robust, chunked.vcov_robust))
+
+# a list of blocks, a callable returning an iterator of blocks, and a single
+# array with the response in the first column
+blocks = [(X[i:i+5000], df['yb'].values[i:i+5000])
+          for i in range(0, n_obs, 5000)]
+c1 = mv.ChunkedGLM(blocks, mv.Binomial())
+c1.fit()
+c2 = mv.ChunkedGLM(lambda: iter(blocks), mv.Binomial())
+c2.fit()
+c3 = mv.ChunkedGLM(np.column_stack([df['yb'].values, X]), mv.Binomial(),
+                   chunksize=777)
+c3.fit()
+print(np.allclose(c1.params, c2.params), np.allclose(c1.params, c3.params))
+os.remove(fname)
+os.rmdir(os.path.dirname(fname))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue May 26 16:48:55 2020
+
+@author: lukepinkel
+"""
+
+import numpy as np # analysis:ignore
+import pandas as pd # analysis:ignore
+import mvpy.api as mv # analysis:ignore
+from mvpy.utils.base_utils import compress_rows # analysis:ignore
+
+# Checks that fitting on the unique covariate and response patterns with their
+# counts as frequency weights (compress=True) reproduces the fit on the full
+# data for GLM, NB2 and CLM, for compressed blocks passed to ChunkedGLM, and
+# for frequency weights against replicated rows
+
+np.random.seed(531)
+n_obs = 30000
+df = pd.DataFrame({'a':np.random.randint(0, 4, n_obs),
+                   'b':np.random.randint(0, 3, n_obs),
+                   'x':np.random.randint(0, 5, n_obs) / 4})
+eta = 0.3 + 0.2*df['a'] - 0.3*df['b'] + 0.5*df['x']
+df['yb'] = np.random.binomial(1, 1.0/(1.0+np.exp(-eta+0.5))) * 1.0
+df['yp'] = np.random.poisson(np.exp(eta*0.5)) * 1.0
+df['yg'] = np.round(np.random.gamma(2.0, np.exp(eta)/2.0), 1) + 0.1
+df['yn'] = np.round(eta + np.random.normal(size=n_obs), 0)
+df['ynb'] = np.random.negative_binomial(2.0, 2.0/(2.0+np.exp(eta))) * 1.0
+df['yo'] = np.digitize(eta + np.random.logistic(size=n_obs), [0.5, 1.0, 1.5])
+
+cases = [('yb', mv.Binomial(), 'M'),
+         ('yp', mv.Poisson(), 'M'),
+         ('yg', mv.Gamma(link=mv.LogLink), 'M'),
+         ('yg', mv.Gamma(link=mv.LogLink), 'NR'),
+         ('yn', mv.Gaussian(), 'M'),
+         ('yn', mv.Gaussian(), 'NR'),
+         ('yg', mv.InverseGaussian(link=mv.LogLink), 'M')]
+
+for yvar, fam, scale in cases:
+    formula = yvar+"~C(a)+C(b)+x"
+    full = mv.GLM(formula, df, fam=fam, scale_estimator=scale)
+    full.fit()
+    comp = mv.GLM(formula, df, fam=fam, scale_estimator=scale, compress=True)
+    comp.fit()
+    print(yvar, scale, comp.X.shape[0])
+    print(np.allclose(full.res.values, comp.res.values))
+    print(np.allclose(full.sumstats.values, comp.sumstats.values))
+    print(np.allclose(full.vcov_robust, comp.vcov_robust))
+
+# NB2 and CLM are fit by trust-constr, so agreement is to its tolerance
+for model_class, formula in [(mv.NegativeBinomial, "ynb~C(a)+x"),
+                             (mv.CLM, "yo~C(a)+x-1")]:
+    full = model_class(formula, df)
+    full.fit()
+    comp = model_class(formula, df, compress=True)
+    comp.fit()
+    print(model_class.__name__, comp.X.shape[0])
+    print(np.allclose(full.params, comp.params, atol=1e-5))
+
+# compressed (X, y, counts) blocks in ChunkedGLM
+full = mv.GLM("yn~C(a)+C(b)+x", df, fam=mv.Gaussian())
+full.fit()
+(Xu, yu), counts, row_inverse = compress_rows(full.X, full.Y)
+chunked = mv.ChunkedGLM([(Xu[:30], yu[:30], counts[:30]),
+                         (Xu[30:], yu[30:], counts[30:])], fam=mv.Gaussian())
+chunked.fit()
+print(np.allclose(chunked.params, full.params),
+      np.allclose(chunked.res['SE'].values, full.res['SE'].values))
+
+# frequency weights combined with compression against replicated rows
+w = np.random.randint(1, 3, n_obs) * 1.0
+rep = df.loc[np.repeat(np.arange(n_obs), w.astype(int))]
+full = mv.GLM("yp~C(a)+C(b)+x", rep, fam=mv.Poisson())
+full.fit()
+comp = mv.GLM("yp~C(a)+C(b)+x", df, fam=mv.Poisson(), freq_weights=w,
+              compress=True)
+comp.fit()
+print(full.n_obs==comp.n_obs, np.allclose(full.res.values, comp.res.values))
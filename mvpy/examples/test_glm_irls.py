@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue May 26 13:40:06 2020
+
+@author: lukepinkel
+"""
+
+import numpy as np # analysis:ignore
+import scipy as sp # analysis:ignore
+import scipy.optimize # analysis:ignore
+import scipy.special # analysis:ignore
+import pandas as pd # analysis:ignore
+import mvpy.api as mv # analysis:ignore
+
+# Checks that the IRLS fit of the GLM is a stationary point of the likelihood
+# for each family (a negligible newton step from the fit), agrees with
+# newton-raphson (method='mn') where the latter converges from its default
+# start, and that IRLS with a negative binomial scale estimated by
+# newton-raphson reaches the maximum likelihood estimate
+
+np.random.seed(527)
+n_obs = 3000
+df = pd.DataFrame(np.random.normal(size=(n_obs, 3))*0.5,
+                  columns=['x1', 'x2', 'x3'])
+eta = 0.3 + df.values.dot(np.array([0.5, -0.4, 0.2]))
+df['yb'] = (np.random.uniform(size=n_obs) < 1.0/(1.0+np.exp(-eta))) * 1.0
+df['yp'] = np.random.poisson(np.exp(eta))
+df['yg'] = np.random.gamma(2.0, np.exp(eta)/2.0)
+df['yn'] = eta + np.random.normal(size=n_obs)
+df['yi'] = np.random.wald(np.exp(eta), 5.0)
+
+# the canonical gamma and inverse gaussian links leave their domain from the
+# newton-raphson starting values, so only stationarity is checked there
+cases = [('yb', mv.Binomial(), True),
+         ('yb', mv.Binomial(link=mv.ProbitLink), True),
+         ('yb', mv.Binomial(link=mv.CloglogLink), True),
+         ('yp', mv.Poisson(), True),
+         ('yg', mv.Gamma(), False),
+         ('yg', mv.Gamma(link=mv.LogLink), True),
+         ('yn', mv.Gaussian(), True),
+         ('yi', mv.InverseGaussian(), False),
+         ('yp', mv.NegBinom(), True)]
+
+for yvar, fam, check_mn in cases:
+    model = mv.GLM(yvar+"~x1+x2+x3", df, fam)
+    model.fit()
+    g = model.gradient(model.params)
+    step = np.linalg.solve(model.hessian(model.params), g)
+    print(type(fam).__name__, model.optimizer.nit, np.max(np.abs(step)))
+    print(np.allclose(step, 0.0, atol=1e-5))
+    if check_mn:
+        model_mn = mv.GLM(yvar+"~x1+x2+x3", df, fam)
+        model_mn.fit(method='mn')
+        print(np.allclose(model.params, model_mn.params, atol=1e-5))
+
+
+# negative binomial with the scale estimated jointly; the reference is the
+# direct maximization of the likelihood in (beta, log(scale))
+X = np.c_[np.ones(n_obs), df[['x1', 'x2']].values]
+mu = np.exp(X.dot(np.array([0.5, 0.4, -0.3])))
+a = 0.4
+y = np.random.negative_binomial(1.0/a, 1.0/(1.0+a*mu)) * 1.0
+
+
+def nb_loglike(params):
+    b, v = params[:-1], np.exp(-params[-1])
+    mu = np.exp(X.dot(b))
+    ll = sp.special.gammaln(y+v) - sp.special.gammaln(v) \
+         - sp.special.gammaln(y+1) + v * np.log(v / (v + mu)) \
+         + y * np.log(mu / (v + mu))
+    return -np.sum(ll)
+
+
+opt = sp.optimize.minimize(nb_loglike, np.zeros(4), method='BFGS',
+                           options={'gtol':1e-9})
+model = mv.GLM(X=X, Y=y, fam=mv.NegBinom(), scale_estimator='NR')
+model.fit()
+print(np.allclose(model.params, opt.x, atol=1e-4))
+model_mn = mv.GLM(X=X, Y=y, fam=mv.NegBinom(), scale_estimator='NR')
+model_mn.fit(method='mn')
+print(np.allclose(model.params, model_mn.params, atol=1e-5))
+print(model.res)
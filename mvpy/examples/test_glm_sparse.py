@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue May 26 15:37:48 2020
+
+@author: lukepinkel
+"""
+
+import numpy as np # analysis:ignore
+import scipy as sp # analysis:ignore
+import scipy.sparse as sps # analysis:ignore
+import pandas as pd # analysis:ignore
+import mvpy.api as mv # analysis:ignore
+
+# Checks that the GLM fit with a sparse design (sparse=True) reproduces the
+# dense fit for a model with a many level factor, and that a sparse design
+# passed directly to GLM and to ChunkedGLM gives the same estimates
+
+np.random.seed(529)
+n_obs, n_levels = 20000, 400
+df = pd.DataFrame(np.random.normal(size=(n_obs, 1)), columns=['x'])
+df['g'] = np.random.randint(0, n_levels, n_obs).astype(str)
+df['h'] = np.random.choice(['a', 'b', 'c'], n_obs)
+u = np.random.normal(size=n_levels) * 0.3
+eta = 0.2 + 0.3*df['x'] + u[df['g'].astype(int)]
+df['yb'] = np.random.binomial(1, 1.0/(1.0+np.exp(-eta)))
+df['yp'] = np.random.poisson(np.exp(eta))
+df['yg'] = np.random.gamma(2.0, np.exp(eta)/2.0)
+df['yn'] = eta + np.random.normal(size=n_obs)
+
+formula = "~x+C(g)+h"
+cases = [('yb', mv.Binomial(), 'M'),
+         ('yp', mv.Poisson(), 'M'),
+         ('yg', mv.Gamma(link=mv.LogLink), 'M'),
+         ('yg', mv.Gamma(link=mv.LogLink), 'NR'),
+         ('yn', mv.Gaussian(), 'M')]
+
+for yvar, fam, scale in cases:
+    dense = mv.GLM(yvar+formula, df, fam, scale_estimator=scale)
+    dense.fit()
+    sparse = mv.GLM(yvar+formula, df, fam, scale_estimator=scale,
+                    sparse=True)
+    sparse.fit()
+    print(yvar, scale, sps.issparse(sparse.X),
+          np.max(np.abs(dense.res.values-sparse.res.values)))
+    print(np.allclose(dense.res.values, sparse.res.values))
+    print(np.allclose(dense.sumstats.values, sparse.sumstats.values))
+    print(np.allclose(dense.vcov_robust, sparse.vcov_robust))
+
+X, y = sparse.X, df['yn'].values
+model = mv.GLM(X=X, Y=y, fam=mv.Gaussian())
+model.fit()
+chunked = mv.ChunkedGLM((X.tocsr(), y), mv.Gaussian(), chunksize=5000)
+chunked.fit()
+print(np.allclose(model.params, dense.params),
+      np.allclose(chunked.params, dense.params))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue May 26 10:14:52 2020
+
+@author: lukepinkel
+"""
+
+import numpy as np # analysis:ignore
+import scipy as sp # analysis:ignore
+import scipy.integrate # analysis:ignore
+import pandas as pd # analysis:ignore
+import mvpy.api as mv # analysis:ignore
+
+# Checks the adaptive Gauss-Hermite deviance of a random intercept logistic
+# model against the marginal likelihood integrated unit by unit with
+# scipy.integrate.quad, and that the fit with nagq>1 improves the exact
+# deviance over the Laplace fit
+
+np.random.seed(526)
+n_groups, n_per = 60, 10
+n_obs = n_groups * n_per
+df = pd.DataFrame(np.random.normal(size=(n_obs, 1)), columns=['x1'])
+df['id'] = np.repeat(np.arange(n_groups), n_per)
+u = np.random.normal(size=n_groups) * 1.2
+eta = -0.3 + 0.8*df['x1'] + u[df['id']]
+df['y'] = (np.random.uniform(size=n_obs) < 1.0/(1.0+np.exp(-eta))) * 1.0
+
+
+def exact_deviance(model, params):
+    '''
+    params are the laplace parameters [lambda, beta] of the single random
+    intercept
+    '''
+    X, y, ids = model.mod.X, df['y'].values, df['id'].values
+    ll = 0.0
+    for j in range(n_groups):
+        ix = ids==j
+        eta0 = X[ix].dot(params[1:])
+
+        def func(v):
+            mu = 1.0 / (1.0 + np.exp(-(eta0 + params[0] * v)))
+            lj = np.sum(y[ix]*np.log(mu) + (1.0-y[ix])*np.log(1.0-mu))
+            return np.exp(lj - v**2 / 2.0) / np.sqrt(2.0 * np.pi)
+        ll += np.log(sp.integrate.quad(func, -10, 10)[0])
+    return -2.0 * ll
+
+
+model = mv.GLMM("~x1", {"id":"~1"}, "y", data=df, fam=mv.Binomial())
+model._setup_laplace()
+params = np.array([1.1, -0.2, 0.7])
+dev = exact_deviance(model, params)
+for nagq in [1, 3, 7, 15, 25]:
+    print(nagq, model.laplace_deviance(params, nagq) - dev)
+print(np.allclose(model.laplace_deviance(params, 25), dev))
+
+res = {}
+for nagq in [1, 15]:
+    model = mv.GLMM("~x1", {"id":"~1"}, "y", data=df, fam=mv.Binomial())
+    model.fit(verbose=False, estimator='laplace', nagq=nagq)
+    res[nagq] = model
+dev1 = exact_deviance(res[1], res[1].optimizer.x)
+dev15 = exact_deviance(res[15], res[15].optimizer.x)
+print(np.allclose(res[15].ll, dev15, atol=1e-4))
+print(dev15 <= dev1)
+print(res[15].res)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed May 27 09:22:10 2020
+
+@author: lukepinkel
+"""
+
+import numpy as np # analysis:ignore
+from mvpy.models import penalized_regression as pr # analysis:ignore
+from mvpy.utils import base_utils # analysis:ignore
+
+# Checks that every knot of the lasso path from lars_path satisfies the KKT
+# conditions, including designs with duplicated and linearly dependent 
+# columns, and that for n>p with X of full rank, where the lasso solution is
+# unique along the whole path, the knots agree with coordinate descent 
+# (eln_path with alpha=1) at the same lambdas
+
+np.random.seed(532)
+for n_obs, n_feats, rho, n_dup in [(200, 30, 0.0, 0), (100, 60, 0.9, 0), 
+                                   (50, 200, 0.5, 0), (60, 30, 0.3, 10)]:
+    X = np.random.normal(size=(n_obs, n_feats)) \
+        + rho * np.random.normal(size=(n_obs, 1)) * 3
+    if n_dup > 0:
+        Xd = X[:, :n_dup]
+        X = np.hstack([X, Xd, Xd.dot(np.random.normal(size=(n_dup, n_dup)))])
+        n_feats = X.shape[1]
+    b = np.zeros(n_feats)
+    b[:8] = np.random.normal(size=8) * 2
+    X = base_utils.csd(X)
+    y = base_utils.csd(X.dot(b) + np.random.normal(size=n_obs))
+    B, lambdas, active = pr.lars_path(X, y)
+
+    kkt = []
+    for k in range(1, len(B)):
+        g = X.T.dot(y - X.dot(B[k])) / n_obs
+        dev = np.where(B[k]!=0, np.abs(g - lambdas[k] * np.sign(B[k])),
+                       np.maximum(np.abs(g) - lambdas[k], 0.0))
+        kkt.append(np.max(dev))
+    print(n_obs, n_feats, rho, n_dup, len(B), np.max(kkt))
+    print(np.allclose(kkt, 0.0, atol=1e-10))
+    if n_obs > n_feats and n_dup==0:
+        Bcd, _, _ = pr.eln_path(X, y, alpha=1.0, lambdas=lambdas[1:],
+                                tol=1e-15, max_sweeps=100000)
+        print(np.allclose(B[1:], Bcd, atol=1e-4))
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon May 25 11:02:37 2020
+
+@author: lukepinkel
+"""
+
+import numpy as np # analysis:ignore
+import pandas as pd # analysis:ignore
+import mvpy.api as mv # analysis:ignore
+
+# Checks that average information REML (method='ai') and the profiled
+# likelihood (method='profiled') reach the estimates found by trust-constr,
+# for a random slope model and for crossed random intercepts
+
+np.random.seed(526)
+n_groups, n_per = 60, 12
+n_obs = n_groups * n_per
+df = pd.DataFrame(np.random.normal(size=(n_obs, 2)), columns=['x1', 'x2'])
+df['id'] = np.repeat(np.arange(n_groups), n_per)
+df['site'] = np.random.choice(np.arange(15), n_obs)
+u0 = np.random.normal(size=n_groups)
+u1 = np.random.normal(size=n_groups) * 0.5
+v0 = np.random.normal(size=15) * 0.7
+df['y'] = 1 + 0.5*df['x1'] - 0.3*df['x2'] + u0[df['id']] \
+          + u1[df['id']]*df['x2'] + np.random.normal(size=n_obs)
+df['y2'] = 1 + 0.5*df['x1'] + u0[df['id']] + v0[df['site']] \
+           + np.random.normal(size=n_obs)
+
+for formula in ["y~x1+x2+(1+x2|id)", "y2~x1+(1|id)+(1|site)"]:
+    res = {}
+    for method in ['trust-constr', 'ai', 'profiled']:
+        model = mv.LMM(formula, data=df)
+        model.fit(method=method, verbose=0)
+        res[method] = model
+
+    theta = res['trust-constr'].params
+    for method in ['ai', 'profiled']:
+        print(method, np.max(np.abs(res[method].params - theta)))
+        print(np.allclose(res[method].params, theta, atol=1e-4))
+        print(np.allclose(res[method].ll, res['trust-constr'].ll))
+        print(np.allclose(res[method].b, res['trust-constr'].b, atol=1e-4))
+    print(res['ai'].fit_hist)
+
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon May 25 09:41:12 2020
+
+@author: lukepinkel
+"""
+
+import numpy as np # analysis:ignore
+import scipy as sp # analysis:ignore
+import scipy.sparse as sps # analysis:ignore
+import pandas as pd # analysis:ignore
+import mvpy.api as mv # analysis:ignore
+
+# Checks the restricted log likelihood, gradient, average information and
+# hessian computed from the sparse mixed model equations against the dense
+# V=ZGZ'+R formulation, for independent units and for correlated units
+# (acov)
+
+np.random.seed(525)
+n_groups, n_per = 50, 10
+n_obs = n_groups * n_per
+df = pd.DataFrame(np.random.normal(size=(n_obs, 2)), columns=['x1', 'x2'])
+df['id'] = np.repeat(np.arange(n_groups), n_per)
+u0 = np.random.normal(size=n_groups)
+u1 = np.random.normal(size=n_groups) * 0.5
+df['y'] = 1 + 0.5*df['x1'] - 0.3*df['x2'] + u0[df['id']] \
+          + u1[df['id']]*df['x2'] + np.random.normal(size=n_obs)
+
+A = 0.5**np.abs(np.subtract.outer(np.arange(n_groups), np.arange(n_groups)))
+
+
+def dense_loglike(model, theta):
+    G, Ginv, SigA, R, Rinv, SigE = model.params2mats(theta)
+    X, Z, y = model.X, model.Z.toarray(), model.y
+    V = Z.dot(G.toarray()).dot(Z.T) + R.toarray()
+    Vinv = np.linalg.inv(V)
+    XtVX = X.T.dot(Vinv).dot(X)
+    P = Vinv - Vinv.dot(X).dot(np.linalg.solve(XtVX, X.T.dot(Vinv)))
+    ll = np.linalg.slogdet(V)[1] + np.linalg.slogdet(XtVX)[1] \
+         + y.T.dot(P).dot(y)[0, 0]
+    return ll, P
+
+
+def central_diff(func, x, eps=1e-5):
+    E = np.eye(len(x)) * eps
+    J = [(func(x + E[i]) - func(x - E[i])) / (2.0 * eps) 
+         for i in range(len(x))]
+    return np.array(J).T
+
+
+def dense_ai(model, theta):
+    ll, P = dense_loglike(model, theta)
+    Py = P.dot(model.y)
+    PdVPy = [op.dot(Py) for op in model.deriv_ops]
+    q = len(PdVPy)
+    AI = np.zeros((q, q))
+    for i in range(q):
+        for j in range(q):
+            AI[i, j] = PdVPy[i].T.dot(P).dot(PdVPy[j])[0, 0]
+    return AI
+
+
+for acov in [None, {'id':sps.csc_matrix(A)}]:
+    model = mv.LMM("y~x1+x2+(1+x2|id)", data=df, acov=acov)
+    theta = np.array([0.8, 0.1, 0.4, 1.1])
+
+    # the likelihood of the model omits k log|A|, which does not depend on
+    # theta, for the k=2 random effects with unit covariance A
+    const = 0.0 if acov is None else 2.0 * np.linalg.slogdet(A)[1]
+    ll_sparse = model.loglike(theta)
+    ll_dense = dense_loglike(model, theta)[0]
+    print(np.allclose(ll_sparse + const, ll_dense))
+
+    g_sparse = model.gradient(theta)
+    g_dense = central_diff(lambda x: dense_loglike(model, x)[0], theta)
+    print(np.allclose(g_sparse, g_dense, atol=1e-5))
+
+    AI_sparse = model.average_information(theta)
+    AI_dense = dense_ai(model, theta)
+    print(np.allclose(AI_sparse, AI_dense))
+
+    H = model.hessian(theta)
+    H_fd = central_diff(model.gradient, theta)
+    print(np.allclose(H, (H_fd + H_fd.T) / 2.0, atol=1e-5))
+
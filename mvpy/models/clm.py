@@ -20,13 +20,13 @@ from ..utils import linalg_utils, base_utils, statfunc_utils
         
 class MinimalCLM:
     
-    def __init__(self, X, Y):
+    def __init__(self, X, Y, W=None):
         self.X, self.Y = X, Y
         self.n_cats = len(np.unique(self.Y[~np.isnan(self.Y)]))
         self.resps = np.unique(self.Y[~np.isnan(self.Y)])
         self.resps = np.sort(self.resps)
         #self.W = self.Y.dot(np.arange(self.n_cats))+1.0
-        self.W = ones(self.X.shape[0])
+        self.W = ones(self.X.shape[0]) if W is None else W
         self.constraints = [dict(zip(
                 ['type', 'fun'], 
                 ['ineq', lambda params: params[i+1]-params[i]])) 
@@ -97,8 +97,9 @@ class MinimalCLM:
         Pi = Gamma_1 - Gamma_2
         Phi3 =linalg_utils._check_2d(W / Pi**2)
         dPi = (B1 * Phi_11).T - (B2*Phi_12).T
-        T0 = (B1 * Phi_21).T.dot(B1)
-        T1 = (B2 * Phi_22).T.dot(B2)
+        Wc = linalg_utils._check_2d(W)
+        T0 = (B1 * Phi_21 * Wc).T.dot(B1)
+        T1 = (B2 * Phi_22 * Wc).T.dot(B2)
         T2 = dPi.dot(dPi.T*Phi3)
         H=T0-T1-T2
         return -H
@@ -110,7 +111,8 @@ class MinimalCLM:
                                 'options':{'verbose':0}}
             
         
-        theta = statfunc_utils.norm_qtf(np.sum(self.Y, axis=0).cumsum()[:-1]/np.sum(self.Y))
+        counts = self.W.dot(self.Y)
+        theta = statfunc_utils.norm_qtf(counts.cumsum()[:-1]/np.sum(counts))
         beta = ones(self.X.shape[1])
         params = np.concatenate([theta, beta], axis=0)
         self.theta_init = theta
@@ -126,7 +128,25 @@ class MinimalCLM:
 
 class CLM:
     
-    def __init__(self, frm, data, X=None, Y=None):
+    def __init__(self, frm, data, X=None, Y=None, freq_weights=None, 
+                 compress=False):
+        '''
+        Cumulative link (proportional odds) model for an ordinal response
+        
+        Parameters
+        ----------
+        frm : str
+            patsy formula
+        data : dataframe
+            data referenced by frm
+        freq_weights : array, optional
+            Frequency weights, i.e. the number of times each row is 
+            observed, held in W
+        compress : bool, default False
+            If True, duplicated rows of (X, Y) are collapsed into frequency
+            weights before fitting, giving the same estimates and standard 
+            errors at the cost of the unique rows
+        '''
         Y, X = patsy.dmatrices(frm, data, return_type='dataframe')
         self.X, self.xcols, self.xix, self.x_is_pd = base_utils.check_type(X)
         self.Y, self.ycols, self.yix, self.y_is_p = base_utils.check_type(Y)
@@ -137,7 +157,17 @@ class CLM:
         self.Y = np.concatenate([(self.Y==x)[:, None] for x in self.resps],
                                  axis=1).astype(float)
         #self.W = self.Y.dot(np.arange(self.n_cats))+1.0
-        self.W = ones(self.X.shape[0])
+        if freq_weights is not None:
+            freq_weights = linalg_utils._check_1d(
+                    linalg_utils._check_np(freq_weights)).astype(float)
+        if compress:
+            (self.X, self.Y), counts, self.row_inverse = \
+                base_utils.compress_rows(self.X, self.Y)
+            if freq_weights is not None:
+                counts = np.bincount(self.row_inverse, weights=freq_weights)
+            freq_weights, self.xix, self.yix = counts, None, None
+        self.W = ones(self.X.shape[0]) if freq_weights is None else freq_weights
+        self.n_obs = np.sum(self.W)
         self.constraints = [dict(zip(
                 ['type', 'fun'], 
                 ['ineq', lambda params: params[i+1]-params[i]])) 
@@ -159,56 +189,69 @@ class CLM:
         y = (exp(x)*(1.0 - exp(x))) / (exp(x) + 1.0)**3.0
         return y
     
-    
-    def loglike(self, params):
-        W = self.W
-        params = linalg_utils._check_1d(params)
+    def _compute_iterate(self, params):
         o1, o2 = self.o1, self.o2
         B1, B2 = self.B1, self.B2
         Nu_1, Nu_2 = B1.dot(params)+o1, B2.dot(params)+o2
         Gamma_1, Gamma_2 = self.inv_logit(Nu_1), self.inv_logit(Nu_2)
+        Phi_11, Phi_12 = self.dlogit(Nu_1), self.dlogit(Nu_2)
         Pi = Gamma_1 - Gamma_2
+        return dict(Nu_1=Nu_1, Nu_2=Nu_2, Phi_11=Phi_11, Phi_12=Phi_12, 
+                    Pi=Pi)
+    
+    def _iterate(self, params):
+        '''
+        Linear predictors of the two cumulative logits, their derivatives 
+        and the category probabilities at params, held in a small cache so
+        that loglike, gradient and hessian compute them once per iterate
+        '''
+        params = linalg_utils._check_1d(params)
+        if not hasattr(self, '_cache'):
+            self._cache = base_utils.ParamCache(maxsize=2)
+        return self._cache.get(params, self._compute_iterate)
+    
+    def loglike(self, params):
+        W = self.W
+        Pi = self._iterate(params)['Pi']
         LL = np.sum(W * np.log(Pi))
         return -LL
     
     def gradient(self, params):
         W = self.W
-        o1, o2 = self.o1, self.o2
         B1, B2 = self.B1, self.B2
-        Nu_1, Nu_2 = B1.dot(params)+o1, B2.dot(params)+o2
-        Phi_11, Phi_12 = self.dlogit(Nu_1), self.dlogit(Nu_2)
+        it = self._iterate(params)
+        Phi_11, Phi_12 = it['Phi_11'], it['Phi_12']
         #Phi_11[Y[:, 0].astype(bool)], Phi_12[Y[:, -1].astype(bool)] = 1.0, 0.0
         dPi = (B1 * Phi_11[:, None]).T - (B2*Phi_12[:, None]).T
-        Gamma_1, Gamma_2 = self.inv_logit(Nu_1), self.inv_logit(Nu_2)
         #Gamma_1[Y[:, 0].astype(bool)] = 1.0
         #Gamma_2[Y[:, -1].astype(bool)] = 0.0
-        Pi = Gamma_1 - Gamma_2
+        Pi = it['Pi']
         
         g = -dot(dPi, W / Pi)
         return g
     
     def hessian(self, params):
         W = self.W
-        o1, o2 = self.o1, self.o2
         B1, B2 = self.B1, self.B2
-        Nu_1, Nu_2 = B1.dot(params)+o1, B2.dot(params)+o2
+        it = self._iterate(params)
+        Nu_1, Nu_2 = it['Nu_1'], it['Nu_2']
         Phi_21, Phi_22 = self.d2logit(Nu_1),  self.d2logit(Nu_2)
         #Phi_21[Y[:, 0].astype(bool)], Phi_22[Y[:, -1].astype(bool)] = 1.0, 0.0
     
-        Phi_11, Phi_12 = self.dlogit(Nu_1), self.dlogit(Nu_2)
+        Phi_11, Phi_12 = it['Phi_11'], it['Phi_12']
         #Phi_11[Y[:, 0].astype(bool)], Phi_12[Y[:, -1].astype(bool)] = 1.0, 0.0
         Phi_11 = linalg_utils._check_2d(Phi_11)
         Phi_12 = linalg_utils._check_2d(Phi_12)
         Phi_21 = linalg_utils._check_2d(Phi_21)
         Phi_22 = linalg_utils._check_2d(Phi_22)
-        Gamma_1, Gamma_2 = self.inv_logit(Nu_1), self.inv_logit(Nu_2)
         #Gamma_1[Y[:, 0].astype(bool)] = 1.0
         #Gamma_2[Y[:, -1].astype(bool)] = 0.0
-        Pi = Gamma_1 - Gamma_2
+        Pi = it['Pi']
         Phi3 =linalg_utils._check_2d(W / Pi**2)
         dPi = (B1 * Phi_11).T - (B2*Phi_12).T
-        T0 = (B1 * Phi_21).T.dot(B1)
-        T1 = (B2 * Phi_22).T.dot(B2)
+        Wc = linalg_utils._check_2d(W)
+        T0 = (B1 * Phi_21 * Wc).T.dot(B1)
+        T1 = (B2 * Phi_22 * Wc).T.dot(B2)
         T2 = dPi.dot(dPi.T*Phi3)
         H=T0-T1-T2
         return -H
@@ -218,10 +261,13 @@ class CLM:
             optimizer_kwargs = {'method':'trust-constr',
                                 'options':{'verbose':0}}
             
-        intercept_model = MinimalCLM(np.ones((self.X.shape[0], 1)), self.Y)
+        intercept_model = MinimalCLM(np.ones((self.X.shape[0], 1)), self.Y, 
+                                     self.W)
         intercept_model.fit()
         self.intercept_model = intercept_model
-        theta = statfunc_utils.norm_qtf(np.sum(self.Y, axis=0).cumsum()[:-1]/np.sum(self.Y))
+        self._cache = base_utils.ParamCache(maxsize=2)
+        counts = self.W.dot(self.Y)
+        theta = statfunc_utils.norm_qtf(counts.cumsum()[:-1]/np.sum(counts))
         beta = ones(self.X.shape[1])*0
         params = np.concatenate([theta, beta], axis=0)
         self.theta_init = theta
@@ -246,7 +292,7 @@ class CLM:
         else:
           idx = idx+["beta%i"%i for i in range(self.X.shape[1])]
         self.res.index  = idx
-        self.res['p']  = sp.stats.t.sf(np.abs(self.res['t']), self.Y.shape[0]-len(self.params))*2.0
+        self.res['p']  = sp.stats.t.sf(np.abs(self.res['t']), self.n_obs-len(self.params))*2.0
         self.theta = self.params[:len(theta)]
         self.beta = self.params[len(theta):]
         self.LLA = self.loglike(self.params)
@@ -254,7 +300,7 @@ class CLM:
         self.LLR = self.LL0 - self.LLA
         self.LLRp = sp.stats.chi2.sf(self.LLR, 
                                   len(self.params) - len(self.intercept_model.params))
-        n, p = self.X.shape
+        n, p = self.n_obs, self.X.shape[1]
         rmax =  (1 - np.exp(-2.0/n * (self.LL0)))
         r2_coxsnell = 1 - np.exp(2.0/n*(self.LLA-self.LL0))
         r2_mcfadden = 1 - self.LLA/self.LL0
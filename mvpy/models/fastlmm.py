@@ -7,17 +7,50 @@ Created on Sat May  9 16:42:06 2020
 """
 
 import re # analysis:ignore
-import jax # analysis:ignore
+import json # analysis:ignore
+import time # analysis:ignore
 import patsy # analysis:ignore
 import timeit# analysis:ignore
-import numba # analysis:ignore
+import functools # analysis:ignore
+import tracemalloc # analysis:ignore
 import numpy as np # analysis:ignore
 import scipy as sp # analysis:ignore
 import pandas as pd # analysis:ignore
-import mvpy.api as mv # analysis:ignore
-import jax.numpy as jnp  # analysis:ignore
 import scipy.sparse as sps # analysis:ignore
 
+
+def _numba_jit(*jit_args, **jit_kws):
+    '''
+    Equivalent of numba.jit that defers importing numba, and compiling the
+    function, until the function is first called
+    '''
+    def decorator(func):
+        compiled = []
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not compiled:
+                import numba
+                compiled.append(numba.jit(*jit_args, **jit_kws)(func))
+            return compiled[0](*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _jax_jit(func):
+    '''
+    Equivalent of jax.jit that defers importing jax until the function is 
+    first called
+    '''
+    compiled = []
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not compiled:
+            import jax
+            compiled.append(jax.jit(func))
+        return compiled[0](*args, **kwargs)
+    return wrapper
+
+
 def _check_np(x):
     if type(x) is not np.ndarray:
         x = x.values
@@ -69,12 +102,12 @@ def lmat(n):
     return L  
 
 
-@numba.jit(nopython=True)
+@_numba_jit(nopython=True)
 def _lmat(n):
     p = int(n * (n + 1) / 2)
     template = np.arange(n)
-    z = np.ones((p,), dtype=numba.int64)
-    k = np.zeros((p,), dtype=numba.int64)
+    z = np.ones((p,), dtype=np.int64)
+    k = np.zeros((p,), dtype=np.int64)
     a = int(0)
     for i in range(n):
         k[a:a+n-i] = template
@@ -88,15 +121,15 @@ def lmat_nb(n):
     K = sp.sparse.csc_matrix(data, shape=shape)
     return K
 
-@numba.jit(nopython=True)
+@_numba_jit(nopython=True)
 def _kmat(p, q):
     p = int(p)
     q = int(q)
     pq = p * q
     
     template = np.arange(0, int(q)) * int(p)
-    z = np.ones((pq, ), dtype=numba.int64)
-    k = np.zeros((pq,), dtype=numba.int64)
+    z = np.ones((pq, ), dtype=np.int64)
+    k = np.zeros((pq,), dtype=np.int64)
     for i in range(p):
         k[i*q:(i+1)*q] = template + i
     return (z, (np.arange(pq), k)), (pq, pq)
@@ -106,14 +139,14 @@ def kmat_nb(p, q):
     K = sp.sparse.csc_matrix(data, shape=shape)
     return K
 
-@numba.jit(nopython=True)
+@_numba_jit(nopython=True)
 def _dmat(n):
     p = int(n * (n + 1) / 2)
     m = int(n**2)
     r = int(0)
     a = int(0)
     
-    d = np.zeros((m,), dtype=numba.int64)
+    d = np.zeros((m,), dtype=np.int64)
     t = np.ones((m,), dtype=np.double)
     for i in range(n):
         d[r:r+i] = i - n + np.cumsum(n - np.arange(0, i)) + 1
@@ -135,7 +168,7 @@ def nmat_nb(n):
     N = K + I
     return N
 
-@numba.jit(nopython=True)
+@_numba_jit(nopython=True)
 def khatri_rao(X, Y):
     n, p = X.shape
     m, q = Y.shape
@@ -210,7 +243,7 @@ def add_chol_row(xnew, xold, L=None):
                        [r, np.atleast_1d(rpp)]])
         return A
     
-@numba.jit(nopython=True)
+@_numba_jit(nopython=True)
 def toeplitz_cholesky_lower_nb(n, A):
     g = np.zeros((2, n), dtype=np.double)
     for j in range(0, n):
@@ -238,7 +271,7 @@ def toeplitz_cholesky_lower_nb(n, A):
         g[0, i] = 0.0
     return L
 
-@numba.jit(nopython=True)
+@_numba_jit(nopython=True)
 def vech(X):
     p = X.shape[0]
     tmp =  1 - np.tri(p, p, k=-1)
@@ -247,7 +280,7 @@ def vech(X):
     Y = X.T.flatten()[ix]
     return Y
 
-@numba.jit(nopython=True)
+@_numba_jit(nopython=True)
 def invech(v):
     '''
     Inverse half vectorization operator
@@ -265,42 +298,45 @@ def invech(v):
     return Y
 
 
-@jax.jit
+@_jax_jit
 def jax_vec(X):
     '''
     Takes an n \times p matrix and returns a 1 dimensional np vector
     '''
     return X.reshape(-1, order='F')
 
-@jax.jit
+@_jax_jit
 def jax_invec(x, n_rows, n_cols):
     '''
     Takes an np 1 dimensional vector and returns an n \times p matrix
     '''
     return x.reshape(int(n_rows), int(n_cols), order='F')
 
-@jax.jit
+@_jax_jit
 def jax_vech(X):
     '''
     Half vectorization operator; returns an \frac{(n+1)\times n}{2} vector of
     the stacked columns of unique items in a symmetric  n\times n matrix
     '''
+    import jax.numpy as jnp
     rix, cix = jnp.triu_indices(len(X))
     res = jnp.take(X.T, rix*len(X)+cix)
     return res
 
-@jax.jit
+@_jax_jit
 def jax_invech(v):
     '''
     Inverse half vectorization operator
     '''
+    import jax
+    import jax.numpy as jnp
     rows = int(jnp.round(.5 * (-1 + jnp.sqrt(1 + 8 * len(v)))))
     res = jnp.zeros((rows, rows))
     res = jax.ops.index_update(res, jnp.triu_indices(rows), v)
     res = res + res.T - jnp.diag(jnp.diag(res))
     return res
 
-@numba.jit(nopython=True)
+@_numba_jit(nopython=True)
 def vine_corr(d, betaparams=10):
     P = np.zeros((d, d))
     S = np.eye(d)
@@ -322,7 +358,7 @@ def vine_corr(d, betaparams=10):
     S = v.dot(S).dot(v)
     return S
 
-@numba.jit(nopython=True)
+@_numba_jit(nopython=True)
 def onion_corr(d, betaparams=10):
     beta = betaparams + (d - 2) / 2
     u = np.random.beta(beta, beta)
@@ -361,7 +397,7 @@ def _check_shape(x, ndims=1):
     
     return x
 
-@numba.jit
+@_numba_jit()
 def _check_shape_nb(x, ndims=1):
     if x.ndim>ndims:
         y = x.reshape(x.shape[:-1])
@@ -386,7 +422,7 @@ def dummy(x, fullrank=True, categories=None):
 
 
 
-@numba.jit
+@_numba_jit()
 def dummy_nb(x, fullrank=True, categories=None):
     x = _check_shape_nb(x)
     if categories is None:
@@ -414,15 +450,18 @@ def parse_random_effects(formula):
     return fe_form, groups
 
 def construct_random_effects(groups, data, n_vars):
+    # sparse_utils imports numba at module level, so like the kernels above
+    # it is imported on first use here and in LME and batch_lme
+    from mvpy.utils.sparse_utils import sparse_khatri_rao
     re_vars, re_groupings = list(zip(*groups))
     re_vars, re_groupings = set(re_vars), set(re_groupings)
     Zdict = dict(zip(re_vars, [_check_np(patsy.dmatrix(x, data=data, return_type='dataframe')) for x in re_vars]))
-    Jdict = dict(zip(re_groupings, [dummy_nb(data[x]) for x in re_groupings]))
     dim_dict = {}
     Z = []
     for x, y in groups:
-        dim_dict[y] = {'n_groups':Jdict[y].shape[1], 'n_vars':Zdict[x].shape[1]}
-        Zi = khatri_rao(Jdict[y].T, Zdict[x].T).T
+        Zi = sparse_khatri_rao(data[y], Zdict[x]).toarray()
+        dim_dict[y] = {'n_groups':Zi.shape[1] // Zdict[x].shape[1], 
+                       'n_vars':Zdict[x].shape[1]}
         Z.append(Zi)
     Z = np.concatenate(Z, axis=1)
     return Z, dim_dict
@@ -573,28 +612,34 @@ def get_jacmats(deriv_mats):
 class LME:
     
     def __init__(self, formula, data):
+        from mvpy.utils.sparse_utils import (BlockDiagonalCovariance,
+                                             RelativeCovarianceFactor)
         X, Z, y, dims = construct_model_matrices(formula, data)
         dims['error'] = dict(n_groups=len(X), n_vars=1)
 
         theta, indices = make_theta(dims)
-        XZ = sps.hstack([X, Z])
+        XZ = sps.hstack([sps.csc_matrix(_check_np(X)), sps.csc_matrix(Z)],
+                        format='csc')
         C = XZ.T.dot(XZ)
         Xty = X.T.dot(y)
         Zty = Z.T.dot(y)
         b = np.vstack([Xty, Zty])
-        Gmats, g_indices = create_gmats(theta, indices, dims)
-        Gmats_inverse, _ = create_gmats(theta, indices, dims, inverse=True)
-        G = sps.block_diag(list(Gmats.values())).tocsc()
-        Ginv =  sps.block_diag(list(Gmats_inverse.values())).tocsc()
+        shapes = dict([(key, (value['n_groups'], value['n_vars'])) 
+                       for key, value in dims.items() if key!='error'])
+        gmats = BlockDiagonalCovariance(shapes, indices).update(theta)
+        factor = RelativeCovarianceFactor(shapes, dict([(key, indices[key])
+                                                        for key in shapes]),
+                                          X.shape[1], 1, lower=1e-4)
+        G, Ginv = gmats.G.copy(), gmats.Ginv.copy()
         Zs = sps.csc_matrix(Z)
         Ip = sps.eye(Zs.shape[0])
         self.bounds = [(None, None) if int(x)==0 else (0, None) for x in theta]
         self.G = G
         self.Ginv = Ginv
-        self.g_indices = g_indices
-        self.X = _check_shape_nb(_check_np(X), 2)
+        self.gmats = gmats
+        self.X = _check_shape(_check_np(X), 2)
         self.Z = Z
-        self.y = _check_shape_nb(_check_np(y), 2)
+        self.y = _check_shape(_check_np(y), 2)
         self.XZ = XZ
         self.C = C
         self.Xty = Xty
@@ -611,11 +656,14 @@ class LME:
         self.yty = y.T.dot(y)
         self.jac_mats = get_jacmats(self.deriv_mats)
         self.t_indices = list(zip(*np.triu_indices(len(theta))))
+        self.factor = factor
+        self._cross = sps.bmat([[self.C, self.b], 
+                                [self.b.T, np.atleast_2d(self.yty)]]).A
     
     
     def _params_to_model(self, theta):
-        G = update_gmat(theta, self.G.copy(), self.dims, self.indices, self.g_indices)
-        Ginv = update_gmat(theta, self.G.copy(), self.dims, self.indices, self.g_indices, inverse=True)
+        gmats = self.gmats.update(theta)
+        G, Ginv = gmats.G.copy(), gmats.Ginv.copy()
         s = theta[-1]
         R = self.Ip * s
         Rinv = self.Ip / s 
@@ -630,7 +678,7 @@ class LME:
         k =  Ginv.shape[0]
         C[-k:, -k:] += Ginv
         logdetR = np.log(s) * self.Z.shape[0]
-        logdetG = lndet_gmat(theta, self.dims, self.indices)
+        logdetG = self.gmats.update(theta).logdet()
         yty = np.array(np.atleast_2d(self.yty/s))
         M = sps.bmat([[C, self.b/s],
                       [self.b.T/s, yty]])
@@ -641,6 +689,57 @@ class LME:
         ll = logdetC+logdetG+logdetR+ytPy
         return ll
     
+    def _profiled_mme(self, lam):
+        T = self.factor.update(lam).T.A
+        M = T.T.dot(self._cross).dot(T)
+        k = self.Z.shape[1]
+        M[-k-1:-1, -k-1:-1] += np.eye(k)
+        return M, T
+    
+    def loglike_profiled(self, lam):
+        '''
+        Minus two times the restricted log likelihood with the residual 
+        variance profiled out, parameterized by the lower triangular 
+        relative covariance factors; see LMM.loglike_profiled
+        '''
+        M, T = self._profiled_mme(lam)
+        try:
+            L = np.linalg.cholesky(M)
+        except np.linalg.LinAlgError:
+            return np.inf
+        nu = self.X.shape[0] - self.X.shape[1]
+        r2 = np.diag(L)[-1]**2
+        logdetC = np.sum(2*np.log(np.diag(L))[:-1])
+        ll = logdetC + nu * (1.0 + np.log(r2 / nu))
+        return ll
+    
+    def gradient_profiled(self, lam):
+        M, T = self._profiled_mme(lam)
+        C, b = M[:-1, :-1], M[:-1, -1]
+        Cinv = np.linalg.inv(C)
+        c = Cinv.dot(b)
+        nu = self.X.shape[0] - self.X.shape[1]
+        r2 = M[-1, -1] - b.dot(c)
+        KTC = self._cross[:-1, :-1].dot(T[:-1, :-1]).dot(Cinv)
+        XZ = self.XZ
+        Zte = XZ.T.dot(self.y[:, 0] - XZ.dot(T[:-1, :-1].dot(c)))
+        start, size = self.factor.start[:-1], self.factor.size[:-1]
+        D = np.zeros((len(start), np.max(size)))
+        for d in range(D.shape[1]):
+            ix = np.nonzero(size > d)[0]
+            ix = ix[ix>=self.X.shape[1]]
+            jx = start[ix] + d
+            D[ix, d] = 2.0 * KTC[ix, jx] - 2.0 * nu / r2 * Zte[ix] * c[jx]
+        return self.factor.collect(D)
+    
+    def _profiled_to_theta(self, lam):
+        M, T = self._profiled_mme(lam)
+        C, b = M[:-1, :-1], M[:-1, -1]
+        s = (M[-1, -1] - b.dot(np.linalg.solve(C, b))) / \
+            (self.X.shape[0] - self.X.shape[1])
+        theta = self.factor.covariance_params(lam, s)
+        return np.concatenate([theta, [s]])
+        
     def gradient(self, theta):
         dims = self.dims
         G, Ginv, R, Rinv, V, Vinv, W, s = self._params_to_model(theta)
@@ -683,7 +782,16 @@ class LME:
         H = invech(np.concatenate(H)[:, 0])
         return H
     
-    def _optimize_theta(self, optimizer_kwargs={}, hess=None):
+    def _optimize_theta(self, optimizer_kwargs={}, hess=None, profiled=False):
+        if profiled:
+            optimizer = sp.optimize.minimize(self.loglike_profiled, 
+                                             self.factor.theta0, 
+                                             bounds=self.factor.bounds,
+                                             jac=self.gradient_profiled,
+                                             method='L-BFGS-B')
+            optimizer.x_profiled = optimizer.x
+            optimizer.x = self._profiled_to_theta(optimizer.x)
+            return optimizer, optimizer.x
         if 'method' not in optimizer_kwargs.keys():
             optimizer_kwargs['method'] = 'trust-constr'
         if 'options' not in optimizer_kwargs.keys():
@@ -715,8 +823,9 @@ class LME:
         
         return beta, XtWX_inv, u, G, R, Rinv, V, Vinv
     
-    def _fit(self, optimizer_kwargs={}, hess=None):
-        optimizer, theta = self._optimize_theta(optimizer_kwargs, hess)
+    def _fit(self, optimizer_kwargs={}, hess=None, profiled=False):
+        optimizer, theta = self._optimize_theta(optimizer_kwargs, hess, 
+                                                profiled)
         self.theta = theta
         
         H_theta, Hinv_theta, SE_theta = self._acov(theta)
@@ -761,93 +870,380 @@ class LME:
         self.params_tvalues = self.params / self.se_params
         df = self.X.shape[0]-len(self.theta)
         self.params_pvalues = sp.stats.t(df).sf(np.abs(self.params_tvalues))
-        
-        
-        
-                
-            
-        
-        
-        
 
+
+def spectral_decomposition(Z, tol=1e-10):
+    '''
+    Nonzero eigenvalues s and the corresponding rotation U_{1}'=S^{-1/2}V'Z' 
+    of ZZ', from the eigendecomposition Z'Z=VSV' of the (usually much
+    smaller) q by q cross product. When Z'Z is diagonal, as it is for a 
+    single random intercept, no eigendecomposition is needed.
     
+    Returns
+    -------
+    s : array
+        Nonzero eigenvalues of ZZ'
     
-    
-
-df = pd.DataFrame(np.kron(np.arange(200), np.ones(20)), columns=['id1'])
-df['id2'] = np.kron(np.arange(50), np.ones(80))
-df['id3'] = np.kron(np.arange(100), np.ones(40))
-
-df['x1'] = np.random.normal(size=(4000))
-df['x2'] = np.random.normal(size=(4000))
-df['x3'] = np.random.normal(size=(4000))
-df['x4'] = np.random.normal(size=(4000))
-df['x5'] = np.random.normal(size=(4000))
-
-df['y'] = 0
-
-X, Z, y, dims = construct_model_matrices("y~x1+x5-1+(1+x2|id1)+(1|id2)+(1+x3+x4|id3)", data=df)
-dims['error'] = dict(n_groups=len(X), n_vars=1)
-
-G1 = np.array([[1.0, 0.2],
-               [0.2, 1.0]])
-G2 = np.array([[1.0]])
-G3 = vine_corr(3)
-
-U1 = sp.stats.multivariate_normal(np.zeros(2), G1).rvs(200).flatten()
-U2 = sp.stats.multivariate_normal(np.zeros(1), G2).rvs(50)
-U3 = sp.stats.multivariate_normal(np.zeros(3), G3).rvs(100).flatten()
-
-beta = np.array([1.5, -1.0])
-eta = X.dot(beta)+Z.dot(np.concatenate((U1, U2, U3)))
-var = eta.var()
-df['y'] = sp.stats.norm(eta, np.sqrt((1-0.5)/0.5*var)).rvs()
-
-mod = LME("y~x1+x5-1+(1+x2|id1)+(1|id2)+(1+x3+x4|id3)", data=df)
-lmm = mv.LMM("y~x1+x5-1+(1+x2|id1)+(1|id2)+(1+x3+x4|id3)", data=df)
-
-theta = mod.theta
-
-ll_new = mod.loglike(theta)
-ll_old = lmm.loglike(theta)
-
-np.allclose(ll_new, ll_old)
-
-g_new = mod.gradient(theta)
-g_old = lmm.gradient(theta)
-
-np.allclose(g_new, g_old)
-
-
-H_new = mod.hessian(theta)
-H_old = lmm.hessian(theta)
-
-np.allclose(H_new, H_old)
-
-
-ll_time_new = timeit.timeit("mod.loglike(theta)", globals=globals(), number=1)
-ll_time_prv = timeit.timeit("lmm.loglike(theta)", globals=globals(), number=1)
+    rotate : callable
+        Function returning U_{1}'A for an n by k array A
+    '''
+    Zs = sps.csc_matrix(Z)
+    ZtZ = Zs.T.dot(Zs)
+    if (ZtZ - sps.diags(ZtZ.diagonal())).nnz==0:
+        s = ZtZ.diagonal()
+        keep = s > tol * np.max(s)
+        Zk = sps.csc_matrix(Zs[:, keep].dot(sps.diags(1.0 / np.sqrt(s[keep]))))
+        s = s[keep]
+    else:
+        s, V = np.linalg.eigh(ZtZ.A)
+        keep = s > tol * np.max(s)
+        s, V = s[keep], V[:, keep]
+        Zk = Zs.dot(V / np.sqrt(s))
+    rotate = lambda A: np.asarray(Zk.T.dot(A))
+    return s, rotate
 
-gd_time_new = timeit.timeit("mod.gradient(theta)", globals=globals(), number=1)
-gd_time_prv = timeit.timeit("lmm.gradient(theta)", globals=globals(), number=1)
 
+def _batch_reml_terms(logh, s, Xt, Yt, XtX_r, XtY_r, yty_r, n):
+    '''
+    Profiled REML criterion for each column at the variance ratios exp(logh),
+    computed from the rotated data.  The part of the data orthogonal to the
+    column space of Z enters only through the residual cross products 
+    XtX_r, XtY_r, and yty_r.
+    '''
+    p = Xt.shape[1]
+    h = np.exp(logh)
+    d = 1.0 / (h[None] * s[:, None] + 1.0)
+    XtHX = XtX_r[None] + np.einsum('ia,im,ib->mab', Xt, d, Xt, optimize=True)
+    XtHy = XtY_r.T + np.einsum('ia,im,im->ma', Xt, d, Yt, optimize=True)
+    yHy = yty_r + np.einsum('im,im->m', d, Yt**2)
+    L = np.linalg.cholesky(XtHX)
+    w = np.linalg.solve(L, XtHy[:, :, None])[:, :, 0]
+    yPy = yHy - np.sum(w**2, axis=1)
+    logdetH = -np.sum(np.log(d), axis=0)
+    logdetXHX = 2.0 * np.sum(np.log(np.diagonal(L, axis1=1, axis2=2)), axis=1)
+    ll = logdetH + logdetXHX + (n - p) * (1.0 + np.log(yPy / (n - p)))
+    return ll, L, w, yPy
+
+
+def batch_reml(X, Z, Y, n_grid=41, bounds=(-10.0, 10.0), tol=1e-6,
+               xnames=None, ynames=None):
+    '''
+    FaST-LMM style restricted maximum likelihood for many responses sharing
+    the design y = Xb + Zu + e, with Cov(u)=\\sigma_{u}^{2}I and 
+    Cov(e)=\\sigma_{e}^{2}I.  ZZ' is decomposed once, X and every column of Y
+    are rotated once, and with \\sigma_{e}^{2} profiled out the REML 
+    criterion of each response is a function of the variance ratio 
+    h=\\sigma_{u}^{2}/\\sigma_{e}^{2} alone.  The ratios are found with a
+    grid search over log(h) followed by golden section search, vectorized
+    over the columns of Y, with each evaluation costing O(rank(Z)p^2) per
+    response.
+    
+    Parameters
+    ----------
+    X : array
+        n by p fixed effect design matrix
+    
+    Z : array or sparse matrix
+        n by q random effect design matrix
+    
+    Y : array
+        n by m matrix of responses
+    
+    n_grid : int, default 41
+        Number of grid points over log(h)
+    
+    bounds : tuple, default (-10, 10)
+        Range of log(h) searched; h=0 is always considered as well
+    
+    tol : float, default 1e-6
+        Width of the final bracket on log(h)
+    
+    xnames, ynames : list, default None
+        Names of the fixed effects and responses
+    
+    Returns
+    -------
+    res : DataFrame
+        One row per response with the fixed effects, their standard errors,
+        the random effect and error variances, the variance ratio, and minus
+        two times the restricted log likelihood
+    '''
+    X, Y = _check_shape(_check_np(X), 2), _check_shape(_check_np(Y), 2)
+    n, p = X.shape
+    m = Y.shape[1]
+    s, rotate = spectral_decomposition(Z)
+    Xt, Yt = rotate(X), rotate(Y)
+    XtX_r = X.T.dot(X) - Xt.T.dot(Xt)
+    XtY_r = X.T.dot(Y) - Xt.T.dot(Yt)
+    yty_r = np.sum(Y**2, axis=0) - np.sum(Yt**2, axis=0)
+    terms = (s, Xt, Yt, XtX_r, XtY_r, yty_r, n)
+    
+    grid = np.linspace(bounds[0], bounds[1], n_grid)
+    f = np.vstack([_batch_reml_terms(np.full(m, x), *terms)[0] for x in grid])
+    i = np.argmin(f, axis=0)
+    a, b = grid[np.maximum(i-1, 0)], grid[np.minimum(i+1, n_grid-1)]
+    r = (np.sqrt(5.0) - 1.0) / 2.0
+    c, d = b - r * (b - a), a + r * (b - a)
+    fc = _batch_reml_terms(c, *terms)[0]
+    fd = _batch_reml_terms(d, *terms)[0]
+    while np.max(b - a) > tol:
+        left = fc < fd
+        b = np.where(left, d, b)
+        a = np.where(left, a, c)
+        c_new = np.where(left, b - r * (b - a), d)
+        d_new = np.where(left, c, a + r * (b - a))
+        f_new = _batch_reml_terms(np.where(left, c_new, d_new), *terms)[0]
+        fc, fd = np.where(left, f_new, fd), np.where(left, fc, f_new)
+        c, d = c_new, d_new
+    logh = (a + b) / 2.0
+    ll, L, w, yPy = _batch_reml_terms(logh, *terms)
+    # boundary solution with no random effect variance
+    ll0, L0, w0, yPy0 = _batch_reml_terms(np.full(m, -np.inf), *terms)
+    zero = ll0 < ll
+    h = np.where(zero, 0.0, np.exp(logh))
+    ll, yPy = np.where(zero, ll0, ll), np.where(zero, yPy0, yPy)
+    L, w = np.where(zero[:, None, None], L0, L), np.where(zero[:, None], w0, w)
+    
+    s2 = yPy / (n - p)
+    Linv = np.linalg.inv(L)
+    beta = np.einsum('mba,mb->ma', Linv, w)
+    XtHX_inv = np.einsum('mca,mcb->mab', Linv, Linv)
+    se = np.sqrt(np.diagonal(XtHX_inv, axis1=1, axis2=2) * s2[:, None])
+    
+    xnames = ['x%i'%i for i in range(p)] if xnames is None else list(xnames)
+    ynames = ['y%i'%i for i in range(m)] if ynames is None else list(ynames)
+    res = pd.DataFrame(np.hstack([beta, se]), index=ynames,
+                       columns=xnames+['SE '+x for x in xnames])
+    res['re_var'] = h * s2
+    res['error_var'] = s2
+    res['ratio'] = h
+    res['loglike'] = ll
+    return res
 
-hs_time_new = timeit.timeit("mod.hessian(theta)", globals=globals(), number=1)
-hs_time_prv = timeit.timeit("lmm.hessian(theta)", globals=globals(), number=1) 
 
+def batch_lme(formula, data, yvars):
+    '''
+    Fits the model given by formula, with a single random intercept 
+    term e.g. "~x1+x2+(1|id)", to each of the columns yvars of data; see
+    batch_reml
+    '''
+    from mvpy.utils.sparse_utils import sparse_khatri_rao
+    fe_form, groups = parse_random_effects(formula)
+    if (len(groups)!=1) or (patsy.dmatrix(groups[0][0], data=data).shape[1]!=1):
+        raise ValueError("batch_lme requires a single random effect term "
+                         "with one variance component, e.g. (1|id)")
+    fe_form = re.sub("\+$", "", fe_form)
+    X = patsy.dmatrix(fe_form, data=data, return_type='dataframe')
+    re_var, group = groups[0]
+    Zij = _check_np(patsy.dmatrix(re_var, data=data, return_type='dataframe'))
+    Z = sparse_khatri_rao(data[group], Zij)
+    res = batch_reml(X.values, Z, data[yvars].values, xnames=X.columns,
+                     ynames=yvars)
+    return res
 
-optimizer, theta  = mod._optimize_theta()
 
-mod._compute_effects(theta)
-mod._fit()
+def simulate_benchmark_data(n_obs, n_levels, n_slopes=0, seed=None):
+    '''
+    Simulates data from a linear mixed model with a single grouping factor
+    
+    Parameters
+    ----------
+    n_obs: int
+        Number of observations
+    
+    n_levels: int
+        Number of levels of the grouping factor
+    
+    n_slopes: int, default 0
+        Number of random slopes in addition to the random intercept
+    
+    seed: int, default None
+        Seed for numpy.random.default_rng
+    
+    Returns
+    -------
+    data: DataFrame
+        Data with the response y, covariates x1,..., grouping id and 
+        positive weights w
+    
+    formula: str
+        Formula of the simulated model in the style used by LMM and LME
+    '''
+    rng = np.random.default_rng(seed)
+    k = n_slopes + 1
+    n_fixed = max(2, n_slopes)
+    data = pd.DataFrame(rng.normal(size=(n_obs, n_fixed)), 
+                        columns=['x%i'%(i+1) for i in range(n_fixed)])
+    data['id'] = rng.integers(0, n_levels, size=n_obs)
+    S = 0.3 * np.ones((k, k)) + 0.7 * np.eye(k)
+    U = rng.multivariate_normal(np.zeros(k), S, size=n_levels)
+    Zij = np.hstack([np.ones((n_obs, 1)), data.values[:, :n_slopes]])
+    eta = data.values[:, :n_fixed].dot(np.ones(n_fixed) * 0.5)
+    eta += np.sum(Zij * U[data['id'].values], axis=1)
+    data['w'] = rng.uniform(0.5, 1.5, size=n_obs)
+    data['y'] = eta + rng.normal(size=n_obs) * data['w']
+    fe = "+".join(['x%i'%(i+1) for i in range(n_fixed)])
+    re_terms = "+".join(['1']+['x%i'%(i+1) for i in range(n_slopes)])
+    formula = "y~%s+(%s|id)"%(fe, re_terms)
+    return data, formula
+
+
+def _trace_peak(func):
+    '''
+    Peak memory traced by tracemalloc during one call of func
+    '''
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak
 
-res = pd.DataFrame(np.vstack([mod.params,  mod.params_ci_lower, 
-                   mod.params_ci_upper, mod.se_params, mod.params_tvalues, mod.params_pvalues]).T)
 
-res.columns = ['params', '95CI-', '95CI+', 'SE', 't', 'p']
+def _measure(func, repeat, trace_memory=True):
+    '''
+    Minimum and median wall time over repeat calls of func, made without 
+    tracing, and, if trace_memory, the peak traced memory of one further
+    call (nan otherwise)
+    '''
+    times = timeit.Timer(func).repeat(repeat=repeat, number=1)
+    peak = _trace_peak(func) if trace_memory else np.nan
+    return np.min(times), np.median(times), peak
 
 
+def _benchmark_operations(model, data, formula, fit_method):
+    '''
+    Constructor and the operations timed for each model type
+    '''
+    fe_form, groups = parse_random_effects(formula)
+    yvar, fe_form = re.split("[~]", re.sub("\+$", "", fe_form))
+    random_effects = dict([(y, "~"+x) for x, y in groups])
+    if model=='LME':
+        construct = lambda: LME(formula, data)
+        fit = lambda mod, theta: (setattr(mod, 'theta', theta.copy()), 
+                                  mod._fit({'options': {'verbose': 0}}))
+    elif model=='LMM':
+        from mvpy.models.lmm import LMM
+        construct = lambda: LMM(formula, data)
+        fit = lambda mod, theta: mod._fit(method=fit_method, verbose=0)
+    elif model=='WLMM':
+        from mvpy.models.glmm import WLMM
+        construct = lambda: WLMM("~"+fe_form, random_effects, yvar.strip(),
+                                 data, W=data['w'].values)
+        fit = lambda mod, theta: mod._fit(method=fit_method, verbose=0)
+    else:
+        raise ValueError("Unknown model %s"%model)
+    return construct, fit
 
 
+def benchmark_models(n_obs=(500, 2000, 8000), n_levels=(20, 100), 
+                     n_slopes=(0, 1), models=('LME', 'LMM', 'WLMM'),
+                     operations=('loglike', 'gradient', 'hessian', 'fit'),
+                     repeat=3, fit_method='ai', max_dense_obs=2000, seed=0,
+                     trace_memory=True, output=None):
+    '''
+    Times the construction, loglike, gradient, hessian and fit of the mixed
+    models over a grid of problem sizes, recording the wall time and the
+    peak memory traced by tracemalloc.  The timed calls run without 
+    tracing; the peak memory is that of one additional call of each 
+    operation (and of the constructor), made under tracemalloc after the 
+    timed calls.  Operations that form dense n_obs by n_obs matrices 
+    (every operation of LME, and the hessian of LMM and WLMM) are skipped
+    for n_obs greater than max_dense_obs.  Errors are recorded in the 
+    report rather than raised.  The first construction of each model type
+    includes the compilation of its numba kernels.
+    
+    Parameters
+    ----------
+    n_obs, n_levels, n_slopes: tuple
+        Grid of the number of observations, the number of levels of the 
+        grouping factor, and the number of random slopes
+    
+    models: tuple
+        Subset of 'LME', 'LMM' and 'WLMM'
+    
+    operations: tuple
+        Subset of 'loglike', 'gradient', 'hessian' and 'fit'; construction
+        is always timed
+    
+    repeat: int, default 3
+        Number of timed calls of each operation (fit is timed once)
+    
+    fit_method: str, default 'ai'
+        Method passed to the fit of LMM and WLMM
+    
+    trace_memory: bool, default True
+        Whether to make the additional traced call of each operation; if 
+        False peak_memory is nan and every operation runs only repeat 
+        times (fit and construction once)
+    
+    output: str, default None
+        Path to which the report is written, as json records if the path 
+        ends with .json and as csv otherwise
+    
+    Returns
+    -------
+    report: DataFrame
+        One row per model, size and operation with columns model, n_obs, 
+        n_levels, n_slopes, operation, time_min, time_median, peak_memory
+        (bytes), n_params and status
+    '''
+    records = []
+    for n, q, k in [(n, q, k) for n in n_obs for q in n_levels 
+                    for k in n_slopes]:
+        data, formula = simulate_benchmark_data(n, q, k, seed)
+        for model in models:
+            rec = dict(model=model, n_obs=n, n_levels=q, n_slopes=k)
+            construct, fit = _benchmark_operations(model, data, formula,
+                                                   fit_method)
+            dense = (model=='LME') and (n > max_dense_obs)
+            if dense:
+                records.append(dict(rec, operation='construct', 
+                                    status='skipped'))
+                continue
+            try:
+                t_start = time.time()
+                mod = construct()
+                t = time.time() - t_start
+                peak = _trace_peak(construct) if trace_memory else np.nan
+            except Exception as e:
+                records.append(dict(rec, operation='construct', 
+                                    status='error: %r'%e))
+                continue
+            theta = np.asarray(mod.theta, dtype=float).copy()
+            records.append(dict(rec, operation='construct', time_min=t,
+                                time_median=t, peak_memory=peak, 
+                                n_params=len(theta), status='ok'))
+            for op in operations:
+                if op=='fit':
+                    func, n_rep = (lambda: fit(mod, theta)), 1
+                else:
+                    func = functools.partial(getattr(mod, op), theta)
+                    n_rep = repeat
+                if (op=='hessian') and (n > max_dense_obs):
+                    records.append(dict(rec, operation=op, status='skipped'))
+                    continue
+                try:
+                    t_min, t_med, peak = _measure(func, n_rep, trace_memory)
+                    records.append(dict(rec, operation=op, time_min=t_min,
+                                        time_median=t_med, peak_memory=peak,
+                                        n_params=len(theta), status='ok'))
+                except Exception as e:
+                    records.append(dict(rec, operation=op, 
+                                        status='error: %r'%e))
+    columns = ['model', 'n_obs', 'n_levels', 'n_slopes', 'operation', 
+               'time_min', 'time_median', 'peak_memory', 'n_params', 'status']
+    report = pd.DataFrame(records, columns=columns)
+    if output is not None:
+        if str(output).endswith('.json'):
+            with open(output, 'w') as f:
+                json.dump(json.loads(report.to_json(orient='records')), f,
+                          indent=1)
+        else:
+            report.to_csv(output, index=False)
+    return report
 
 
+if __name__=='__main__':
+    print(benchmark_models().to_json(orient='records'))
@@ -49,20 +49,42 @@ class GLM:
             self.theta_init *= 1e-6
         
         
-    def loglike(self, params, X=None, Y=None, jn=None):
+    def _compute_iterate(self, params, X, Y):
         beta, phi = self.f.unpack_params(params)
+        eta = X.dot(beta)
+        mu = self.f.inv_link(eta)
+        if self.f.spar == 'profiled':
+            phi = self.f.est_scale(Y, df=self.dfe, mu=mu)
+        T = self.f.canonical_parameter(mu)
+        V = self.f.var_func(T)
+        return dict(beta=beta, phi=phi, eta=eta, mu=mu, T=T, V=V)
+    
+    def _iterate(self, params, X=None, Y=None):
+        '''
+        Linear predictor, mean, canonical parameter, variance and scale at
+        params.  For the model's own X and Y these are held in a small cache
+        shared by loglike, gradient and hessian, so that they are computed
+        once per iterate
+        '''
+        if X is None and Y is None:
+            if not hasattr(self, '_cache'):
+                self._cache = base_utils.ParamCache(maxsize=2)
+            return self._cache.get(params, lambda params: 
+                                   self._compute_iterate(params, self.X, 
+                                                         self.Y))
         if X is None:
             X = self.X
+        if Y is None:
+            Y = self.Y
+        return self._compute_iterate(params, X, Y)
+        
+    def loglike(self, params, X=None, Y=None, jn=None):
+        it = self._iterate(params, X, Y)
         if Y is None:
             Y = self.Y
         if jn is None:
             jn = self.jn
-        eta = X.dot(beta)
-        mu = self.f.inv_link(eta)
-        if self.f.spar == 'profiled':
-            phi = self.f.est_scale(Y, df=self.dfe, mu=mu)
-            
-        T = self.f.canonical_parameter(mu)
+        T, phi = it['T'], it['phi']
         Z = self.f.cumulant(T)
         Ym = linalg_utils._check_1d(Y)*self.f.weights
         LL = ((Ym).T.dot(T) - jn.T.dot(Z)) / phi
@@ -70,19 +92,12 @@ class GLM:
         return -linalg_utils._check_0d(LL)
     
     def gradient(self, params, X=None, Y=None, jn=None):
+        it = self._iterate(params, X, Y)
         if X is None:
             X = self.X
         if Y is None:
             Y = self.Y
-        if jn is None:
-            jn = self.jn
-        beta, phi = self.f.unpack_params(params)
-        eta = X.dot(beta)
-        mu = self.f.inv_link(eta)
-        if self.f.spar == 'profiled':
-            phi = self.f.est_scale(Y, df=self.dfe, mu=mu)
-        T = self.f.canonical_parameter(mu)
-        V = self.f.var_func(T)
+        eta, mu, phi, V = it['eta'], it['mu'], it['phi'], it['V']
         Vinv =1.0/V
         W = Vinv * self.f.dinv_link(eta)*self.f.weights
         G = -(linalg_utils._check_1d(Y) - mu) / phi * W
@@ -90,20 +105,12 @@ class GLM:
         return g
     
     def hessian(self, params, X=None, Y=None, jn=None):
+        it = self._iterate(params, X, Y)
         if X is None:
             X = self.X
         if Y is None:
             Y = self.Y
-        if jn is None:
-            jn = self.jn
-        beta, phi = self.f.unpack_params(params)
-
-        eta = X.dot(beta)
-        mu = self.f.inv_link(eta)
-        if self.f.spar == 'profiled':
-            phi = self.f.est_scale(Y, df=self.dfe, mu=mu)
-        T = self.f.canonical_parameter(mu)
-        V = self.f.var_func(T)
+        eta, mu, phi, V = it['eta'], it['mu'], it['phi'], it['V']
         Vinv = 1.0/V
         W0 = self.f.dinv_link(eta)**2
         W1 = self.f.d2inv_link(eta)
@@ -155,6 +162,7 @@ class GLM:
                     optimizer_kwargs[x] = y
         X0 = np.ones((self.n_obs, 1))
         t0 = np.array([1e-9])
+        self._cache = base_utils.ParamCache(maxsize=2)
         
             
         if self.f.dist != 'gamma':
@@ -175,6 +183,7 @@ class GLM:
         self.sse = np.sum((self.Y[:, 0]-self.predict())**2)
         if self.f.dist == 'normal':
             self.f.phi = self.sse / (self.n_obs - self.X.shape[1])
+            self._cache.clear()
         self.hess = self.hessian(self.beta)
         self.grad = self.gradient(self.beta)
         self.vcov = linalg_utils.einv(self.hess)
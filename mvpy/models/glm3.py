@@ -8,6 +8,8 @@ Created on Wed Jan  1 16:33:48 2020
 
 
 
+import math # analysis:ignore
+import time # analysis:ignore
 import numpy as np # analysis:ignore
 import scipy as sp # analysis:ignore
 import scipy.stats # analysis:ignore
@@ -16,16 +18,48 @@ import scipy.stats# analysis:ignore
 import scipy.special# analysis:ignore
 import patsy  # analysis:ignore
 import pandas as pd # analysis:ignore
-from ..utils import linalg_utils, base_utils # analysis:ignore
+import scipy.sparse as sps # analysis:ignore
+import scipy.sparse.linalg # analysis:ignore
+from ..utils import linalg_utils, base_utils, sparse_utils # analysis:ignore
+try:
+    import numba # analysis:ignore
+except ImportError:
+    numba = None
 
 LN2PI = np.log(2.0 * np.pi)
 FOUR_SQRT2 = 4.0 * np.sqrt(2.0)
 
 
+def _bracketed_root(func, x0, tol):
+    '''
+    Root of a scalar function by brentq, with the bracket [x0-1, x0+1] 
+    expanded until it contains a sign change
+    '''
+    a, b = x0 - 1.0, x0 + 1.0
+    for j in range(50):
+        if np.sign(func(a))!=np.sign(func(b)):
+            break
+        a, b = a - 2.0**j, b + 2.0**j
+    return sp.optimize.brentq(func, a, b, xtol=tol)
+
+
+def _crossprod(X, w):
+    '''
+    X'diag(w)X for dense or sparse X, with weights of any sign
+    '''
+    if sps.issparse(X):
+        return linalg_utils.wcrossprod(X, w)
+    return (X.T * w).dot(X)
+
+
 
 class GLM:
     
-    def __init__(self, frm=None, data=None, fam=None, scale_estimator='M'):
+    _fused_passes = False
+    
+    def __init__(self, frm=None, data=None, fam=None, scale_estimator='M',
+                 X=None, Y=None, sparse=False, freq_weights=None, 
+                 compress=False):
         '''
         Generalized linear model class.  Currently supports
         dependent Binomial, Gaussian, Gamma, Inverse Gamma,
@@ -42,11 +76,34 @@ class GLM:
                    pandas dataframe
             fam : object
                   class of the distribution being modeled  
+            scale_estimator : str
+                              Method for handling scale
+            X : array or sparse matrix
+                design matrix, used in place of a formula.  A scipy.sparse 
+                X is kept sparse throughout the fit
+            Y : array
+                dependent variable, used with X
+            sparse : bool
+                     If True the formula is coded as a sparse (csc) design
+                     matrix, with sparse indicators for categorical factors
+            freq_weights : array
+                           Frequency weights, i.e. the number of times each 
+                           row is observed.  Unlike the weights of the 
+                           family, which scale the variance, these count
+                           observations, so that the fit, standard errors
+                           and fit statistics are those of the data with 
+                           each row repeated
+            compress : bool
+                       If True the duplicated rows of (X, Y) are collapsed
+                       into frequency weights before fitting, which gives
+                       the same estimates at the cost of the unique rows.
+                       Requires a dense design
         
         Attributes
         ----------
             n_obs : float
-                    number of observations
+                    number of observations, the sum of the frequency 
+                    weights when given
             n_feats : float
                       number of features(independent variables)
             dfe : float
@@ -73,18 +130,57 @@ class GLM:
                   the index of the rows of y (if applicable)
             y_is_pd : bool
                       Boolean True if Y is a pandas dataframe
+            freq_weights : array or float
+                           Frequency weights of the rows of X, 1.0 if not
+                           given
+            row_inverse : array
+                          When compressed, the row of X corresponding to
+                          each of the original rows
         '''
         self.f = fam
-        Y, X = patsy.dmatrices(frm, data, return_type='dataframe')
-        self.X, self.xcols, self.xix, self.x_is_pd = base_utils.check_type(X)
+        if frm is not None and sparse:
+            Y, X, xinfo = sparse_utils.sparse_dmatrices(frm, data)
+            X = X, xinfo.column_names
+        elif frm is not None:
+            Y, X = patsy.dmatrices(frm, data, return_type='dataframe')
+        elif sps.issparse(X):
+            X = X, None
+        if isinstance(X, tuple):
+            self.X, self.xcols = sps.csc_matrix(X[0], dtype=float), X[1]
+            self.xix, self.x_is_pd = None, False
+        else:
+            self.X, self.xcols, self.xix, self.x_is_pd = \
+                base_utils.check_type(X)
         self.Y, self.ycols, self.yix, self.y_is_pd = base_utils.check_type(Y)
-        self.n_obs, self.n_feats = self.X.shape
+        if freq_weights is not None:
+            freq_weights = linalg_utils._check_1d(
+                    linalg_utils._check_np(freq_weights)).astype(float)
+        if compress:
+            if sps.issparse(self.X):
+                raise ValueError("Row compression requires a dense design")
+            (self.X, self.Y), counts, self.row_inverse = \
+                base_utils.compress_rows(self.X, self.Y)
+            if freq_weights is not None:
+                counts = np.bincount(self.row_inverse, weights=freq_weights)
+            freq_weights, self.xix, self.yix = counts, None, None
+        self.freq_weights = 1.0 if freq_weights is None else freq_weights
+        self.n_feats = self.X.shape[1]
+        self.n_obs = np.sum(self.freq_weights * np.ones(self.X.shape[0]))
         self.dfe = self.n_obs - self.n_feats
-        self.jn = np.ones((self.n_obs, 1))
-        self.YtX = self.Y.T.dot(self.X)
+        self.jn = np.ones((self.X.shape[0], 1))
+        self.YtX = self.X.T.dot(self.freq_weights * self.Y).T \
+            if np.ndim(self.freq_weights)==0 else \
+            self.X.T.dot(self.freq_weights[:, None] * self.Y).T
         self.theta_init = np.zeros(self.X.shape[1])
         if isinstance(fam, Gamma):
-            self.theta_init = np.linalg.lstsq(self.X, self.f.link(self.Y))[0]
+            c = np.sqrt(self.freq_weights * np.ones(self.X.shape[0]))
+            z = linalg_utils._check_1d(self.f.link(self.Y)) * c
+            if sps.issparse(self.X):
+                Xc = sps.diags(c).dot(self.X)
+                self.theta_init = sps.linalg.lsqr(Xc, z)[0]
+            else:
+                self.theta_init = np.linalg.lstsq(self.X * c[:, None], z,
+                                                  rcond=None)[0]
             self.theta_init = linalg_utils._check_1d(self.theta_init)
         
         
@@ -102,10 +198,87 @@ class GLM:
                 phi_init = np.ones(1)
             self.theta_init = np.concatenate([self.theta_init, np.atleast_1d(phi_init)])
      
-    def _est_scale(self, y, mu):
+    def _chunks(self):
+        '''
+        Yields the (X, y, c) blocks of rows over which the IRLS passes and 
+        the scale estimate accumulate, where c are the frequency weights of
+        the rows; the in-memory design is a single block
+        '''
+        yield (self.X, linalg_utils._check_1d(linalg_utils._check_np(self.Y)),
+               self.freq_weights)
+    
+    def _chunk_sum(self, func, beta=None):
+        '''
+        Sums func(X, y, mu, c) over the blocks of rows returned by _chunks, 
+        where mu is the mean implied by the coefficients beta (None if beta
+        is not given) and c the frequency weights
+        '''
+        s = 0.0
+        for X, y, c in self._chunks():
+            mu = None if beta is None else self.f.inv_link(X.dot(beta))
+            s = s + func(X, y, mu, c)
+        return s
+    
+    def _pearson_chi2(self, y, mu, v=None, c=1.0):
+        y, mu = self.f.cshape(y, mu)
+        r = (y - mu)**2
+        if v is None:
+            v = self.f.var_func(mu=mu)
+        return np.sum(c * r / v)
+    
+    def _weight_scale(self, mu, phi):
+        '''
+        The dispersion dividing the gradient and hessian weights and the 
+        variance at mu given the scale phi.  When the scale is estimated by
+        newton-raphson for a family whose variance depends on it 
+        (scale_in_variance), it enters the variance and the dispersion is one
+        '''
+        if self.scale_handling == 'NR' and self.f.scale_in_variance:
+            return 1.0, self.f.var_func(mu=mu, scale=phi)
+        return phi, self.f.var_func(mu=mu)
+    
+    def _compute_iterate(self, params):
+        '''
+        Linear predictor, mean, variance and scale at params, along with
+        the coefficients, log scale and the dispersion of the weights
+        '''
+        if self.scale_handling == 'NR':
+            beta, tau = params[:-1], params[-1]
+        else:
+            beta, tau = params, None
+        eta = self.X.dot(beta)
+        mu = self.f.inv_link(eta)
+        v = self.f.var_func(mu=mu)
+        if self.scale_handling == 'NR':
+            phi = np.exp(tau)
+        elif self.scale_handling == 'M':
+            phi = self._pearson_chi2(self.Y, mu, v, self.freq_weights)
+            phi/= self.dfe
+        else:
+            phi = 1.0
+        disp = phi
+        if self.scale_handling == 'NR' and self.f.scale_in_variance:
+            disp, v = self._weight_scale(mu, phi)
+        it = dict(beta=beta, tau=tau, eta=eta, mu=mu, v=v, phi=phi, 
+                  disp=disp)
+        return it
+    
+    def _iterate(self, params):
+        '''
+        Quantities at params shared by loglike, gradient and hessian, held 
+        in a small cache so that X\\beta, the inverse link and, for the 'M' 
+        scale estimator, the scale are computed once per iterate
+        '''
+        params = linalg_utils._check_1d(params)
+        if not hasattr(self, '_cache'):
+            self._cache = base_utils.ParamCache(maxsize=2)
+        return self._cache.get(params, self._compute_iterate)
+        
+    def _est_scale(self, y=None, mu=None, beta=None):
         '''
         Computes the method of moments estimate of scale(dispersion)
-        s = \frac{1}{n - p} \sum (y - mu)^{2} / V_mu(mu)
+        s = \\frac{1}{n - p} \\sum c(y - mu)^{2} / V_mu(mu), where c are the
+        frequency weights
         
         Parameters
         ----------
@@ -113,16 +286,20 @@ class GLM:
             dependent variable
         mu : array
              mean estimate given the independent variables
+        beta : array
+               coefficients, used in place of y and mu to accumulate the sum
+               over the blocks of rows returned by _chunks
         
         Returns
         -------
         s : scalar
             estimate of the scale/dispersion
         '''
-        y, mu = self.f.cshape(y, mu)
-        r = (y - mu)**2
-        v = self.f.var_func(mu=mu)
-        s = np.sum(r / v)
+        if mu is None:
+            s = self._chunk_sum(lambda X, y, mu, c: 
+                                self._pearson_chi2(y, mu, c=c), beta)
+        else:
+            s = self._pearson_chi2(y, mu, c=self.freq_weights)
         s/= self.dfe
         return s
     
@@ -167,20 +344,9 @@ class GLM:
         ll : scalar
              log likelihood
         '''
-        params = linalg_utils._check_1d(params)
-        if self.scale_handling == 'NR':
-            beta, tau = params[:-1], params[-1]
-            eta = self.X.dot(beta)
-            mu = self.f.inv_link(eta)
-            phi = np.exp(tau)
-        else:
-            eta = self.X.dot(params)
-            mu = self.f.inv_link(eta)
-            if self.scale_handling == 'M':
-                phi = self._est_scale(self.Y, mu)
-            else:
-                phi = 1.0
-        ll = self.f.loglike(self.Y, mu=mu, scale=phi)
+        it = self._iterate(params)
+        ll = np.sum(self.freq_weights * self.f._loglike(self.Y, mu=it['mu'], 
+                                                         scale=it['phi']))
         return ll
 
     def gradient(self, params):
@@ -200,23 +366,13 @@ class GLM:
             vector of first partial derivatives of the loglikelihood with
             respect to each parameter
         '''
-        params = linalg_utils._check_1d(params)
-        if self.scale_handling == 'NR':
-            beta, tau = params[:-1], params[-1]
-            eta = self.X.dot(beta)
-            mu = self.f.inv_link(eta)
-            phi = np.exp(tau)
-            dt = np.atleast_1d(np.sum(self.f.dtau(tau, self.Y, mu)))
-        else:
-            eta = self.X.dot(params)
-            mu = self.f.inv_link(eta)
-            if self.scale_handling == 'M':
-                phi = self._est_scale(self.Y, mu)
-            else:
-                phi = 1.0
-        w = self.f.gw(self.Y, mu=mu, phi=phi)
-        g = np.dot(self.X.T, w)
+        it = self._iterate(params)
+        mu, disp = it['mu'], it['disp']
+        c = self.freq_weights
+        w = self.f.gw(self.Y, mu=mu, phi=disp, eta=it['eta'], v=it['v'])
+        g = self.X.T.dot(c * w)
         if self.scale_handling == 'NR':
+            dt = np.atleast_1d(np.sum(c * self.f.dtau(it['tau'], self.Y, mu)))
             g = np.concatenate([g, dt])
         return g
     
@@ -236,24 +392,23 @@ class GLM:
         H : array
              Matrix of second order partial derivatives
         '''
+        it = self._iterate(params)
+        mu, disp, c = it['mu'], it['disp'], self.freq_weights
+        orthogonal = self.scale_handling == 'NR' and self.f.scale_in_variance
         if self.scale_handling == 'NR':
-            beta, tau = params[:-1], params[-1]
-            eta = self.X.dot(beta)
-            mu = self.f.inv_link(eta)
-            phi = np.exp(tau)
-            d2t = np.atleast_2d(self.f.d2tau(tau, self.Y, mu))
+            d2t = np.atleast_2d(np.sum(c * self.f.d2tau(it['tau'], self.Y, mu)))
             dbdt = -np.atleast_2d(self.gradient(params)[:-1])
+        if orthogonal:
+            # expected information, under which the coefficients and the 
+            # scale are orthogonal
+            w = self.f.ew(self.Y, mu=mu, eta=it['eta'], v=it['v'])
+            dbdt = dbdt * 0.0
         else:
-            eta = self.X.dot(params)
-            mu = self.f.inv_link(eta)
-            if self.scale_handling == 'M':
-                phi = self._est_scale(self.Y, mu)
-            else:
-                phi = 1.0
-        w = self.f.hw(self.Y, mu=mu, phi=phi)
-        H = (self.X.T * w).dot(self.X)
+            w = self.f.hw(self.Y, mu=mu, phi=disp, eta=it['eta'], v=it['v'])
+        H = _crossprod(self.X, c * w)
         if self.scale_handling == 'NR':
-            H = np.block([[H, dbdt.T], [dbdt, d2t]])
+            H = sps.bmat([[H, dbdt.T], [dbdt, d2t]]) if sps.issparse(H) \
+                else np.block([[H, dbdt.T], [dbdt, d2t]])
         return H 
     
     
@@ -290,7 +445,10 @@ class GLM:
             fit_hist['ll'].append(self.loglike(theta))
             if gnorm/len(g)<1e-9:
                  break
-            dx = np.atleast_1d(np.linalg.solve(H, g))
+            if sps.issparse(H):
+                dx = np.atleast_1d(sps.linalg.spsolve(sps.csc_matrix(H), g))
+            else:
+                dx = np.atleast_1d(np.linalg.solve(H, g))
             if self.loglike(theta - dx)>ll_k:
                 for j in range(100):
                     sh*=2
@@ -300,24 +458,232 @@ class GLM:
             sh = 1.0
         return theta, fit_hist
             
-    def fit(self, method=None):
+    def _irls_pass(self, beta=None, ybar=None, deviance=True, cross=True,
+                   scale=1.0):
+        '''
+        One pass over the blocks of rows returned by _chunks, accumulating 
+        the deviance at beta along with X'WX and X'r, where W are the 
+        expected weights ew and r=-g the negative gradient weights gw, each
+        scaled by the frequency weights, so that (X'WX)^{-1}X'r is the 
+        scoring step from beta.  When beta is None the mean is taken to be 
+        (y+ybar)/2 and r the working response W\\eta-g, so that the 
+        solution is the first estimate of beta itself.  Given beta, the 
+        mean, weights and deviance of each block come from the family's 
+        irls_weights, i.e. from its compiled kernel if any, at the given 
+        scale.  The deviance and the cross products can each be skipped by
+        setting deviance or cross to False.
+        '''
+        f = self.f
+        dev, A, b = 0.0, 0.0, 0.0
+        for X, y, c in self._chunks():
+            if beta is None:
+                mu = (y + ybar) / 2.0
+                eta = f.link(mu)
+                if deviance:
+                    dev += np.sum(c * f.deviance(y=y, mu=mu, scale=scale))
+                if not cross:
+                    continue
+                v = f.var_func(mu=mu, scale=scale)
+                w = c * f.ew(y, mu, eta=eta, v=v)
+                r = -c * f.gw(y, mu, eta=eta, v=v) + w * eta
+            else:
+                eta = X.dot(beta)
+                mu, w, g, d = f.irls_weights(y, eta, c, scale)
+                dev += d
+                if not cross:
+                    continue
+                r = -g
+            A = A + linalg_utils.wcrossprod(X, w)
+            b = b + X.T.dot(r)
+        if not cross:
+            A, b = None, None
+        return dev, A, b
+    
+    def _sparse_cholesky(self, A):
+        '''
+        Sparse cholesky factor of A.  The fill reducing ordering and 
+        symbolic factorization are reused across calls for as long as the 
+        sparsity pattern of A is contained in that of the first matrix 
+        '''
+        A = sps.csc_matrix(A)
+        A.sort_indices()
+        chol = getattr(self, '_chol', None)
+        if chol is not None and chol.n==A.shape[0]:
+            try:
+                data = sparse_utils.pattern_data(A, chol.pattern)
+            except ValueError:
+                chol = None
+        else:
+            chol = None
+        if chol is None:
+            chol = self._chol = sparse_utils.SparseCholesky(A)
+            data = sparse_utils.pattern_data(A, chol.pattern)
+        return chol.factor(data)
+    
+    def _sparse_inverse(self, A):
+        '''
+        Dense inverse of the sparse matrix A from its sparse cholesky 
+        factor, falling back to the pseudoinverse when A is not positive 
+        definite
+        '''
+        try:
+            Ainv = self._sparse_cholesky(A).solve(np.eye(A.shape[0]))
+        except np.linalg.LinAlgError:
+            Ainv = np.linalg.pinv(A.toarray())
+        return Ainv
+    
+    def _solve_normal(self, A, b):
+        '''
+        Solves (X'WX)x=b using the cholesky factor of X'WX, falling back
+        to least squares when X'WX is numerically singular.  When X'WX is 
+        sparse the sparse cholesky factor is used instead.
+        '''
+        if sps.issparse(A):
+            try:
+                dx = self._sparse_cholesky(A).solve(b)
+            except np.linalg.LinAlgError:
+                dx = sps.linalg.lsqr(A, b)[0]
+            return dx
+        try:
+            L = sp.linalg.cho_factor(A, lower=True, check_finite=False)
+            dx = sp.linalg.cho_solve(L, b, check_finite=False)
+        except np.linalg.LinAlgError:
+            dx = np.linalg.lstsq(A, b, rcond=None)[0]
+        return dx
+    
+    def _fit_irls(self, tol=1e-8, maxiter=100, n_halvings=30):
+        '''
+        Iteratively reweighted least squares (Fisher scoring).  Each step 
+        solves (X'WX)\\Delta=-X'g, where g are the gradient weights gw and W
+        the expected hessian weights ew, by a cholesky factorization of 
+        X'WX.  The step is halved while the deviance increases or is not
+        finite, and iterations stop when the relative change in the deviance
+        falls below tol.  The iterations start from the working response of
+        \\mu_{0}=(y+\\bar{y})/2, so that no starting value of the 
+        coefficients is needed.  
+        
+        When the scale is estimated by newton-raphson, log(\\phi) is found 
+        as the root of its score given the coefficients.  For exponential 
+        dispersion families the coefficients do not depend on \\phi, so this
+        is done once after they converge.  For families whose variance 
+        depends on the scale (scale_in_variance, e.g. the negative binomial)
+        the IRLS iterations at the current scale and the update of the 
+        scale are alternated until the change in the coefficients and in 
+        log(\\phi) is below sqrt(tol), starting from \\phi=1.
+        
+        All quantities are accumulated over the blocks of rows returned by
+        _chunks.  When _fused_passes is set, the deviance of a trial step and
+        the cross products for the next one are computed in the same pass,
+        so that each step reads the data once; otherwise the cross products
+        are only formed once a step is accepted and has not converged.
+        '''
+        f = self.f
+        alternate = (self.scale_handling == 'NR') and f.scale_in_variance
+        phi = 1.0
+        ybar = self._chunk_sum(lambda X, y, mu, c: np.sum(c * y)) / self.n_obs
+        _, A, b = self._irls_pass(None, ybar, deviance=False)
+        beta = self._solve_normal(A, b)
+        # the first estimate is halved toward the fit of a constant mean 
+        # if it is not valid
+        beta0 = None
+        for j in range(n_halvings):
+            dev, A, b = self._irls_pass(beta, cross=self._fused_passes)
+            if np.isfinite(dev):
+                break
+            if beta0 is None:
+                A0 = self._chunk_sum(lambda X, y, mu, c: 
+                                     _crossprod(X, c*np.ones(X.shape[0])))
+                b0 = self._chunk_sum(lambda X, y, mu, c: 
+                                     X.T.dot(c*np.ones(X.shape[0])))
+                beta0 = self._solve_normal(A0, f.link(ybar) * b0)
+            beta = (beta + beta0) / 2.0
+        fit_hist = {'deviance':[dev], 'step_size':[1.0], 'theta':[beta]}
+        if alternate:
+            fit_hist['scale'] = [phi]
+        dtau = lambda t: self._chunk_sum(lambda X, y, mu, c: 
+                                         np.sum(c * f.dtau(t, y, mu)), beta)
+        tau = None
+        converged, nit = False, 0
+        for k in range(maxiter if alternate else 1):
+            beta_k, irls_converged = beta, False
+            for i in range(maxiter):
+                if A is None:
+                    _, A, b = self._irls_pass(beta, deviance=False, 
+                                              scale=phi)
+                dx = self._solve_normal(A, b)
+                alpha = 1.0
+                for j in range(n_halvings):
+                    beta_new = beta + alpha * dx
+                    dev_new, A_new, b_new = self._irls_pass(
+                            beta_new, cross=self._fused_passes, scale=phi)
+                    if np.isfinite(dev_new) and \
+                        (dev_new <= dev + 1e-12*abs(dev)):
+                        break
+                    alpha /= 2.0
+                else:
+                    break
+                nit += 1
+                ddev = np.abs(dev_new - dev) / (np.abs(dev_new) + 0.1)
+                beta, dev, A, b = beta_new, dev_new, A_new, b_new
+                fit_hist['deviance'].append(dev)
+                fit_hist['step_size'].append(alpha)
+                fit_hist['theta'].append(beta)
+                if alternate:
+                    fit_hist['scale'].append(phi)
+                if ddev < tol:
+                    irls_converged = True
+                    break
+            if self.scale_handling != 'NR':
+                converged = irls_converged
+                break
+            tau0 = np.log(self._est_scale(beta=beta)) if tau is None else tau
+            tau_k, tau = np.log(phi), _bracketed_root(dtau, tau0, tol)
+            if not alternate:
+                converged = irls_converged
+                break
+            dmax = max(np.max(np.abs(beta - beta_k)), np.abs(tau - tau_k))
+            phi = np.exp(tau)
+            if irls_converged and dmax < np.sqrt(tol):
+                converged = True
+                break
+            # the deviance and weights at the new scale
+            dev, A, b = self._irls_pass(beta, cross=self._fused_passes, 
+                                        scale=phi)
+        theta = beta
+        if self.scale_handling == 'NR':
+            theta = np.concatenate([beta, np.atleast_1d(tau)])
+        res = sp.optimize.OptimizeResult(x=theta, fun=dev, nit=nit, 
+                                         success=converged, 
+                                         fit_hist=fit_hist)
+        return theta, res
+        
+    def fit(self, method='irls', tol=1e-8, maxiter=100):
         '''
         Fit GLM.
         Parameters
         ----------
         method : str
-                 'mn' for manual irwls, or 'sp' for scipy's minimize
+                 'irls' for iteratively reweighted least squares (the 
+                 default), 'mn' for manual newton-raphson, or 'sp' for 
+                 scipy's minimize
+        
+        tol : float
+              Tolerance for the relative change in the deviance used by
+              irls
+        
+        maxiter : int
+                  Maximum number of irls iterations
 
         '''
         self.theta0 = self.theta_init.copy()
+        self._cache = base_utils.ParamCache(maxsize=2)
         if method is None:
-            if isinstance(self.f, Gamma):
-                method = 'mn'
-            else:
-                method = 'sp'
+            method = 'irls'
         if method == 'sp':
             res = self._fit_optim()
             params = res.x
+        elif method == 'irls':
+            params, res = self._fit_irls(tol=tol, maxiter=maxiter)
         else:
             params, res = self._fit_manual()
         self.optimizer = res
@@ -345,22 +711,36 @@ class GLM:
         self.beta = beta
         self.phi = phi
         
-        llf = self.f.full_loglike(y, mu=mu, scale=phi)
-        lln = self.f.full_loglike(y, mu=np.ones(mu.shape[0])*y.mean(), 
-                                  scale=phi)
+        c = self.freq_weights
+        ybar = np.sum(c * y) / self.n_obs
+        llf = np.sum(c * self.f._full_loglike(y, mu=mu, scale=phi))
+        lln = np.sum(c * self.f._full_loglike(y, mu=np.ones(mu.shape[0])*ybar,
+                                              scale=phi))
+        chi2 = self._est_scale(self.Y, self.predict(self.params))*self.dfe
+        dev = np.sum(c * self.f.deviance(y=self.Y, mu=mu, scale=phi))
+        disp, v = self._weight_scale(self.mu, self.phi)
+        W = _crossprod(self.X, c * self.f.gw(self.y, self.mu, phi=disp, v=v))
+        self._fit_summary(llf, lln, chi2, dev, W)
+    
+    def _fit_summary(self, llf, lln, pearson_chi2, deviance, W):
+        '''
+        Sets the fit statistics, covariance of the parameters and the table
+        of results given the log likelihoods of the fitted and null models,
+        the pearson chi-squared, the deviance and the middle term W of the 
+        robust covariance
+        '''
         self.LLA = llf*2.0
         self.LL0 = lln*2.0
-        k = len(params)
-        N = self.X.shape[0]
+        k = len(self.params)
+        N = self.n_obs
         sumstats = {}
         sumstats['aic'] = 2*llf + k
         sumstats['aicc'] = 2*llf + (2 * k * N) / (N - k - 1)
         sumstats['bic'] = 2*llf + np.log(N)*k
         sumstats['caic'] = 2*llf + k*(np.log(N) + 1.0)
         sumstats['LLR'] = 2*(lln - llf)
-        sumstats['pearson_chi2'] = self._est_scale(self.Y, 
-                                    self.predict(self.params))*self.dfe
-        sumstats['deviance'] = self.f.deviance(y=self.Y, mu=mu, scale=phi).sum()
+        sumstats['pearson_chi2'] = pearson_chi2
+        sumstats['deviance'] = deviance
         if isinstance(self.f, Binomial):
             sumstats['PseudoR2_CS'] = 1-np.exp(1.0/N * (self.LLA - self.LL0))
             rmax = 1-np.exp(1.0/N *(-self.LL0))
@@ -372,10 +752,13 @@ class GLM:
             
         self.sumstats = pd.DataFrame(sumstats, index=['Fit Statistic']).T
 
-        self.vcov = np.linalg.pinv(self.hessian(self.params))
-        V = self.vcov
-        W = (self.X.T * self.f.gw(self.y, self.mu, phi=self.phi)).dot(self.X)
-        self.vcov_robust = V.dot(W).dot(V)
+        H = self.hessian(self.params)
+        if sps.issparse(H):
+            self.vcov = self._sparse_inverse(H)
+        else:
+            self.vcov = np.linalg.pinv(H)
+        V = self.vcov[:self.n_feats, :self.n_feats]
+        self.vcov_robust = V.dot(W.dot(V))
         
         self.se_theta = np.diag(self.vcov)**0.5
         self.res = np.vstack([self.params, self.se_theta]).T
@@ -388,6 +771,424 @@ class GLM:
         
         
     
+class ChunkedGLM(GLM):
+    
+    _fused_passes = True
+    
+    def __init__(self, data, fam=None, scale_estimator='M', chunksize=100000):
+        '''
+        Generalized linear model fit out-of-core by IRLS, where each pass
+        over the data accumulates X'WX, X'r and the deviance block by block,
+        so that only one block of rows is held in memory at a time
+        
+        Parameters
+        -----------
+            data : tuple, array, callable or iterable
+                   Source of the (X, y) blocks of rows.  Either a tuple 
+                   (X, y) of arrays or numpy memmaps, a 2d array or memmap
+                   whose first column is y and remaining columns are X, a 
+                   callable returning a new iterable of (X, y) blocks each 
+                   time it is called, or a reiterable such as a list of 
+                   blocks.  As every IRLS step is a pass over the data, a 
+                   single use iterator (e.g. a generator) must be wrapped in
+                   a callable that recreates it.  Blocks may also be
+                   (X, y, c) triples, where c are the frequency weights of
+                   the rows, e.g. for data compressed by
+                   base_utils.compress_rows
+            fam : object
+                  class of the distribution being modeled; weights must be
+                  scalar
+            scale_estimator : str
+                              Method for handling scale
+            chunksize : int
+                        Number of rows per block when data is an array or a 
+                        tuple of arrays
+        '''
+        if np.ndim(fam.weights)!=0:
+            raise ValueError("Observation weights are not supported when "
+                             "fitting by chunks")
+        self.f = fam
+        self.chunksize = chunksize
+        if callable(data):
+            self._reader = data
+        elif isinstance(data, tuple):
+            X, y = data
+            self._reader = lambda: self._row_blocks(X, y)
+        elif isinstance(data, np.ndarray):
+            self._reader = lambda: self._row_blocks(data[:, 1:], data[:, 0])
+        elif iter(data) is data:
+            raise ValueError("data is a single use iterator; pass a callable"
+                             " that returns a new iterator of (X, y) blocks")
+        else:
+            self._reader = lambda: data
+        n_obs, ysum, n_feats = 0.0, 0.0, None
+        for Xi, yi, ci in self._chunks():
+            if n_feats is None:
+                n_feats = Xi.shape[1]
+            elif Xi.shape[1]!=n_feats:
+                raise ValueError("Blocks have differing numbers of columns")
+            n_obs += np.sum(ci * np.ones(Xi.shape[0]))
+            ysum += np.sum(ci * yi)
+        self.n_obs, self.n_feats = n_obs, n_feats
+        self.ybar = ysum / n_obs
+        self.dfe = self.n_obs - self.n_feats
+        self.theta_init = np.zeros(self.n_feats)
+        if isinstance(fam, (Binomial, Poisson)):
+            self.scale_handling = 'fixed'
+        else:
+            self.scale_handling = scale_estimator 
+        if self.scale_handling == 'NR':
+            self.theta_init = np.concatenate([self.theta_init, np.ones(1)])
+    
+    def _row_blocks(self, X, y):
+        n, c = X.shape[0], self.chunksize
+        for i in range(0, n, c):
+            yield X[i:i+c], y[i:i+c]
+    
+    def _chunks(self):
+        for block in self._reader():
+            X, y = block[0], block[1]
+            c = 1.0 if len(block)==2 else linalg_utils._check_1d(
+                    np.asarray(block[2], dtype=float))
+            if sps.issparse(X):
+                X = sps.csr_matrix(X, dtype=float)
+            else:
+                X = np.asarray(linalg_utils._check_np(X), dtype=float)
+            y = np.asarray(linalg_utils._check_np(y), dtype=float)
+            yield X, linalg_utils._check_1d(y), c
+    
+    def _unpack(self, params):
+        params = linalg_utils._check_1d(params)
+        if self.scale_handling == 'NR':
+            beta, tau = params[:-1], params[-1]
+            phi = np.exp(tau)
+        else:
+            beta, tau = params, None
+            if self.scale_handling == 'M':
+                phi = self._est_scale(beta=beta)
+            else:
+                phi = 1.0
+        return beta, tau, phi
+    
+    def predict(self, params, X=None):
+        '''
+        Predicted mean given parameters, for X if given and otherwise for 
+        each block of rows in turn
+        '''
+        beta = params[:-1] if self.scale_handling == 'NR' else params
+        if X is not None:
+            return self.f.inv_link(linalg_utils._check_np(X).dot(beta))
+        mu = np.concatenate([self.f.inv_link(X.dot(beta)) 
+                             for X, _, _ in self._chunks()])
+        return mu
+    
+    def loglike(self, params):
+        beta, tau, phi = self._unpack(params)
+        f = self.f
+        ll = self._chunk_sum(lambda X, y, mu, c: 
+                             np.sum(c * f._loglike(y, mu=mu, scale=phi)), beta)
+        return ll
+    
+    def gradient(self, params):
+        beta, tau, phi = self._unpack(params)
+        f = self.f
+        def grad(X, y, mu, c):
+            disp, v = self._weight_scale(mu, phi)
+            return X.T.dot(c * f.gw(y, mu, phi=disp, v=v))
+        g = self._chunk_sum(grad, beta)
+        if self.scale_handling == 'NR':
+            dt = self._chunk_sum(lambda X, y, mu, c: 
+                                 np.sum(c * f.dtau(tau, y, mu)), beta)
+            g = np.concatenate([g, np.atleast_1d(dt)])
+        return g
+    
+    def hessian(self, params):
+        beta, tau, phi = self._unpack(params)
+        f = self.f
+        orthogonal = self.scale_handling == 'NR' and f.scale_in_variance
+        if orthogonal:
+            # expected information, as in GLM.hessian
+            H = self._chunk_sum(lambda X, y, mu, c: 
+                                _crossprod(X, c * f.ew(y, mu, v=f.var_func(
+                                        mu=mu, scale=phi))), beta)
+        else:
+            H = self._chunk_sum(lambda X, y, mu, c: 
+                                _crossprod(X, c * f.hw(y, mu=mu, phi=phi)), 
+                                beta)
+        if self.scale_handling == 'NR':
+            d2t = self._chunk_sum(lambda X, y, mu, c: 
+                                  np.sum(c * f.d2tau(tau, y, mu)), beta)
+            d2t = np.atleast_2d(d2t)
+            dbdt = -np.atleast_2d(self.gradient(params)[:-1])
+            if orthogonal:
+                dbdt = dbdt * 0.0
+            H = sps.bmat([[H, dbdt.T], [dbdt, d2t]]) if sps.issparse(H) \
+                else np.block([[H, dbdt.T], [dbdt, d2t]])
+        return H
+    
+    def fit(self, tol=1e-8, maxiter=100):
+        '''
+        Fit GLM by IRLS, accumulating over the blocks of rows.  Residuals
+        and fitted values are not stored; use predict to compute them.
+        
+        Parameters
+        ----------
+        tol : float
+              Tolerance for the relative change in the deviance
+        
+        maxiter : int
+                  Maximum number of irls iterations
+        '''
+        self.theta0 = self.theta_init.copy()
+        params, res = self._fit_irls(tol=tol, maxiter=maxiter)
+        self.optimizer = res
+        self.params = params
+        beta, tau, phi = self._unpack(params)
+        self.beta = beta
+        self.phi = phi
+        f, ybar = self.f, self.ybar
+        def stats(X, y, mu, c):
+            s = np.zeros(4)
+            s[0] = np.sum(c * f._full_loglike(y, mu=mu, scale=phi))
+            s[1] = np.sum(c * f._full_loglike(y, mu=np.ones(mu.shape[0])*ybar, 
+                                              scale=phi))
+            s[2] = self._pearson_chi2(y, mu, c=c)
+            s[3] = np.sum(c * f.deviance(y=y, mu=mu, scale=phi))
+            return s
+        llf, lln, chi2, dev = self._chunk_sum(stats, beta)
+        def robust(X, y, mu, c):
+            disp, v = self._weight_scale(mu, phi)
+            return _crossprod(X, c * f.gw(y, mu, phi=disp, v=v))
+        W = self._chunk_sum(robust, beta)
+        self._fit_summary(llf, lln, chi2, dev, W)
+        
+        
+        
+
+    
+class BatchGLM:
+    
+    def __init__(self, frm=None, data=None, fam=None, scale_estimator='M',
+                 X=None, Y=None):
+        '''
+        Generalized linear models sharing one design matrix, fit to every 
+        column of a matrix of responses at once by IRLS vectorized across
+        the columns
+        
+        Parameters
+        -----------
+            frm : str
+                  formula.  If Y is given, only the right hand side is used,
+                  and the rows of Y must match those of data
+            data : array
+                   pandas dataframe
+            fam : object
+                  class of the distribution being modeled; weights must be
+                  scalar
+            scale_estimator : str
+                              Method for handling scale
+            X : array
+                design matrix, used in place of a formula
+            Y : array
+                n_obs by n_resp matrix of dependent variables
+        '''
+        if np.ndim(fam.weights)!=0:
+            raise ValueError("Observation weights are not supported when "
+                             "fitting in batches")
+        self.f = fam
+        if frm is not None and Y is None:
+            Y, X = patsy.dmatrices(frm, data, return_type='dataframe')
+        elif frm is not None:
+            X = patsy.dmatrix(frm.split('~')[-1], data, 
+                              return_type='dataframe')
+        self.X, self.xcols, self.xix, self.x_is_pd = base_utils.check_type(X)
+        self.Y, self.ycols, self.yix, self.y_is_pd = base_utils.check_type(Y)
+        self.Y = np.asarray(self.Y, dtype=float)
+        if self.xcols is None:
+            self.xcols = np.array(['x%i'%i for i in range(self.X.shape[1])])
+        if self.ycols is None:
+            self.ycols = np.array(['y%i'%i for i in range(self.Y.shape[1])])
+        self.n_obs, self.n_feats = self.X.shape
+        self.n_resp = self.Y.shape[1]
+        self.dfe = self.n_obs - self.n_feats
+        if isinstance(fam, (Binomial, Poisson)):
+            self.scale_handling = 'fixed'
+        else:
+            self.scale_handling = scale_estimator  
+        iu, ju = np.triu_indices(self.n_feats)
+        self._triu = iu, ju
+    
+    def _map(self, func, Y, mu, **kws):
+        '''
+        Applies a family function of (y, mu) elementwise to n by k arrays,
+        any further array arguments being of the same shape
+        '''
+        kws = {key:val.reshape(-1) for key, val in kws.items()}
+        return func(Y.reshape(-1), mu=mu.reshape(-1), **kws).reshape(mu.shape)
+    
+    def _crossprods(self, W, chunksize=2048):
+        '''
+        Stack of the k weighted cross products X'diag(W[:, j])X for the n 
+        by k matrix of weights W.  Over blocks of rows, the products of the 
+        pairs of columns of X in the upper triangle are formed and multiplied
+        by W in a single matrix product, so that the k cross products are 
+        obtained by one (BLAS) product rather than k of them
+        '''
+        X, (iu, ju) = self.X, self._triu
+        n, p = X.shape
+        T = np.zeros((len(iu), W.shape[1]))
+        for i in range(0, n, chunksize):
+            Xi = X[i:i+chunksize]
+            T += (Xi[:, iu] * Xi[:, ju]).T.dot(W[i:i+chunksize])
+        A = np.zeros((W.shape[1], p, p))
+        A[:, iu, ju] = T.T
+        A[:, ju, iu] = T.T
+        return A
+    
+    def _solve(self, A, B):
+        '''
+        Solves the k systems A[j]x=B[:, j] as one batched solve, falling back
+        to least squares for the columns whose system is singular
+        '''
+        try:
+            D = np.linalg.solve(A, B.T[:, :, None])[:, :, 0].T
+        except np.linalg.LinAlgError:
+            D = np.zeros_like(B)
+            for j in range(B.shape[1]):
+                D[:, j] = np.linalg.lstsq(A[j], B[:, j], rcond=None)[0]
+        return D
+    
+    def _deviance(self, Y, mu):
+        return np.sum(self._map(self.f.deviance, Y, mu), axis=0)
+    
+    def fit(self, tol=1e-8, maxiter=100, n_halvings=30):
+        '''
+        Fit the GLM to every column of Y by IRLS.  Each iteration forms the
+        stacked weights of the active columns, their cross products and 
+        solves the systems in one batch; the step is halved column by column
+        while the deviance increases, and columns whose relative change in 
+        deviance falls below tol are masked out of later iterations.
+        
+        Parameters
+        ----------
+        tol : float
+              Tolerance for the relative change in the deviance
+        
+        maxiter : int
+                  Maximum number of irls iterations
+        
+        n_halvings : int
+                     Maximum number of step halvings
+        '''
+        f, X, Y = self.f, self.X, self.Y
+        q = self.n_resp
+        ybar = np.mean(Y, axis=0)
+        mu = (Y + ybar) / 2.0
+        eta = f.link(mu)
+        W = self._map(f.ew, Y, mu, eta=eta)
+        R = W * eta - self._map(f.gw, Y, mu, eta=eta)
+        B = self._solve(self._crossprods(W), X.T.dot(R))
+        # first estimates not giving a valid mean are halved toward the fit 
+        # of a constant mean
+        eta = X.dot(B)
+        mu = f.inv_link(eta)
+        dev = self._deviance(Y, mu)
+        bad = ~np.isfinite(dev)
+        if np.any(bad):
+            B0 = np.linalg.lstsq(X, np.ones(self.n_obs), rcond=None)[0]
+            B0 = B0[:, None] * f.link(ybar)[None]
+            for j in range(n_halvings):
+                B[:, bad] = (B[:, bad] + B0[:, bad]) / 2.0
+                eta[:, bad] = X.dot(B[:, bad])
+                mu[:, bad] = f.inv_link(eta[:, bad])
+                dev[bad] = self._deviance(Y[:, bad], mu[:, bad])
+                bad = ~np.isfinite(dev)
+                if not np.any(bad):
+                    break
+        active = np.ones(q, dtype=bool)
+        converged = np.zeros(q, dtype=bool)
+        n_iter = np.zeros(q, dtype=int)
+        for i in range(maxiter):
+            ix = np.flatnonzero(active)
+            if len(ix)==0:
+                break
+            Ya, mua, etaa, deva = Y[:, ix], mu[:, ix], eta[:, ix], dev[ix]
+            W = self._map(f.ew, Ya, mua, eta=etaa)
+            G = self._map(f.gw, Ya, mua, eta=etaa)
+            D = self._solve(self._crossprods(W), -X.T.dot(G))
+            alpha = np.ones(len(ix))
+            Bn = B[:, ix] + D
+            etan = X.dot(Bn)
+            mun = f.inv_link(etan)
+            devn = self._deviance(Ya, mun)
+            for j in range(n_halvings):
+                bad = ~(np.isfinite(devn) & (devn <= deva + 1e-12*np.abs(deva)))
+                if not np.any(bad):
+                    break
+                alpha[bad] /= 2.0
+                Bn[:, bad] = B[:, ix[bad]] + alpha[bad] * D[:, bad]
+                etan[:, bad] = X.dot(Bn[:, bad])
+                mun[:, bad] = f.inv_link(etan[:, bad])
+                devn[bad] = self._deviance(Ya[:, bad], mun[:, bad])
+            bad = ~(np.isfinite(devn) & (devn <= deva + 1e-12*np.abs(deva)))
+            ok = ~bad
+            ddev = np.abs(devn - deva) / (np.abs(devn) + 0.1)
+            upd = ix[ok]
+            B[:, upd], eta[:, upd], mu[:, upd] = Bn[:, ok], etan[:, ok], mun[:, ok]
+            dev[upd] = devn[ok]
+            n_iter[upd] += 1
+            conv = ok & (ddev < tol)
+            converged[ix[conv]] = True
+            active[ix[conv | bad]] = False
+        
+        V = self._map(lambda y, mu: f.var_func(mu=mu), Y, mu)
+        chi2 = np.sum((Y - mu)**2 / V, axis=0)
+        if self.scale_handling == 'NR':
+            phi = np.zeros(q)
+            for j in range(q):
+                dtau = lambda t: np.sum(f.dtau(t, Y[:, j], mu[:, j]))
+                phi[j] = np.exp(_bracketed_root(dtau, 
+                                                np.log(chi2[j]/self.dfe), tol))
+        elif self.scale_handling == 'M':
+            phi = chi2 / self.dfe
+        else:
+            phi = np.ones(q)
+        
+        Hw = self._map(f.hw, Y, mu, eta=eta, v=V)
+        H = self._crossprods(Hw) / phi[:, None, None]
+        vcov = np.full(H.shape, np.nan)
+        finite = np.all(np.isfinite(H), axis=(1, 2))
+        vcov[finite] = np.linalg.pinv(H[finite])
+        se = np.sqrt(np.diagonal(vcov, axis1=1, axis2=2)).T
+        
+        scale = np.tile(phi, self.n_obs)
+        llf = np.sum(f._full_loglike(Y.reshape(-1), mu=mu.reshape(-1), 
+                                     scale=scale).reshape(mu.shape), axis=0)
+        k = self.n_feats + (self.scale_handling=='NR')
+        N = self.n_obs
+        sumstats = {}
+        sumstats['deviance'] = dev
+        sumstats['pearson_chi2'] = chi2
+        sumstats['scale'] = phi
+        sumstats['aic'] = 2*llf + k
+        sumstats['bic'] = 2*llf + np.log(N)*k
+        sumstats['converged'] = converged
+        sumstats['n_iter'] = n_iter
+        
+        self.beta, self.phi, self.mu = B, phi, mu
+        self.vcov, self.se = vcov, se
+        self.converged, self.n_iter = converged, n_iter
+        self.sumstats = pd.DataFrame(sumstats, index=self.ycols)
+        ix = pd.MultiIndex.from_product([self.ycols, self.xcols])
+        self.res = pd.DataFrame(np.vstack([B.T.reshape(-1), se.T.reshape(-1)]).T, 
+                                index=ix, columns=['params', 'SE'])
+        self.res['t'] = self.res['params'] / self.res['SE']
+        self.res['p'] = sp.stats.t.sf(np.abs(self.res['t']), self.dfe)*2.0
+        
+        
+        
+
+    
 class Link(object):
     def inv_link(self, eta):
         raise NotImplementedError
@@ -582,16 +1383,15 @@ class PowerLink(Link):
         if self.alpha==0:
             dmu = np.exp(eta)
         else:
-            dmu = -(eta**(1/self.alpha) * np.log(eta)) / (self.alpha**2)
+            dmu = eta**(1/self.alpha - 1.0) / self.alpha
         return dmu
     
     def d2inv_link(self, eta):
         alpha=self.alpha
-        lnx = np.log(eta)
         if alpha==0:
             d2mu = np.exp(eta)
         else:
-            d2mu = (eta**(1/alpha) * lnx * (lnx+2*alpha)) / alpha**4
+            d2mu = (1/alpha - 1.0) * eta**(1/alpha - 2.0) / alpha
         return d2mu
     
     def link(self, mu):
@@ -673,6 +1473,10 @@ def _logbinom(n, k):
 
 class ExponentialFamily(object):
     
+    use_kernels = True
+    kernel_min_obs = 5000
+    scale_in_variance = False
+    
     def __init__(self, link=IdentityLink, weights=1.0, scale=1.0):
         
         if not isinstance(link, Link):
@@ -737,17 +1541,24 @@ class ExponentialFamily(object):
         r_s = np.sign(y - mu) * np.sqrt(d)
         return r_s
     
-    def gw(self, y, mu, phi=1.0):
+    def gw(self, y, mu, phi=1.0, eta=None, v=None):
         y, mu = self.cshape(y, mu)
-        num = self.weights * (y - mu)
-        den = self.var_func(mu=mu) * self.dlink(mu) * phi
+        if eta is None:
+            eta = self.link(mu)
+        if v is None:
+            v = self.var_func(mu=mu)
+        num = self.weights * (y - mu) * self.dinv_link(eta)
+        den = v * phi
         res = num / den
         return -res
     
-    def hw(self, y, mu, phi=1.0):
+    def hw(self, y, mu, phi=1.0, eta=None, v=None):
         y, mu = self.cshape(y, mu)
-        eta = self.link(mu)
-        Vinv = 1.0 / (self.var_func(mu=mu))
+        if eta is None:
+            eta = self.link(mu)
+        if v is None:
+            v = self.var_func(mu=mu)
+        Vinv = 1.0 / v
         W0 = self.dinv_link(eta)**2
         W1 = self.d2inv_link(eta)
         W2 = self.d2canonical(mu)
@@ -757,6 +1568,52 @@ class ExponentialFamily(object):
         Psb = Vinv*W0
         res = (Psc - Psb)*self.weights
         return -res/phi
+    
+    def ew(self, y, mu, phi=1.0, eta=None, v=None):
+        '''
+        Expected value of the hessian weights hw, i.e. the Fisher scoring 
+        (IRLS) weights w\\mu'(\\eta)^{2}/(\\phi V(\\mu)), which are positive
+        for every link.  As for gw and hw, the linear predictor eta and 
+        variance v are computed from mu if not given
+        '''
+        y, mu = self.cshape(y, mu)
+        if eta is None:
+            eta = self.link(mu)
+        if v is None:
+            v = self.var_func(mu=mu)
+        res = self.weights * self.dinv_link(eta)**2 / v
+        return res / phi
+    
+    def irls_weights(self, y, eta, c=1.0, scale=1.0):
+        '''
+        Mean, expected weights ew, gradient weights gw and the summed 
+        deviance at the linear predictor eta, each scaled by the frequency
+        weights c, as needed by an IRLS step.  The scale is passed to the 
+        variance and deviance, so it only matters for families in which it
+        enters them (scale_in_variance), i.e. the negative binomial.  When 
+        numba is available and the class of the family and of its link have
+        a compiled kernel, all four are computed in one pass over the rows;
+        otherwise, or if use_kernels is False, by the elementwise functions
+        of the family.  Blocks of fewer than kernel_min_obs rows also use 
+        the latter, as for them the one time cost of compiling a kernel 
+        outweighs its gain.
+        '''
+        y = linalg_utils._check_1d(linalg_utils._check_np(y))
+        use_kernel = self.use_kernels and y.shape[0]>=self.kernel_min_obs
+        kernel = _irls_kernel(self) if use_kernel else None
+        if kernel is not None:
+            n = y.shape[0]
+            w = np.broadcast_to(np.asarray(self.weights*c, dtype=float), (n,))
+            mu, ew, gw = np.empty(n), np.empty(n), np.empty(n)
+            dev = kernel(eta, y, w, _link_param(self._link), float(scale),
+                         mu, ew, gw)
+            return mu, ew, gw, dev
+        mu = self.inv_link(eta)
+        v = self.var_func(mu=mu, scale=scale)
+        ew = c * self.ew(y, mu, eta=eta, v=v)
+        gw = c * self.gw(y, mu, eta=eta, v=v)
+        dev = np.sum(c * self.deviance(y=y, mu=mu, scale=scale))
+        return mu, ew, gw, dev
         
         
 
@@ -825,14 +1682,14 @@ class Gaussian(ExponentialFamily):
         y, mu = self.cshape(y, mu)
         w = self.weights
         phi = np.exp(tau)
-        g = -np.sum(w * np.power((y - mu), 2) / phi - 1)
+        g = -(w * np.power((y - mu), 2) / phi - 1)
         return g
     
     def d2tau(self, tau, y, mu):
         y, mu = self.cshape(y, mu)
         w = self.weights
         phi = np.exp(tau)
-        g = np.sum(w * np.power((y - mu), 2) / (2 * phi))
+        g = w * np.power((y - mu), 2) / (2 * phi)
         return g
         
     
@@ -883,7 +1740,7 @@ class InverseGaussian(ExponentialFamily):
         return V
                 
     def d2canonical(self, mu):
-        res = 3.0 / (FOUR_SQRT2 * np.power(-mu, 2.5))
+        res = -3.0 / np.power(mu, 4.0)
         return res
     
     def deviance(self, y, T=None, mu=None, eta=None, scale=1.0):
@@ -901,14 +1758,14 @@ class InverseGaussian(ExponentialFamily):
         phi = np.exp(tau)
         num = w * np.power((y - mu), 2)
         den = (phi * y * np.power(mu, 2))
-        g = -np.sum(num / den - 1)
+        g = -(num / den - 1)
         return g    
     
     def d2tau(self, tau, y, mu):
         y, mu = self.cshape(y, mu)
         w = self.weights
         phi = np.exp(tau)
-        g = np.sum(w * np.power((y - mu), 2) / (2 * phi * y * mu**2))
+        g = w * np.power((y - mu), 2) / (2 * phi * y * mu**2)
         return g
 
 
@@ -984,7 +1841,7 @@ class Gamma(ExponentialFamily):
         T1 = (2 - y / mu)
         T2 = sp.special.digamma(w / phi)
         T3 = w / phi * sp.special.polygamma(1, w / phi)
-        g = np.sum(w / phi * (T3+T2-T1-T0))
+        g = w / phi * (T3+T2-T1-T0)
         return g
 
     
@@ -993,6 +1850,8 @@ class Gamma(ExponentialFamily):
 
 class NegativeBinomial(ExponentialFamily):
     
+    scale_in_variance = True
+    
     def __init__(self, link=LogLink, weights=1.0, scale=1.0):
         super().__init__(link, weights, scale)
     
@@ -1066,7 +1925,7 @@ class NegativeBinomial(ExponentialFamily):
         y, mu = self.cshape(y, mu)
         w = self.weights
         phi = np.exp(tau)
-        A = phi * (y - mu) / ((1 + phi) * mu)
+        A = phi * (y - mu) / (1 + phi * mu)
         T0 = sp.special.digamma(y + 1 / phi)
         T1 = np.log(1+phi*mu)
         T2 = sp.special.digamma(1 / phi)
@@ -1078,11 +1937,13 @@ class NegativeBinomial(ExponentialFamily):
         w = self.weights
         phi = np.exp(tau)
         v = 1/phi
-        T0 = v*np.log(1+phi*mu)
-        T1 = v*(sp.special.digamma(y+v) - sp.special.digamma(v))
-        T2 = v**2 * (sp.special.polygamma(2, y+v)-sp.special.polygamma(2, v))
-        A = -y*phi*mu+mu+2*phi*mu**2 / ((1+phi*mu)**2)
-        g = np.sum(w / phi * (T0 - A - T1 - T2))
+        u = 1 + phi * mu
+        T0 = sp.special.digamma(y + v) - sp.special.digamma(v)
+        T1 = np.log(u)
+        T2 = v * (sp.special.polygamma(1, y + v) - sp.special.polygamma(1, v))
+        A = phi * (y - mu) / u
+        B = phi * mu / u + phi * (y - mu) / u**2
+        g = w / phi * (T1 + A - T0 - T2 - B)
         return g
 
     
@@ -1143,11 +2004,7 @@ class Poisson(ExponentialFamily):
         
         y, mu = self.cshape(y, mu)
         w = self.weights
-        d = np.zeros(y.shape[0])
-        ixa = y==0
-        ixb = ~ixa
-        d[ixa] = mu[ixa]
-        d[ixb] = (y[ixb]*np.log(y[ixb]/mu[ixb]) - (y[ixb] - mu[ixb]))
+        d = sp.special.xlogy(y, y / mu) - (y - mu)
         d*=2.0 * w
         return d
     
@@ -1220,20 +2077,239 @@ class Binomial(ExponentialFamily):
         d[ixc] = -np.log(mu[ixc])
         d[ixb] = y[ixb]*np.log(y[ixb]/mu[ixb]) + u*np.log(u/v)
         return 2*w*d
-    
 
-    
-    
-    
-    
-    
-            
-        
-    
-    
-    
-    
-    
-    
-    
 
+
+# Compiled IRLS kernels.  The inverse link of each link class returns the 
+# mean and its derivative together, and the function of each family class 
+# the variance and unit deviance, so that the kernel composed from a pair
+# evaluates the exponentials once per row and forms no temporaries.  Links 
+# with a parameter (PowerLink, NegativeBinomialLink) receive it as lp, and
+# the family functions the scale s, which only enters the variance and 
+# deviance of the negative binomial.
+
+def _mu_identity(eta, lp):
+    return eta, 1.0
+
+def _mu_logit(eta, lp):
+    u = np.exp(eta)
+    return u / (u + 1.0), u / ((1.0 + u)**2)
+
+def _mu_probit(eta, lp):
+    mu = 0.5 * math.erfc(-eta / np.sqrt(2.0))
+    if mu==1.0:
+        mu -= 1e-16
+    return mu, np.exp(-eta**2 / 2.0) / np.sqrt(2.0 * np.pi)
+
+def _mu_log(eta, lp):
+    u = np.exp(eta)
+    return u, u
+
+def _mu_reciprocal(eta, lp):
+    return 1.0 / eta, -1.0 / (eta**2)
+
+def _mu_cloglog(eta, lp):
+    u = np.exp(eta)
+    return 1.0 - np.exp(-u), np.exp(eta - u)
+
+def _mu_power(eta, lp):
+    if lp==0:
+        u = np.exp(eta)
+        return u, u
+    return eta**(1.0 / lp), eta**(1.0 / lp - 1.0) / lp
+
+def _mu_logcomp(eta, lp):
+    u = np.exp(eta)
+    return 1.0 - u, -u
+
+def _mu_negbin(eta, lp):
+    u = np.exp(eta)
+    return u / (lp * (1.0 - u)), u / (lp * (1.0 - u)**2)
+
+def _vd_gaussian(y, mu, s):
+    return 1.0, (y - mu)**2
+
+def _vd_inverse_gaussian(y, mu, s):
+    return mu**3, (y - mu)**2 / (y * mu**2)
+
+def _vd_gamma(y, mu, s):
+    return mu**2, 2.0 * ((y - mu) / mu - np.log(y / mu))
+
+def _vd_negative_binomial(y, mu, s):
+    v = 1.0 / s
+    if y==0:
+        d = np.log(1.0 + s * mu) / s
+    else:
+        d = y * np.log(y / mu) - (y + v) * np.log((y + v) / (mu + v))
+    return mu + s * mu**2, 2.0 * d
+
+def _vd_poisson(y, mu, s):
+    if y==0:
+        d = mu
+    else:
+        d = y * np.log(y / mu) - (y - mu)
+    return mu, 2.0 * d
+
+def _vd_binomial(y, mu, s):
+    if y==0:
+        d = -np.log(1.0 - mu)
+    elif y==1:
+        d = -np.log(mu)
+    else:
+        d = y * np.log(y / mu) + (1.0 - y) * np.log((1.0 - y) / (1.0 - mu))
+    return mu * (1.0 - mu), 2.0 * d
+
+
+_LINK_KERNELS = {IdentityLink:_mu_identity, LogitLink:_mu_logit, 
+                 ProbitLink:_mu_probit, LogLink:_mu_log,
+                 ReciprocalLink:_mu_reciprocal, CloglogLink:_mu_cloglog,
+                 PowerLink:_mu_power, LogComplementLink:_mu_logcomp,
+                 NegativeBinomialLink:_mu_negbin}
+
+_FAMILY_KERNELS = {Gaussian:_vd_gaussian, 
+                   InverseGaussian:_vd_inverse_gaussian, Gamma:_vd_gamma, 
+                   NegativeBinomial:_vd_negative_binomial, 
+                   Poisson:_vd_poisson, Binomial:_vd_binomial}
+
+_IRLS_KERNELS = {}
+
+
+def _link_param(link):
+    if isinstance(link, PowerLink):
+        return float(link.alpha)
+    elif isinstance(link, NegativeBinomialLink):
+        return float(link.k)
+    return 0.0
+
+
+def _make_irls_kernel(mu_func, vd_func):
+    '''
+    Compiles the loop over the rows computing the mean, the expected and 
+    gradient weights and the deviance from the inverse link mu_func and
+    the family function vd_func.  Division by zero and logarithms of 
+    nonpositive numbers give inf and nan as in numpy, so that invalid 
+    steps are caught by the deviance.
+    '''
+    mu_func = numba.njit(error_model='numpy')(mu_func)
+    vd_func = numba.njit(error_model='numpy')(vd_func)
+    @numba.njit(error_model='numpy')
+    def kernel(eta, y, w, lp, s, mu, ew, gw):
+        dev = 0.0
+        for i in range(eta.shape[0]):
+            m, d = mu_func(eta[i], lp)
+            v, r = vd_func(y[i], m, s)
+            mu[i] = m
+            ew[i] = w[i] * d * d / v
+            gw[i] = -w[i] * (y[i] - m) * d / v
+            dev += w[i] * r
+        return dev
+    return kernel
+
+
+def _irls_kernel(fam):
+    '''
+    The compiled kernel for the classes of fam and its link, compiled on 
+    first use and held for later models, or None if numba is unavailable
+    or either class (e.g. a user defined subclass) has no kernel
+    '''
+    key = (type(fam), type(fam._link))
+    if numba is None or key[0] not in _FAMILY_KERNELS or \
+        key[1] not in _LINK_KERNELS:
+        return None
+    if key not in _IRLS_KERNELS:
+        _IRLS_KERNELS[key] = _make_irls_kernel(_LINK_KERNELS[key[1]], 
+                                               _FAMILY_KERNELS[key[0]])
+    return _IRLS_KERNELS[key]
+
+
+def _benchmark_data(fam, n_obs, n_feats, rng):
+    X = np.concatenate([np.ones((n_obs, 1)), 
+                        rng.normal(size=(n_obs, n_feats-1))], axis=1)
+    eta0 = X.dot(rng.normal(size=n_feats) * 0.1)
+    if isinstance(fam, Binomial):
+        y = rng.binomial(1, (1.0 + np.tanh(eta0)) / 2.0) * 1.0
+    elif isinstance(fam, (Poisson, NegativeBinomial)):
+        y = rng.poisson(np.exp(eta0)) * 1.0
+    elif isinstance(fam, Gaussian):
+        y = eta0 + rng.normal(size=n_obs)
+    else:
+        y = rng.gamma(2.0, np.exp(eta0) / 2.0)
+    return X, y
+
+
+def benchmark_irls_kernels(n_obs=(10000, 100000, 1000000), n_feats=10,
+                           families=None, repeat=5, seed=0):
+    '''
+    Times the computation of the IRLS weights (mean, expected and gradient
+    weights and deviance) and a whole IRLS pass, i.e. the weights and the 
+    cross products X'WX and X'r, by the compiled kernels and by the numpy
+    path of the families, at the maximum likelihood estimate of a 
+    simulated GLM.  Kernels are compiled before timing, and used whatever
+    the number of observations.
+    
+    Parameters
+    ----------
+    n_obs: tuple
+        Numbers of observations
+    
+    n_feats: int
+        Number of columns of the design, including the intercept
+    
+    families: list
+        Family instances to time; by default Binomial with logit, probit
+        and cloglog links, Poisson, Gamma with reciprocal and log links, 
+        Gaussian, InverseGaussian and NegativeBinomial
+    
+    repeat: int
+        Number of timed calls, of which the minimum is reported
+    
+    Returns
+    -------
+    report: DataFrame
+        One row per family, link and n_obs with the times in seconds of 
+        the numpy and compiled weights and passes, the speedups, and the 
+        largest relative difference between the weights of the two paths
+    '''
+    if families is None:
+        families = [Binomial(), Binomial(link=ProbitLink), 
+                    Binomial(link=CloglogLink), Poisson(), Gamma(), 
+                    Gamma(link=LogLink), Gaussian(), InverseGaussian(),
+                    NegativeBinomial()]
+    rng = np.random.default_rng(seed)
+    records = []
+    for fam in families:
+        min_obs, fam.kernel_min_obs = fam.kernel_min_obs, 0
+        for n in n_obs:
+            X, y = _benchmark_data(fam, n, n_feats, rng)
+            fam.use_kernels = True
+            mod = GLM(X=X, Y=y, fam=fam)
+            beta = mod._fit_irls()[0][:n_feats]
+            eta = X.dot(beta)
+            times, res = {}, {}
+            for use_kernels in [False, True]:
+                fam.use_kernels = use_kernels
+                res[use_kernels] = fam.irls_weights(y, eta)
+                tw = tp = np.inf
+                for i in range(repeat):
+                    t = time.time()
+                    fam.irls_weights(y, eta)
+                    tw = min(tw, time.time() - t)
+                    t = time.time()
+                    mod._irls_pass(beta)
+                    tp = min(tp, time.time() - t)
+                times[use_kernels] = tw, tp
+            fam.use_kernels = True
+            diff = max([np.max(np.abs(a - b) / (np.abs(a) + 1e-300)) 
+                        for a, b in zip(res[False], res[True])])
+            records.append(dict(family=type(fam).__name__, 
+                                link=type(fam._link).__name__, n_obs=n, 
+                                weights_numpy=times[False][0], 
+                                weights_kernel=times[True][0],
+                                weights_speedup=times[False][0]/times[True][0],
+                                pass_numpy=times[False][1], 
+                                pass_kernel=times[True][1],
+                                pass_speedup=times[False][1]/times[True][1],
+                                max_rel_diff=diff))
+        fam.kernel_min_obs = min_obs
+    report = pd.DataFrame(records)
+    return report
@@ -13,16 +13,19 @@ import numpy as np
 import scipy as sp
 import pandas as pd
 import scipy.stats
+import scipy.special
+import scipy.optimize
 import scipy.sparse as sps
 
-from ..utils import linalg_utils, data_utils
+from ..utils import linalg_utils, data_utils, sparse_utils
+from .lmm import LMM
 
-class WLMM(object):
+class WLMM(LMM):
 
     def __init__(self, fixed_effects, random_effects, yvar, data, W=None, 
                  error_structure=None, acov=None):
         '''
-        Linear Mixed Model
+        Weighted Linear Mixed Model
 
         Parameters
         ----------
@@ -44,13 +47,20 @@ class WLMM(object):
         data: DataFrame
             Pandas DataFrame containing n_obs by n_features including the
             relavent terms to the model
+        
+        W: array, default None
+            Vector of n_obs weights w, such that the error covariance is
+            diag(w)(I_{n}\\otimes V_{m\\times m})diag(w).  The weights are
+            stored as a vector (in the attribute weights) and never expanded 
+            into an n_obs by n_obs matrix; a diagonal weight matrix is also 
+            accepted, in which case its diagonal is used
 
         error_structure: str, default None
             Error structure defaults to iid, but a factor level may be provided
             via a string referencing a column name, which will then be used to
             constructthe error covariance.  Implemented for multivariate linear
             models, where it is repeated across the multiple dependent variables,
-            and has the structure Cov(Error) = V_{m\\times m}\\otimes I_{n}
+            and has the structure Cov(Error) = I_{n}\\otimes V_{m\\times m}
         acov: dict, default None
             Similar to random_effects, dictionary with keys indicating factors
             except the values need to be matrices that specify the covariance
@@ -58,384 +68,38 @@ class WLMM(object):
 
         '''
         if W is None:
-            W = np.eye(data.shape[0])
-        self.W = W
-        self.Winv = np.linalg.inv(W)
-        n_obs = data.shape[0]
-        X = patsy.dmatrix(fixed_effects, data=data, return_type='dataframe')
-        fixed_effects = X.columns
-        Z = []
-        re_struct = collections.OrderedDict()
-        
-        #Determine if model is multivariate
-        if type(yvar) is list: 
-            n_vars = len(yvar)
-            yvnames = yvar
+            weights = np.ones(data.shape[0])
+        elif sps.issparse(W):
+            weights = W.diagonal()
+        elif np.ndim(W)==2:
+            weights = np.diag(W)
         else:
-            n_vars = 1
-            yvnames = [yvar]
-         
-        res_names = [] #might be better of renamed re_names; may be typo
-        for key in random_effects.keys():
-            #dummy encode the groupings and get random effect variate
-            Ji = data_utils.dummy_encode(data[key], complete=True)
-            Zij = patsy.dmatrix(random_effects[key], data=data,
-                                return_type='dataframe')
-            #stratify re variable by dummy columns
-            Zi = linalg_utils.khatri_rao(Ji.T, Zij.T).T 
-            Z.append(Zi)
-            k = Zij.shape[1]*n_vars
-            # RE dependence structure
-            if (acov is not None):
-                if acov[key] is not None: #dependence structure for each RE
-                    acov_i = acov[key]
-                else:                     #single dependence for all REs
-                    acov_i = np.eye(Ji.shape[1])
-            else:                         #IID
-                acov_i = np.eye(Ji.shape[1])
-            re_struct[key] = {'n_units': Ji.shape[1],
-                              'n_level_effects': Zij.shape[1],
-                              'cov_re_dims': k,
-                              'n_params': ((k + 1.0) * k) / 2.0,
-                              'vcov': np.eye(k),
-                              'params': linalg_utils.vech(np.eye(k)),
-                              'acov': acov_i}
-            if len(yvnames)>1:
-                names = [x+": "+y for x in yvnames for y in
-                         Zij.columns.tolist()]
-                names = np.array(names)
-            else:  
-                names = np.array(Zij.columns.tolist())
-            names_a = names[np.triu_indices(k)[0]]
-            names_b = names[np.triu_indices(k)[1]]
-            for r in range(len(names_a)):
-                res_names.append(key+'|'+names_a[r]+' x '+names_b[r])
-        
+            weights = linalg_utils._check_1d(np.asarray(W, dtype=float))
+        self._construct(fixed_effects, random_effects, yvar, data, acov,
+                        weights=weights)
 
-        Z = np.concatenate(Z, axis=1)
-
-        error_struct = collections.OrderedDict()
-        error_struct['vcov'] = np.eye(n_vars)
-        error_struct['acov'] = np.eye(n_obs)
-        error_struct['params'] = linalg_utils.vech(np.eye(n_vars))
-        if len(yvnames)>1&(type(yvnames) is list):
-            tmp = []
-            for i, x in enumerate(yvnames):
-                for j, y in enumerate(yvnames):
-                    if i <= j:
-                        tmp.append(x+": "+y+" error_var")
-            res_names += tmp
-        else:  
-            res_names += ['error_var']
-            
-        if type(yvar) is str:
-            y = data[[yvar]]
-        
-        #Vectorize equations - Add flexibility for dependent variable specific
-        #design matrices
-        elif type(yvar) is list:
-            y = linalg_utils.vecc(data[yvar].values)
-            Z = np.kron(np.eye(n_vars), Z)
-            X = np.vstack([X for i in range(n_vars)])
-
-        var_params = np.concatenate([re_struct[key]["params"]
-                                     for key in re_struct.keys()])
-        err_params = error_struct['params']
-        partitions = [0]+[re_struct[key]['n_params']
-                          for key in re_struct.keys()]
-        partitions += [len(error_struct['params'])]
-        theta = np.concatenate([var_params, err_params])
-        partitions2 = [0]+[re_struct[key]['n_units']
-                           * re_struct[key]['cov_re_dims']
-                           for key in re_struct.keys()]
-        partitions2 = np.cumsum(partitions2)
-        var_struct = collections.OrderedDict()
-        for key in re_struct.keys():
-            var_struct[key] = [re_struct[key]['vcov'].shape,
-                               re_struct[key]['acov']]
-        var_struct['error'] = [error_struct['vcov'].shape,
-                               error_struct['acov']]
-        #Get Z and Z otimes Z for each RE
-        Zs = collections.OrderedDict()
-        ZoZ = collections.OrderedDict()
-        for i in range(len(re_struct)):
-            key = list(re_struct)[i]
-            Zs[key] = sps.csc_matrix(Z[:, partitions2[i]:partitions2[i+1]])
-            ZoZ[key] = sps.csc_matrix(sps.kron(Zs[key], Zs[key]))
-
-        deriv_mats = collections.OrderedDict()
-        for key in var_struct.keys():
-            Sv_shape, Av = var_struct[key]
-            Av_shape = Av.shape
-            Kv = linalg_utils.kronvec_mat(Sv_shape, Av_shape, sparse=True)
-            Ip = sps.csc_matrix(sps.eye(np.product(Sv_shape)))
-            vecAv = sps.csc_matrix(linalg_utils.vecc(Av))
-
-            D = sps.csc_matrix(Kv.dot(sps.kron(Ip, vecAv)))
-            if key != 'error':
-                D = sps.csc_matrix(ZoZ[key].dot(D))
-            tmp = sps.csc_matrix(linalg_utils.dmat(int(np.sqrt(D.shape[1]))))
-            deriv_mats[key] = D.dot(tmp)
-
-        self.var_struct = var_struct
-        self.deriv_mats = deriv_mats
-        self.bounds = [(0, None) if x == 1 else (None, None) for x in theta]
-        self.theta = theta
-        self.partitions = np.cumsum(partitions)
-        J = sps.hstack([deriv_mats[key] for key in deriv_mats])
-        self.jac_mats = [J[:, i].reshape(Z.shape[0], Z.shape[0], order='F')
-                         for i in range(J.shape[1])]
-
-        self.X = linalg_utils._check_np(X)
-        self.Z = linalg_utils._check_np(Z)
-        self.y = linalg_utils._check_np(y)
-        self.error_struct = error_struct
-        self.re_struct = re_struct
-        self.ZoZ = ZoZ
-        self.res_names = res_names + fixed_effects.tolist()
-        self.n_vars = n_vars
-        self.XZY = np.block([X, Z, y])
-        self.XZ = np.block([X, Z])
-        self.A = np.block([[X, Z], [np.zeros((Z.shape[1], X.shape[1])),
-                           np.eye(Z.shape[1])]])
-
-    def params2mats(self, theta=None):
-        '''
-        Create variance matrices from parameter vector
-        Parameters
-        ------------
-        theta: array
-            Vector containing relavent model terms
+    def _fit(self, optimizer_kwargs={}, maxiter=100, verbose=2,
+             hess_opt=False, method='trust-constr', tol=1e-8,
+             optimizer_options=None):
         '''
-        if theta is None:
-            theta = self.theta
-        partitions = self.partitions
-        error_struct = self.error_struct
-        re_struct = self.re_struct
-
-        Glist, Ginvlist, SigA = [], [], []
-        for i, key in enumerate(re_struct.keys()):
-            a, b = int(partitions[i]), int(partitions[i+1])
-            Vi = linalg_utils.invech(theta[a:b])
-            Ai = re_struct[key]['acov']
-            Glist.append(np.kron(Vi, Ai))
-            Ginvlist.append(np.kron(np.linalg.pinv(Vi), Ai))
-            SigA.append(Vi)
-        p1, p2 = int(partitions[-2]), int(partitions[-1])
-        Verr = linalg_utils.invech(theta[p1:p2])
-        R = np.kron(Verr, error_struct['acov'])
-        W, Winv = self.W, self.Winv
-        R = W.dot(R).dot(W)
-        Rinv = np.kron(np.linalg.inv(Verr), error_struct['acov'])
-        Rinv = Winv.dot(Rinv).dot(Winv)
-        G, Ginv = sp.linalg.block_diag(*Glist), sp.linalg.block_diag(*Ginvlist)
-
-        SigE = Verr.copy()
-        return G, Ginv, SigA, R, Rinv, SigE
-
-    def mmec(self, Rinv, Ginv):
+        LMM._fit with the positional order of the arguments of WLMM kept, 
+        so that optimizer_kwargs is followed by maxiter
         '''
-        Mixed Model Equation Coefficient(MMEC) matrix construction
-        Parameters
-        ------------
-        Rinv: array
-          Inverse error covariance
-        Ginv:
-          Inverse random effect covariance
-        '''
-        F = self.XZ
-        C = F.T.dot(Rinv).dot(F)
-        k = Ginv.shape[0]
-        C[-k:, -k:] += Ginv
-        return C
+        return LMM._fit(self, optimizer_kwargs=optimizer_kwargs,
+                        optimizer_options=optimizer_options, maxiter=maxiter,
+                        verbose=verbose, hess_opt=hess_opt, method=method,
+                        tol=tol)
 
-    def mme_aug(self, Rinv, Ginv, C=None):
-        '''
-        Augmented Mixed Model Equation Coefficient matrix construction
-        Parameters
-        ------------
-        Rinv: array
-          Inverse error covariance
-        Ginv: array
-          Inverse random effect covariance
-        C: array
-          MMEC coefficient matrix
-
-        '''
-        if C is None:
-            C = self.mmec(Rinv, Ginv)
-        XZ, y = self.XZ, self.y
-        t = y.T.dot(Rinv)
-        b = t.dot(XZ)
-        yRy = linalg_utils._check_np(t).dot(y)
-        M = np.block([[C, b.T], [b, yRy]])
-        return M
-
-    def loglike(self, theta):
-        '''
-        Minus two times the restricted log likelihood
-        Parameters
-        ---------
-        theta: array
-            vector of parameters
-        '''
-        theta = linalg_utils._check_1d(theta)
-        G, Ginv, SigA, R, Rinv, SigE = self.params2mats(theta)
-        re_struct, error_struct = self.re_struct, self.error_struct
-        C = self.mmec(Rinv, Ginv)
-        M = self.mme_aug(Rinv, Ginv, C=C)
-        L = linalg_utils.chol(M)
-        logdetC = 2*np.sum(np.log(np.diag(L)[:-1]))
-        yPy = L[-1, -1]**2
-        logdetG = 0.0
-        for key, Vi in list(zip(re_struct.keys(), SigA)):
-            logdetG += re_struct[key]['n_units']*np.linalg.slogdet(Vi)[1]
-        logdetR = error_struct['acov'].shape[0]*np.linalg.slogdet(SigE)[1]
-        LL = logdetR+logdetC + logdetG + yPy
-        return LL
-
-    def _fit(self, optimizer_kwargs={}, maxiter=100, verbose=2, hess_opt=False,
-            compute_hessian=True):
-        if hess_opt is False:
-            res = sp.optimize.minimize(self.loglike, self.theta,
-                                       bounds=self.bounds,
-                                       options={'verbose': verbose,
-                                                'maxiter': maxiter},
-                                       method='trust-constr',
-                                       jac=self.gradient,
-                                       **optimizer_kwargs)
-        else:
-            res = sp.optimize.minimize(self.loglike, self.theta,
-                                       bounds=self.bounds,
-                                       options={'verbose': verbose,
-                                                'maxiter': maxiter},
-                                       method='trust-constr',
-                                       jac=self.gradient,
-                                       hess=self.hessian,
-                                       **optimizer_kwargs)
-        
-        self.params = res.x
-        self.optimizer = res
-        G, Ginv, SigA, R, Rinv, SigE = self.params2mats(res.x)
-        self.G, self.Ginv, self.R, self.Rinv = G, Ginv, R, Rinv
-        self.SigA, self.SigE = SigA, SigE
-        W = linalg_utils.woodbury_inversion(self.Z, C=G, A=R)
-        X = self.X
-        XtW = X.T.dot(W)
-        self.b = linalg_utils.einv(XtW.dot(X)).dot(XtW.dot(self.y))
-        self.r = self.y - self.X.dot(self.b)
-        self.u = G.dot(self.Z.T.dot(W).dot(self.r))
-        self.SE_b = np.sqrt(np.diag(linalg_utils.einv(XtW.dot(X))))
-        return res
-    
     def fit(self, optimizer_kwargs={}, maxiter=100, verbose=2, hess_opt=False,
-            compute_hessian=True):
-        res = self._fit(optimizer_kwargs, maxiter, verbose, hess_opt, 
-                        compute_hessian)
-        X = self.X
-        self.optimizer = res
-        self.hessian_est = self.hessian(self.params)
-        self.hessian_inv = np.linalg.pinv(self.hessian_est)
-        self.SE_theta = np.sqrt(np.diag(self.hessian_inv))
-        self.grd = self.gradient(self.params)
-        self.gnorm = np.linalg.norm(self.grd) / len(self.params)
-        res = pd.DataFrame(np.concatenate([self.params[:, None], self.b]),
-                           columns=['Parameter Estimate'])
-        res['Standard Error'] = np.concatenate([self.SE_theta, self.SE_b])
-        res['t value'] = res['Parameter Estimate'] / res['Standard Error']
-        res['p value'] = sp.stats.t.sf(np.abs(res['t value']),
-                                       X.shape[0]-len(self.params)) * 2.0
-        res.index = self.res_names
-        self.res = res
-        n_obs, k_params = self.X.shape[0], len(self.params)
-        
-        self.ll = self.loglike(self.params)
-        self.aic = self.ll + (2 * k_params)
-        self.aicc = self.ll + 2*k_params*n_obs / (n_obs - k_params - 1)
-        self.bic = self.ll + k_params*np.log(n_obs)
-        self.caic = self.ll + k_params * np.log(n_obs+1)
-        self.r2_fe = 1 - np.var(self.y - self.X.dot(self.b)) / np.var(self.y)
-        self.r2_re = 1 - np.var(self.y - self.Z.dot(self.u)) / np.var(self.y)
-        self.r2 = 1 - np.var(self.y - self.predict()) / np.var(self.y)
-        self.sumstats = np.array([self.aic, self.aicc, self.bic, self.caic,
-                                  self.r2_fe, self.r2_re, self.r2])
-        self.sumstats = pd.DataFrame(self.sumstats, index=['AIC', 'AICC', 'BIC',
-                                                           'CAIC', 
-                                                           'FixedEffectsR2',
-                                                           'RandomEffectsR2', 
-                                                           'R2'])
-        
-    def predict(self, X=None, Z=None):
-        if X is None:
-            X = self.X
-        if Z is None:
-            Z = self.Z
-        return X.dot(self.b)+Z.dot(self.u)
-
-    def gradient(self, theta):
+            method='trust-constr', tol=1e-8, se_method='ai',
+            optimizer_options=None):
         '''
-        The gradient of minus two times the restricted log likelihood.  This is
-        equal to
-
-        \\partial\\mathcal{L}=vec(Py)'\\partial V-(vec(Py)\\otimes
-                              vec(Py))'\\partial V
-
-        Parameters
-        ----------
-        theta: array
-          Vector of parameters
-
-        Returns
-        --------
-        g: array
-          gradient vector of one dimensions (for compatibility with minimize)
-
+        Fit the model by restricted maximum likelihood; see LMM.fit
         '''
-        theta = linalg_utils._check_1d(theta)
-        G, Ginv, SigA, R, Rinv, SigE = self.params2mats(theta)
-        deriv_mats = self.deriv_mats
-        X, Z, y = self.X, self.Z, self.y
-        W = linalg_utils.woodbury_inversion(Z, Cinv=Ginv, Ainv=Rinv) 
-        XtW = X.T.dot(W)
-        XtWX_inv = linalg_utils.einv(XtW.dot(X))
-        P = W - XtW.T.dot(XtWX_inv).dot(XtW)
-        dP = P.reshape(np.product(P.shape), 1, order='F')
-        Py = P.dot(y)
-        PyPy = np.kron(Py, Py)
-        # PyPy = vec(_check_2d(Py).dot(_check_2d(Py).T))[:, None] effecient
-        # only at large heterogenous n
-        g = []
-        for key in deriv_mats.keys():
-            JF_Omega = deriv_mats[key]
-            g_i = JF_Omega.T.dot(dP) - JF_Omega.T.dot(PyPy)
-            g.append(g_i)
-        g = np.concatenate(g)
-        return linalg_utils._check_1d(g)
-
-    def hessian(self, theta):
-        theta = linalg_utils._check_1d(theta)
-        G, Ginv, SigA, R, Rinv, SigE = self.params2mats(theta)
-        jac_mats = self.jac_mats
-        X, Z, y = self.X, self.Z, self.y
-        W = linalg_utils.woodbury_inversion(Z, Cinv=Ginv, Ainv=Rinv)
-        XtW = X.T.dot(W)
-        XtWX_inv = linalg_utils.einv(XtW.dot(X))
-        P = W - XtW.T.dot(XtWX_inv).dot(XtW)
-        # P = W - np.linalg.multi_dot([XtW.T, XtWX_inv, XtW])
-        Py = P.dot(y)
-        H = []
-        for i, Ji in enumerate(jac_mats):
-            for j, Jj in enumerate(jac_mats):
-                if j >= i:
-                    PJi = sps.coo_matrix.dot(Ji.T, P).T
-                    PJj = sps.coo_matrix.dot(Jj.T, P).T
-                    yPJi = sps.coo_matrix.dot(Ji.T, Py).T
-                    JjPy = Jj.dot(Py)
-                    Hij = -(PJi.dot(PJj)).diagonal().sum()\
-                        + (2 * (yPJi.dot(P)).dot(JjPy))[0]
-                    H.append(Hij[0])
-        H = linalg_utils.invech(np.array(H))
-        return H
+        LMM.fit(self, optimizer_kwargs=optimizer_kwargs,
+                optimizer_options=optimizer_options, maxiter=maxiter,
+                verbose=verbose, hess_opt=hess_opt, method=method, tol=tol,
+                se_method=se_method)
     
 class GLMM(WLMM):
     '''
@@ -457,18 +121,27 @@ class GLMM(WLMM):
         self.error_struct, self.acov = error_structure, acov
         self.data = data
         self.mod = WLMM(fixed_effects, random_effects, yvar, data,
-                        W=np.eye(data.shape[0]), error_structure=None,
-                        acov=None)        
-        self.mod._fit()
+                        W=None, error_structure=None, acov=None)
         self.y = self.mod.y
         
-    def fit(self, n_iters=200, tol=1e-3, verbose=True):
-        
+    def _fit_pql(self, n_iters=200, tol=1e-3, verbose=True, 
+                 method='trust-constr'):
+        '''
+        Penalized quasi-likelihood; each outer iteration updates the weights
+        and the working response of a single weighted model in place, 
+        keeping its model matrices and the symbolic factorization of the
+        mixed model equations, and refits starting from the previous 
+        estimates of the variance parameters
+        '''
         mod = self.mod
-        theta = mod.params
+        if not hasattr(mod, 'params'):
+            mod._fit()
         y = self.y
         fit_hist = []
         bounds = mod.bounds[:-1]+[(1, 1)] #fix error covariance to 1
+        mod.bounds = bounds
+        theta = mod.params.copy()
+        theta[-1] = 1.0
         for i in range(n_iters):
             eta = mod.predict()
             
@@ -478,13 +151,10 @@ class GLMM(WLMM):
             nu = eta + gp*(y - mu)
             v = linalg_utils._check_1d(v)
             W = 1.0 / (v * (self.f.dlink(mu)**2)[:, 0])
-            W = np.diag(1/np.sqrt(W))
-            
             
-            mod = WLMM(self.fe, self.re, self.yvar, self.data, W=W)
-            mod.y = nu
-            mod.bounds = bounds
-            mod._fit()
+            mod.update_working(nu, 1.0 / np.sqrt(W))
+            mod.theta = theta
+            mod._fit(method=method)
             tvar = (np.linalg.norm(theta)+np.linalg.norm(mod.params))
             eps = np.linalg.norm(theta - mod.params) / tvar
             fit_hist.append(eps)
@@ -495,52 +165,407 @@ class GLMM(WLMM):
             theta = mod.params
         self.mod = mod
         self.fit_hist = fit_hist
-        res = self.mod.optimizer
-        self.params = res.x
-        G, Ginv, SigA, R, Rinv, SigE = self.mod.params2mats(res.x)
-        self.G, self.Ginv, self.R, self.Rinv = G, Ginv, R, Rinv
-        self.SigA, self.SigE = SigA, SigE
-        W = linalg_utils.woodbury_inversion(self.mod.Z, C=G, A=R)
-        X = self.mod.X
-        XtW = X.T.dot(W)
-        self.optimizer = res
-        self.hessian_est = self.mod.hessian(self.params)
-        self.hessian_inv = np.linalg.pinv(self.hessian_est)
-        self.SE_theta = np.sqrt(np.diag(self.hessian_inv))
-        self.grd = self.mod.gradient(self.params)
-        self.gnorm = np.linalg.norm(self.grd) / len(self.params)
-        self.b = linalg_utils.einv(XtW.dot(X)).dot(XtW.dot(self.mod.y))
-        self.SE_b = np.sqrt(np.diag(linalg_utils.einv(XtW.dot(X))))
-        self.r = self.mod.y - self.mod.X.dot(self.b)
-        self.u = G.dot(self.mod.Z.T.dot(W).dot(self.r))
-        res = pd.DataFrame(np.concatenate([self.params[:, None], self.b]),
+        if method=='ai':
+            mod._summarize(mod.optimizer.hess)
+        else:
+            mod._summarize()
+        for attr in ['params', 'optimizer', 'G', 'Ginv', 'R', 'Rinv', 'SigA',
+                     'SigE', 'hessian_est', 'hessian_inv', 'SE_theta', 'grd',
+                     'gnorm', 'b', 'SE_b', 'r', 'u', 'res', 'll', 'aic', 
+                     'aicc', 'bic', 'caic', 'r2_fe', 'r2_re', 'r2',
+                     'sumstats']:
+            setattr(self, attr, getattr(mod, attr))
+
+    def fit(self, n_iters=200, tol=1e-3, verbose=True, method='trust-constr',
+            estimator='pql', nagq=1):
+        '''
+        Fit the model
+
+        Parameters
+        ----------
+        n_iters: int, default 200
+            Maximum number of outer PQL iterations
+
+        tol: float, default 1e-3
+            Convergence tolerance for the relative change in the variance
+            parameters between PQL iterations
+
+        method: str, default 'trust-constr'
+            Optimizer used for the weighted linear mixed models fit by PQL;
+            see LMM.fit
+
+        estimator: str, default 'pql'
+            Either 'pql' for penalized quasi-likelihood, or 'laplace' for the
+            Laplace approximation to the marginal likelihood
+
+        nagq: int, default 1
+            Number of adaptive Gauss-Hermite quadrature points used by the
+            'laplace' estimator, with nagq=1 the Laplace approximation.  
+            Values greater than one require estimator='laplace' and a model
+            with a single grouping factor and a single random effect (e.g. 
+            a random intercept), as the quadrature is taken over one scalar
+            random effect per unit; otherwise a ValueError is raised before
+            any fitting
+        '''
+        if estimator not in ['pql', 'laplace']:
+            raise ValueError("estimator must be one of 'pql' or 'laplace'")
+        if (nagq!=1) and (estimator=='pql'):
+            raise ValueError("nagq>1 requires estimator='laplace'")
+        self._check_nagq(nagq)
+        if estimator=='pql':
+            self._fit_pql(n_iters, tol, verbose, method)
+        else:
+            self._fit_laplace(nagq=int(nagq), verbose=verbose)
+
+    def _check_nagq(self, nagq):
+        '''
+        Raises a ValueError unless nagq is a positive integer, and, when 
+        greater than one, the model has a single grouping factor with a 
+        single random effect
+        '''
+        if (int(nagq)!=nagq) or (nagq<1):
+            raise ValueError("nagq must be a positive integer")
+        if nagq>1:
+            re_struct = self.mod.re_struct
+            if (len(re_struct)!=1) or \
+               (list(re_struct.values())[0]['cov_re_dims']!=1):
+                raise ValueError("nagq>1 requires a single grouping factor "
+                                 "with a single random effect")
+
+    def _setup_laplace(self):
+        '''
+        Precomputes the structures used by the Laplace and adaptive
+        Gauss-Hermite estimators.  The random effects are written as
+        u=\\Lambda v with v~N(0, I), where \\Lambda is block diagonal with the
+        lower triangular factors \\Lambda_{i} of each grouping factor, so
+        that the conditional modes of v solve a penalized GLM.  With a single
+        grouping factor the mode problems decouple by unit and are solved as
+        batches of k by k systems; otherwise the joint problem is solved with
+        a sparse cholesky factorization whose pattern is fixed.
+        '''
+        mod = self.mod
+        n_fe = mod.X.shape[1]
+        shapes, indices = collections.OrderedDict(), {}
+        for i, key in enumerate(mod.re_struct.keys()):
+            shapes[key] = mod.gmats.shapes[key]
+            indices[key] = np.arange(int(mod.partitions[i]),
+                                     int(mod.partitions[i+1]))
+        n_lam = int(mod.partitions[-2])
+        factor = sparse_utils.RelativeCovarianceFactor(shapes, indices)
+        self._lfactor = factor
+        self._lam_index = np.arange(n_lam)
+        self._beta_index = np.arange(n_lam, n_lam + n_fe)
+        self._single_factor = len(shapes)==1
+        self._yl = linalg_utils._check_1d(self.y)
+        if self._single_factor:
+            key = list(shapes.keys())[0]
+            n_units, k = shapes[key]
+            Z = sps.coo_matrix(mod.Z)
+            groups = np.zeros(mod.n_obs, dtype=int)
+            Zd = np.zeros((mod.n_obs, k))
+            groups[Z.row] = Z.col // k
+            Zd[Z.row, Z.col % k] = Z.data
+            self._groups, self._Zd = groups, Zd
+            self._n_units, self._k = n_units, k
+        else:
+            Z = sps.csc_matrix(mod.Z)
+            q = Z.shape[1]
+            pattern = sparse_utils.block_closure(Z.T.dot(Z) + sps.eye(q),
+                                                 factor.start, factor.size)
+            perm = sparse_utils.fill_reducing_ordering(pattern)
+            self._lpattern = pattern
+            self._lchol = sparse_utils.SparseCholesky(pattern, perm=perm)
+            self._ldiag = sparse_utils.pattern_data(sps.eye(q), pattern)
+        self._modes = None
+
+    def _cond_deviance(self, eta):
+        '''
+        Minus the conditional log likelihood of each observation, omitting
+        terms that depend only on y, along with the derivative with respect
+        to eta and the Fisher weights, computed with the family and link
+        '''
+        f, y = self.f, self._yl
+        mu = f.inv_link(eta)
+        T = f.canonical_parameter(mu)
+        d = -(y * T - f.cumulant(T))
+        d = np.where(np.isfinite(d), d, np.inf)
+        dmu = f.dinv_link(eta)
+        V = f.var_func(T=T)
+        g = -(y - mu) * dmu / V
+        w = dmu**2 / V
+        return d, g, w
+
+    def _group_sum(self, x):
+        return np.bincount(self._groups, weights=x, minlength=self._n_units)
+
+    def _conditional_modes_grouped(self, beta, Lam, v, maxiter=50,
+                                   tol=1e-8, n_halvings=20):
+        '''
+        Newton iterations for the conditional modes of the spherical random
+        effects, batched over the units of a single grouping factor
+        '''
+        k, n_units = self._k, self._n_units
+        A = self._Zd.dot(Lam)
+        offset = self.mod.X.dot(beta)
+        eta = offset + np.sum(A * v[self._groups], axis=1)
+        d, g, w = self._cond_deviance(eta)
+        h = self._group_sum(d) + np.sum(v**2, axis=1) / 2.0
+        for i in range(maxiter):
+            grad = np.vstack([self._group_sum(A[:, a] * g)
+                              for a in range(k)]).T + v
+            H = np.zeros((n_units, k, k))
+            for a, b in list(zip(*np.triu_indices(k))):
+                H[:, a, b] = H[:, b, a] = self._group_sum(A[:, a]*A[:, b]*w)
+            H += np.eye(k)[None]
+            step = np.linalg.solve(H, grad[:, :, None])[:, :, 0]
+            alpha = np.ones(n_units)
+            for j in range(n_halvings):
+                v_new = v - alpha[:, None] * step
+                eta = offset + np.sum(A * v_new[self._groups], axis=1)
+                d, g, w = self._cond_deviance(eta)
+                h_new = self._group_sum(d) + np.sum(v_new**2, axis=1) / 2.0
+                worse = h_new > h + 1e-12 * (1.0 + np.abs(h))
+                if not np.any(worse):
+                    break
+                alpha = np.where(worse, alpha / 2.0, alpha)
+            v, h = v_new, h_new
+            if np.max(np.abs(alpha[:, None] * step)) < tol:
+                break
+        H = np.zeros((n_units, k, k))
+        for a, b in list(zip(*np.triu_indices(k))):
+            H[:, a, b] = H[:, b, a] = self._group_sum(A[:, a] * A[:, b] * w)
+        H += np.eye(k)[None]
+        return v, h, H, A, offset
+
+    def _conditional_modes_sparse(self, beta, v, maxiter=50, tol=1e-8,
+                                  n_halvings=20):
+        '''
+        Newton iterations for the joint conditional modes of the spherical
+        random effects of several grouping factors
+        '''
+        ZL = sps.csc_matrix(self.mod.Z.dot(self._lfactor.T))
+        offset = self.mod.X.dot(beta)
+        eta = offset + ZL.dot(v)
+        d, g, w = self._cond_deviance(eta)
+        h = np.sum(d) + np.sum(v**2) / 2.0
+        for i in range(maxiter):
+            grad = ZL.T.dot(g) + v
+            L = self._lchol.factor(self._sparse_hessian(ZL, w))
+            step = L.solve(grad)
+            alpha = 1.0
+            for j in range(n_halvings):
+                v_new = v - alpha * step
+                eta = offset + ZL.dot(v_new)
+                d, g, w = self._cond_deviance(eta)
+                h_new = np.sum(d) + np.sum(v_new**2) / 2.0
+                if h_new <= h + 1e-12 * (1.0 + np.abs(h)):
+                    break
+                alpha /= 2.0
+            v, h = v_new, h_new
+            if np.max(np.abs(alpha * step)) < tol:
+                break
+        L = self._lchol.factor(self._sparse_hessian(ZL, w))
+        return v, h, L
+
+    def _sparse_hessian(self, ZL, w):
+        H = ZL.T.dot(sps.diags(w)).dot(ZL)
+        return sparse_utils.pattern_data(H, self._lpattern) + self._ldiag
+
+    def laplace_deviance(self, params, nagq=1, modes=None):
+        '''
+        Minus two times the Laplace (nagq=1) or adaptive Gauss-Hermite
+        approximation to the marginal log likelihood, omitting terms that
+        only depend on y.  The conditional modes of the spherical random 
+        effects found are stored in _modes, but only modes, and not the 
+        modes of previous evaluations, is used as the starting value, so 
+        that the deviance is a function of params alone
+
+        Parameters
+        ----------
+        params: array
+            Vector containing the entries of the relative covariance factors,
+            ordered as vech(V_{i}) for each grouping factor, followed by the
+            fixed effects
+
+        nagq: int, default 1
+            Number of quadrature points; values greater than one require a
+            single grouping factor with a single random effect
+
+        modes: array, optional
+            Starting value of the Newton iterations for the conditional 
+            modes, by default zero
+        '''
+        self._check_nagq(nagq)
+        params = linalg_utils._check_1d(params)
+        lam, beta = params[self._lam_index], params[self._beta_index]
+        factor = self._lfactor.update(lam)
+        if self._single_factor:
+            key = list(factor.shapes.keys())[0]
+            Lam = factor.Lambda[key]
+            v = np.zeros((self._n_units, self._k)) if modes is None else \
+                np.reshape(modes, (self._n_units, self._k))
+            v, h, H, A, offset = self._conditional_modes_grouped(beta, Lam, v)
+            self._modes = v
+            if nagq==1:
+                lndet = np.linalg.slogdet(H)[1]
+                return 2.0 * np.sum(h) + np.sum(lndet)
+            z, wq = np.polynomial.hermite_e.hermegauss(nagq)
+            sd = 1.0 / np.sqrt(H[:, 0, 0])
+            vq = v[:, 0][:, None] + sd[:, None] * z[None]
+            hq = np.zeros((self._n_units, nagq))
+            for q in range(nagq):
+                eta = offset + A[:, 0] * vq[self._groups, q]
+                hq[:, q] = self._group_sum(self._cond_deviance(eta)[0])
+            hq += vq**2 / 2.0
+            lnw = np.log(wq) + z**2 / 2.0
+            ll = sp.special.logsumexp(lnw[None] - hq, axis=1) + np.log(sd)
+            ll -= np.log(2.0 * np.pi) / 2.0
+            return -2.0 * np.sum(ll)
+        else:
+            v = np.zeros(self.mod.Z.shape[1]) if modes is None else \
+                linalg_utils._check_1d(modes)
+            v, h, L = self._conditional_modes_sparse(beta, v)
+            self._modes = v
+            return 2.0 * h + L.logdet()
+
+    def _laplace_to_params(self, params):
+        '''
+        Converts the relative covariance factors in params to the random
+        effect covariance parameters vech(V_{i})
+        '''
+        params = linalg_utils._check_1d(params).copy()
+        lam = params[self._lam_index]
+        params[self._lam_index] = self._lfactor.covariance_params(lam)
+        return params
+
+    def _params_to_laplace(self, params):
+        '''
+        Inverse of _laplace_to_params, taking \\Lambda_{i} to be the cholesky
+        factor of V_{i}
+        '''
+        params = linalg_utils._check_1d(params).copy()
+        for key, (n_units, k) in self._lfactor.shapes.items():
+            ix = self._lfactor.indices[key]
+            V = linalg_utils.invech(params[ix])
+            try:
+                L = np.linalg.cholesky(V)
+            except np.linalg.LinAlgError:
+                u, U = np.linalg.eigh(V)
+                V = (U * np.maximum(u, 0.0)).dot(U.T) + 1e-12 * np.eye(k)
+                L = np.linalg.cholesky(V)
+            params[ix] = L.T[np.triu_indices(k)]
+        return params
+
+    def _fit_laplace(self, nagq=1, verbose=False, maxiter=500):
+        '''
+        Maximizes the Laplace or adaptive Gauss-Hermite approximation to the
+        marginal likelihood jointly over the relative covariance factors and
+        the fixed effects, with the conditional modes of the random effects
+        recomputed at each evaluation, starting from the modes at the last
+        accepted iterate
+        '''
+        mod = self.mod
+        self._setup_laplace()
+        factor = self._lfactor
+        X, y = mod.X, self._yl
+        # fixed effects start from the GLM that ignores the random effects
+        beta = np.zeros(X.shape[1])
+        for i in range(25):
+            eta = X.dot(beta)
+            d, g, w = self._cond_deviance(eta)
+            step = np.linalg.solve((X * w[:, None]).T.dot(X), X.T.dot(g))
+            beta = beta - step
+            if np.max(np.abs(step)) < 1e-8:
+                break
+        x0 = np.concatenate([factor.theta0, beta])
+        bounds = factor.bounds + [(None, None)] * X.shape[1]
+        # every evaluation within an iteration, including those of the 
+        # finite difference gradient, starts the mode search from the modes
+        # at the current iterate, which are only moved once the optimizer 
+        # has accepted a step
+        start = [None]
+        
+        def accept(x):
+            self.laplace_deviance(x, nagq, start[0])
+            start[0] = self._modes
+            
+        accept(x0)
+        opt = sp.optimize.minimize(lambda x: self.laplace_deviance(x, nagq,
+                                                                   start[0]),
+                                   x0, bounds=bounds, method='L-BFGS-B',
+                                   callback=accept,
+                                   options={'maxiter': maxiter,
+                                            'disp': verbose})
+        accept(opt.x)
+        params = self._laplace_to_params(opt.x)
+        dev = self.laplace_deviance(opt.x, nagq, start[0])
+        # standard errors from the numerical hessian of the deviance in the
+        # covariance parameterization, with the modes started at the optimum
+        func = lambda x: self.laplace_deviance(self._params_to_laplace(x),
+                                               nagq, start[0])
+        H = _numerical_hessian(func, params)
+        self.laplace_deviance(opt.x, nagq, start[0])
+        self.hessian_est = H
+        self.hessian_inv = np.linalg.pinv(H / 2.0)
+        SE = np.sqrt(np.abs(np.diag(self.hessian_inv)))
+        lam, beta = opt.x[self._lam_index], opt.x[self._beta_index]
+        factor.update(lam)
+        if self._single_factor:
+            key = list(factor.shapes.keys())[0]
+            u = self._modes.dot(factor.Lambda[key].T).reshape(-1)
+        else:
+            u = factor.T.dot(self._modes)
+        self.optimizer = opt
+        self.params = params
+        self.b = beta[:, None]
+        self.u = u[:, None]
+        n_lam = len(self._lam_index)
+        self.SE_theta, self.SE_b = SE[:n_lam], SE[n_lam:]
+        res_names = mod.res_names[:n_lam] + mod.res_names[n_lam+1:]
+        res = pd.DataFrame(params, index=res_names,
                            columns=['Parameter Estimate'])
-        res['Standard Error'] = np.concatenate([self.SE_theta, self.SE_b])
+        res['Standard Error'] = SE
         res['t value'] = res['Parameter Estimate'] / res['Standard Error']
-        res['p value'] = sp.stats.t.sf(np.abs(res['t value']),
-                                       X.shape[0]-len(self.params)) * 2.0
-        res.index = self.mod.res_names
+        res['p value'] = sp.stats.norm.sf(np.abs(res['t value'])) * 2.0
         self.res = res
-        n_obs, k_params = self.mod.X.shape[0], len(self.params)
-        
-        self.ll = self.mod.loglike(self.params)
+        n_obs, k_params = X.shape[0], len(params)
+        self.ll = dev
         self.aic = self.ll + (2 * k_params)
         self.aicc = self.ll + 2*k_params*n_obs / (n_obs - k_params - 1)
         self.bic = self.ll + k_params*np.log(n_obs)
         self.caic = self.ll + k_params * np.log(n_obs+1)
-        self.r2_fe = 1 - np.var(self.mod.y - self.mod.X.dot(self.b)) / np.var(self.mod.y)
-        self.r2_re = 1 - np.var(self.mod.y - self.mod.Z.dot(self.u)) / np.var(self.mod.y)
-        self.r2 = 1 - np.var(self.mod.y - self.mod.predict()) / np.var(self.mod.y)
-        self.sumstats = np.array([self.aic, self.aicc, self.bic, self.caic,
-                                  self.r2_fe, self.r2_re, self.r2])
-        self.sumstats = pd.DataFrame(self.sumstats, index=['AIC', 'AICC', 'BIC',
-                                                           'CAIC', 
-                                                           'FixedEffectsR2',
-                                                           'RandomEffectsR2', 
-                                                           'R2'])
-        
-        
-        
-        
-        
-   
+        self.sumstats = pd.DataFrame(np.array([self.aic, self.aicc, self.bic,
+                                               self.caic]),
+                                     index=['AIC', 'AICC', 'BIC', 'CAIC'])
+
+    def predict(self, X=None, Z=None):
+        '''
+        Returns the predicted linear predictor using both fixed and random
+        effect estimates
+        '''
+        if X is None:
+            X = self.mod.X
+        if Z is None:
+            Z = self.mod.Z
+        return X.dot(self.b)+Z.dot(self.u)
+
+
+def _numerical_hessian(func, x, eps=1e-4):
+    '''
+    Central difference approximation to the hessian of a scalar function
+    '''
+    p = len(x)
+    H = np.zeros((p, p))
+    h = eps * np.maximum(np.abs(x), 1.0)
+    f0 = func(x)
+    for i in range(p):
+        ei = np.zeros(p)
+        ei[i] = h[i]
+        H[i, i] = (func(x + ei) - 2.0 * f0 + func(x - ei)) / h[i]**2
+        for j in range(i):
+            ej = np.zeros(p)
+            ej[j] = h[j]
+            H[i, j] = H[j, i] = (func(x + ei + ej) - func(x + ei - ej)
+                                 - func(x - ei + ej) + func(x - ei - ej)) \
+                                 / (4.0 * h[i] * h[j])
+    return H
@@ -6,6 +6,7 @@ Created on Wed Sep 11 20:03:34 2019
 @author: lukepinkel
 """
 import re
+import time
 import patsy
 import collections
 import numpy as np
@@ -13,8 +14,9 @@ import scipy as sp
 import pandas as pd
 import scipy.stats
 import scipy.sparse as sps
+import concurrent.futures
 
-from ..utils import linalg_utils, data_utils
+from ..utils import linalg_utils, data_utils, sparse_utils, base_utils
 
 def replace_duplicate_operators(match):
     return match.group()[-1:]
@@ -39,10 +41,7 @@ def construct_random_effects(groups, data, n_vars):
         dim_dict[y] = {'nvars':Jdict[y].shape[1], 'n_groups':Zdict[x].shape[1]}
         Zi = linalg_utils.khatri_rao(Jdict[y].T, Zdict[x].T).T
         if n_vars>1:
-            # This should be changed to kron(Zi, eye)
-            Kl = linalg_utils.kmat(Zi.shape[0], n_vars)
-            Kr = linalg_utils.kmat(n_vars, Zi.shape[1])
-            Zi = Kl.dot(np.kron(np.eye(n_vars), Zi)).dot(Kr)
+            Zi = np.kron(Zi, np.eye(n_vars))
         Z.append(Zi)
     Z = np.concatenate(Z, axis=1)
     return Z, dim_dict
@@ -66,7 +65,109 @@ def construct_model_matrices(formula, data):
 
 
 
+class VarianceDerivative(object):
+
+    def __init__(self, Z, A, k, i, j):
+        '''
+        Implicit representation of the derivative of the covariance term 
+        Z(A\\otimes V)Z' with respect to V_{ij}, namely Z(A\\otimes E)Z'
+        where E=E_{ij}+E_{ji} (or E_{ii}), which is applied on demand rather 
+        than formed.  The cost of an application is linear in nnz(Z).
+        
+        Parameters
+        ----------
+        Z: sparse matrix or None
+            n by (n_units * k) design matrix whose columns are ordered by unit
+            and then by effect; None is taken to be the identity
+        
+        A: sparse matrix or None
+            n_units by n_units covariance among the units; None is taken to
+            be the identity
+        
+        k: int
+            Dimension of V
+        
+        i, j: int
+            Indices of the element of V
+        '''
+        self.Z, self.A, self.k, self.i, self.j = Z, A, k, i, j
+        
+    def _kron_dot(self, t):
+        k, i, j = self.k, self.i, self.j
+        r = t.shape[1]
+        t = t.reshape(-1, k, r)
+        out = np.zeros_like(t)
+        out[:, i] += t[:, j]
+        if i!=j:
+            out[:, j] += t[:, i]
+        if self.A is not None:
+            out = self.A.dot(out.reshape(out.shape[0], -1))
+        return out.reshape(-1, r)
+    
+    def dot(self, v):
+        '''
+        Applies the derivative matrix to a vector or a block of vectors
+        '''
+        v = np.asarray(v)
+        is_1d = v.ndim==1
+        t = v.reshape(v.shape[0], -1)
+        if self.Z is not None:
+            t = self.Z.T.dot(t)
+        t = self._kron_dot(t)
+        if self.Z is not None:
+            t = self.Z.dot(t)
+        if is_1d:
+            t = t.reshape(-1)
+        return t
+    
+    
+# State of the model copy held by each bootstrap worker
+_BOOT_STATE = {}
+
+
+def _bootstrap_init(model_type, state, specs):
+    '''
+    Attaches to the shared design arrays and reconstructs the model on which
+    the bootstrap replicates are refit
+    '''
+    arrays, blocks = base_utils.attach_arrays(specs)
+    mod = model_type.__new__(model_type)
+    mod.__dict__.update(state)
+    mod.X = arrays['X']
+    mod.Z = sps.csc_matrix((arrays['Z_data'], arrays['Z_indices'],
+                            arrays['Z_indptr']), shape=state['_Z_shape'])
+    mod.y = arrays['mu'].reshape(-1, 1).copy()
+    _BOOT_STATE.update(mod=mod, arrays=arrays, blocks=blocks)
+
+
+def _bootstrap_replicate(seed_seq):
+    '''
+    Simulates a response from the fitted model with the random stream 
+    seed_seq, refits it, and returns the variance parameters, the fixed
+    effects, and whether the fit converged
+    '''
+    mod, arrays = _BOOT_STATE['mod'], _BOOT_STATE['arrays']
+    rng = np.random.default_rng(seed_seq)
+    fit_kws = mod._boot_fit_kws
+    u = []
+    for LA, LV in mod._boot_chol:
+        n_units, k = LA.shape[0], LV.shape[0]
+        U = rng.standard_normal((n_units, k)).dot(LV.T)
+        u.append((LA.dot(U) if sps.issparse(LA) else np.dot(LA, U)).reshape(-1))
+    u = np.concatenate(u)
+    m = mod.n_vars
+    e = rng.standard_normal((mod.n_obs, m)).dot(mod._boot_chol_err.T)
+    e = e.reshape(-1) * np.repeat(mod.weights, m)
+    y = arrays['mu'] + mod.Z.dot(u) + e
+    mod.update_working(y=y)
+    mod.theta = mod._boot_theta.copy()
+    res = mod._fit(verbose=0, **fit_kws)
+    return np.concatenate([res.x, mod.b[:, 0]]), bool(res.success)
+
+
 class LMM(object):
+    
+    hessian_max_obs = 5000
 
     def __init__(self, formula, data, error_structure=None, acov=None):
         '''
@@ -100,9 +201,39 @@ class LMM(object):
         yvars, fixed_effects = re.split("[~]", fe_form)
         yvars = re.split(",", re.sub("\(|\)", "", yvars))
         yvar = [x.strip() for x in yvars]
+        self._construct(fixed_effects, random_effects, yvar, data, acov)
+        
+    def _construct(self, fixed_effects, random_effects, yvar, data, acov=None,
+                   weights=None):
+        '''
+        Constructs the model matrices, the covariance structures and the 
+        sparse mixed model equations
+        
+        Parameters
+        ----------
+        fixed_effects: str
+            patsy formula for the fixed effects
+        
+        random_effects: dict
+            Dictionary whose keys correspond to factors, and whose values are
+            formulas specifying the random effect terms
+        
+        yvar: str or list
+            Dependent variable(s)
+        
+        data: DataFrame
+            Data containing the model terms
+        
+        acov: dict, default None
+            Dictionary of covariance matrices among the levels of each factor
+        
+        weights: array, default None
+            Diagonal of W, where the error covariance is W(I\\otimes\\Sigma)W
+        '''
         n_obs = data.shape[0]
         X = patsy.dmatrix(fixed_effects, data=data, return_type='dataframe')
         fixed_effects = X.columns
+        fe_info, re_info, re_levels = X.design_info, {}, {}
         Z = []
         re_struct = collections.OrderedDict()
         
@@ -113,20 +244,23 @@ class LMM(object):
         else:
             n_vars = 1
             yvnames = [yvar]
+        yvar = yvnames
+        self._yvars = yvar
          
         res_names = [] # might be better off renamed re_names; may be typo
         for key in random_effects.keys():
             # dummy encode the groupings and get random effect variate
-            Ji = data_utils.dummy_encode(data[key], complete=True)
             Zij = patsy.dmatrix(random_effects[key], data=data,
                                 return_type='dataframe')
-            # stratify re variable by dummy columns
-            Zi = linalg_utils.khatri_rao(Ji.T, Zij.T).T
+            # stratify re variable by groupings without forming the dense
+            # indicator matrix
+            re_info[key] = Zij.design_info
+            re_levels[key] = np.unique(data[key])
+            Zi = sparse_utils.sparse_khatri_rao(data[key], Zij.values,
+                                                re_levels[key])
+            n_units = Zi.shape[1] // Zij.shape[1]
             if n_vars>1:
-                # This should be changed to kron(Zi, eye)
-                Kl = linalg_utils.kmat(Zi.shape[0], n_vars)
-                Kr = linalg_utils.kmat(n_vars, Zi.shape[1])
-                Zi = Kl.dot(np.kron(np.eye(n_vars), Zi)).dot(Kr)
+                Zi = sps.kron(Zi, sps.eye(n_vars), format='csc')
                 
             Z.append(Zi)
             k = Zij.shape[1]*n_vars
@@ -135,10 +269,11 @@ class LMM(object):
                 if acov[key] is not None: # dependence structure for each RE
                     acov_i = acov[key]
                 else:                     # single dependence for all REs
-                    acov_i = np.eye(Ji.shape[1])
+                    acov_i = sps.eye(n_units, format='csc')
             else:                         # IID
-                acov_i = np.eye(Ji.shape[1])
-            re_struct[key] = {'n_units': Ji.shape[1],
+                acov_i = sps.eye(n_units, format='csc')
+            acov_i = sps.csc_matrix(acov_i)
+            re_struct[key] = {'n_units': n_units,
                               'n_level_effects': Zij.shape[1],
                               'cov_re_dims': k,
                               'n_params': ((k + 1.0) * k) / 2.0,
@@ -157,11 +292,11 @@ class LMM(object):
                 res_names.append(key+'|'+names_a[r]+' x '+names_b[r])
         
 
-        Z = np.concatenate(Z, axis=1)
+        Z = sps.csc_matrix(sps.hstack(Z))
 
         error_struct = collections.OrderedDict()
         error_struct['vcov'] = np.eye(n_vars)
-        error_struct['acov'] = np.eye(n_obs)
+        error_struct['acov'] = sps.eye(n_obs, format='csc')
         error_struct['params'] = linalg_utils.vech(np.eye(n_vars))
         if len(yvnames)>1&(type(yvnames) is list):
             tmp = []
@@ -198,28 +333,6 @@ class LMM(object):
                                re_struct[key]['acov']]
         var_struct['error'] = [error_struct['vcov'].shape,
                                error_struct['acov']]
-        # Get Z and Z otimes Z for each RE
-        Zs = collections.OrderedDict()
-        ZoZ = collections.OrderedDict()
-        for i in range(len(re_struct)):
-            key = list(re_struct)[i]
-            Zs[key] = sps.csc_matrix(Z[:, partitions2[i]:partitions2[i+1]])
-            # This can be time consuming for sufficiently dense Zs
-            ZoZ[key] = sps.csc_matrix(sps.kron(Zs[key], Zs[key]))
-
-        deriv_mats = collections.OrderedDict()
-        for key in var_struct.keys():
-            Sv_shape, Av = var_struct[key]
-            Av_shape = Av.shape
-            Kv = linalg_utils.kronvec_mat(Av_shape, Sv_shape, sparse=True)
-            Ip = sps.csc_matrix(sps.eye(np.product(Sv_shape)))
-            vecAv = sps.csc_matrix(linalg_utils.vecc(Av))
-            D = sps.csc_matrix(Kv.dot(sps.kron(vecAv, Ip)))
-    
-            if key != 'error':
-                D = sps.csc_matrix(ZoZ[key].dot(D))
-            tmp = sps.csc_matrix(linalg_utils.dmat(int(np.sqrt(D.shape[1]))))
-            deriv_mats[key] = D.dot(tmp)
        #if n_vars==1:
        #    bounds = [(0, None) if x == 1 else (None, None) for x in theta]
        #else:
@@ -227,13 +340,21 @@ class LMM(object):
        #    bounds+= [(1, 1) if  x==1 else (0, 0) for x in mv.vech(np.eye(n_vars))]
         bounds = [(0, None) if x == 1 else (None, None) for x in theta]
         self.var_struct = var_struct
-        self.deriv_mats = deriv_mats
         self.bounds = bounds
         self.theta = theta
         self.partitions = np.cumsum(partitions)
-        J = sps.hstack([deriv_mats[key] for key in deriv_mats])
-        self.jac_mats = [J[:, i].reshape(Z.shape[0], Z.shape[0], order='F')
-                         for i in range(J.shape[1])]
+        shapes, indices = collections.OrderedDict(), {}
+        for i, key in enumerate(re_struct.keys()):
+            shapes[key] = (re_struct[key]['n_units'], 
+                           re_struct[key]['cov_re_dims'])
+            indices[key] = np.arange(int(self.partitions[i]), 
+                                     int(self.partitions[i+1]))
+        self.gmats = sparse_utils.BlockDiagonalCovariance(
+            shapes, indices, dict([(key, re_struct[key]['acov']) 
+                                   for key in re_struct.keys()]))
+        for key in re_struct.keys():
+            re_struct[key]['acov_inv'] = self.gmats.acov_inv[key]
+        self.partitions2 = partitions2
 
         if n_vars==1:
             fe_names = fixed_effects.tolist()
@@ -241,22 +362,471 @@ class LMM(object):
             fe_names = [[x+':'+yv for x in fixed_effects.tolist()] for yv in yvar]
             fe_names = [x for y in fe_names for x in y]
         self.X = linalg_utils._check_np(X)
-        self.Z = linalg_utils._check_np(Z)
+        self.Z = Z
         self.y = linalg_utils._check_np(y)
         self.error_struct = error_struct
         self.re_struct = re_struct
-        self.ZoZ = ZoZ
         self.res_names = res_names + fe_names
         self.n_vars = n_vars
-        self.XZY = np.block([X, Z, y])
-        self.XZ = np.block([X, Z])
-        self.A = np.block([[X, Z], [np.zeros((Z.shape[1], X.shape[1])),
-                           np.eye(Z.shape[1])]])
+        self.n_obs = n_obs
+        self._fe_info, self._re_info = fe_info, re_info
+        self._re_levels = re_levels
+        if weights is None:
+            weights = np.ones(n_obs)
+        self._scale_design(weights)
         self._is_multivar = n_vars>1
+        self._setup_mme()
+        self._prof_factor = None
+    
+    def _scale_design(self, weights):
+        '''
+        Forms the rows of [X, Z, y] scaled by the inverse weights, which are
+        all that the mixed model equations depend on, along with the 
+        derivative operators that act on them
+        
+        Parameters
+        ----------
+        weights: array
+            Diagonal of W, where the error covariance is W(I\\otimes\\Sigma)W
+        '''
+        re_struct, partitions2 = self.re_struct, self.partitions2
+        n_vars = self.n_vars
+        self.weights = linalg_utils._check_1d(np.asarray(weights, dtype=float))
+        # The mixed model equations are formed from the rows of [X, Z, y] 
+        # scaled by W^{-1}, so that the error covariance is I\otimes\Sigma
+        Ws = sps.diags(np.repeat(1.0 / self.weights, n_vars))
+        self.XZ = sps.csc_matrix(Ws.dot(sps.hstack([sps.csc_matrix(self.X),
+                                                    self.Z])))
+        self.XZY = sps.csc_matrix(sps.hstack([self.XZ, 
+                                              Ws.dot(sps.csc_matrix(self.y))]))
+        self._yw = Ws.dot(self.y[:, 0])
+        # Derivatives of the (weighted) marginal covariance with respect to
+        # each element of theta
+        deriv_ops = []
+        for i, key in enumerate(re_struct.keys()):
+            k = re_struct[key]['cov_re_dims']
+            off = self.X.shape[1] + partitions2[i]
+            Zi = sps.csc_matrix(self.XZ[:, off:off+partitions2[i+1]
+                                        -partitions2[i]])
+            A = re_struct[key]['acov']
+            A = None if (A - sps.eye(A.shape[0])).nnz==0 else A
+            for r, c in list(zip(*np.triu_indices(k))):
+                deriv_ops.append(VarianceDerivative(Zi, A, k, r, c))
+        for r, c in list(zip(*np.triu_indices(n_vars))):
+            deriv_ops.append(VarianceDerivative(None, None, n_vars, r, c))
+        self.deriv_ops = deriv_ops
+    
+    def _cross_terms(self, W=None):
+        '''
+        Cross products W_{a}'W_{b}+W_{b}'W_{a} of the scaled rows of 
+        [X, Z, y] belonging to each pair of dependent variables
+        '''
+        W = self.XZY if W is None else W
+        m = self.n_vars
+        Wv = [sps.csc_matrix(W[a::m]) for a in range(m)]
+        terms = []
+        for a, b in list(zip(*np.triu_indices(m))):
+            T = Wv[a].T.dot(Wv[b])
+            if a!=b:
+                T = T + T.T
+            terms.append(sps.csc_matrix(T))
+        return terms
+    
+    def update_working(self, y=None, weights=None):
+        '''
+        Replaces the dependent variable and/or the weights in place.  The 
+        model matrices, covariance structures, the sparsity pattern of the
+        mixed model equations and its symbolic factorization are kept, so
+        that only the numeric values of the cross products are recomputed.
+        This is used by iterative schemes such as PQL that repeatedly fit a
+        weighted model to a working response.
+        
+        Parameters
+        ----------
+        y: array, default None
+            New (vectorized) dependent variable 
+        
+        weights: array, default None
+            Diagonal of W, where the error covariance is W(I\\otimes\\Sigma)W
+        '''
+        if y is not None:
+            self.y = linalg_utils._check_np(y).reshape(-1, 1)
+        if weights is None:
+            weights = self.weights
+        self._scale_design(weights)
+        self._mme_terms = np.vstack([sparse_utils.pattern_data(T, 
+                                                              self._mme_pattern)
+                                     for T in self._cross_terms()])
+        if self._prof_factor is not None:
+            self._prof_cross = sps.csc_matrix(self.XZY.T.dot(self.XZY))
+        return self
+    
+    def update(self, new_data, weights=None, acov=None, refit=False, 
+               **fit_kws):
+        '''
+        Appends new rows to the model, adding random effect columns for any
+        levels of the grouping factors not seen before.  The design of the
+        new rows is built from the stored patsy design information, and the 
+        cross products of the mixed model equations are updated by adding
+        those of the new rows to the existing ones.  The sparsity pattern and
+        its symbolic factorization are only recomputed if the new rows 
+        change it.  The starting values for the next fit are set to the 
+        current estimates.
+        
+        Parameters
+        ----------
+        new_data: DataFrame
+            New observations, containing the same variables as the data used
+            to construct the model
+        
+        weights: array, default None
+            Weights of the new observations, which default to one
+        
+        acov: dict, default None
+            Covariance matrices among the levels of the grouping factors,
+            extended to cover the new levels.  Required for factors with a
+            dependence structure that gain new levels
+        
+        refit: bool, default False
+            Whether to refit the model, passing fit_kws to fit
+        '''
+        m, n_fe = self.n_vars, self.X.shape[1]
+        n_new = new_data.shape[0]
+        N_old = self.XZY.shape[1]
+        old_p2 = self.partitions2
+        Xn = patsy.build_design_matrices([self._fe_info], new_data,
+                                         return_type='dataframe')[0].values
+        Zn, Zo, colmap = [], [], [np.arange(n_fe)]
+        shapes = collections.OrderedDict()
+        acov = {} if acov is None else acov
+        for i, key in enumerate(self.re_struct.keys()):
+            re_i = self.re_struct[key]
+            old_levels = self._re_levels[key]
+            levels = np.concatenate([old_levels, np.setdiff1d(
+                    np.unique(new_data[key]), old_levels)])
+            Zij = patsy.build_design_matrices([self._re_info[key]], new_data,
+                                              return_type='dataframe')[0]
+            Zi = sparse_utils.sparse_khatri_rao(new_data[key], Zij.values,
+                                                levels)
+            if m>1:
+                Zi = sps.kron(Zi, sps.eye(m), format='csc')
+            n_units, k = len(levels), re_i['cov_re_dims']
+            A = re_i['acov']
+            if acov.get(key) is not None:
+                A = sps.csc_matrix(acov[key])
+            elif n_units > A.shape[0]:
+                if (A - sps.eye(A.shape[0])).nnz!=0:
+                    raise ValueError("acov must be provided for factor %s, "
+                                     "which has new levels"%key)
+                A = sps.eye(n_units, format='csc')
+            if A.shape[0]!=n_units:
+                raise ValueError("acov for factor %s must be %i by %i"
+                                 %(key, n_units, n_units))
+            # existing columns keep their positions within the block and new
+            # levels are appended to its end
+            Zoi = sps.csc_matrix(self.Z[:, old_p2[i]:old_p2[i+1]])
+            Zoi.resize((Zoi.shape[0], n_units*k))
+            Zo.append(Zoi)
+            Zn.append(Zi)
+            colmap.append(n_fe + sum([Zj.shape[1] for Zj in Zn[:-1]]) 
+                          + np.arange(old_p2[i+1]-old_p2[i]))
+            re_i['n_units'], re_i['acov'] = n_units, A
+            self._re_levels[key] = levels
+            shapes[key] = (n_units, k)
+        Zn = sps.csc_matrix(sps.hstack(Zn))
+        N = n_fe + Zn.shape[1] + 1
+        colmap.append([N-1])
+        colmap = np.concatenate(colmap).astype(int)
+        self.partitions2 = np.cumsum([0]+[n*k for n, k in shapes.values()])
+        self.gmats = sparse_utils.BlockDiagonalCovariance(
+            shapes, self.gmats.indices, dict([(key, self.re_struct[key]['acov'])
+                                              for key in shapes]))
+        for key in shapes.keys():
+            self.re_struct[key]['acov_inv'] = self.gmats.acov_inv[key]
+            self.var_struct[key][1] = self.re_struct[key]['acov']
+        
+        if m==1:
+            yn = new_data[self._yvars].values
+        else:
+            yn = linalg_utils.vecc(new_data[self._yvars].values.T)
+            Xn = np.kron(Xn, np.eye(m))
+        wn = np.ones(n_new) if weights is None else \
+             linalg_utils._check_1d(np.asarray(weights, dtype=float))
+        # cross products of the new rows in the new column layout
+        Ws = sps.diags(np.repeat(1.0 / wn, m))
+        Wn = sps.csc_matrix(Ws.dot(sps.hstack([sps.csc_matrix(Xn), Zn, 
+                                               sps.csc_matrix(yn)])))
+        new_terms = self._cross_terms(Wn)
+        # existing cross products, reindexed to the new column layout
+        P = sps.coo_matrix(self._mme_pattern)
+        old_terms = [sps.csc_matrix((t, (colmap[P.row], colmap[P.col])),
+                                    shape=(N, N)) for t in self._mme_terms]
+        terms = [To + Tn for To, Tn in zip(old_terms, new_terms)]
+        
+        self.X = np.vstack([self.X, Xn])
+        self.Z = sps.csc_matrix(sps.vstack([sps.hstack(Zo), Zn]))
+        self.y = np.vstack([self.y, yn.reshape(-1, 1)])
+        self.n_obs = self.n_obs + n_new
+        self.error_struct['acov'] = sps.eye(self.n_obs, format='csc')
+        self.var_struct['error'][1] = self.error_struct['acov']
+        self._scale_design(np.concatenate([self.weights, wn]))
+        if N==N_old:
+            pattern = self._mme_pattern
+            union = abs(pattern)
+            for T in new_terms:
+                union = union + abs(T)
+            same = sps.csc_matrix(union).nnz==pattern.nnz
+        else:
+            same = False
+        if same:
+            self._mme_terms = np.vstack([sparse_utils.pattern_data(T, pattern)
+                                         for T in terms])
+        else:
+            self._setup_mme(terms)
+        if hasattr(self, 'params'):
+            self.theta = self.params.copy()
+            prof_start = getattr(self.optimizer, 'x_profiled', None)
+        else:
+            prof_start = None
+        if self._prof_factor is not None:
+            self._setup_profiled()
+            if prof_start is not None:
+                self._prof_factor.theta0 = prof_start
+        if refit:
+            self.fit(**fit_kws)
+        return self
+        
+    def _setup_mme(self, terms=None):
+        '''
+        Precomputes the fixed sparsity pattern of the augmented mixed model
+        equations
+        
+        M = [X, Z, y]'R^{-1}[X, Z, y] + blockdiag(0, G^{-1}, 0)
+        
+        together with its fill reducing ordering and symbolic factorization.
+        Because R^{-1}=I\\otimes\\Sigma^{-1}, the first term is a linear
+        combination of the cross products of the rows of [X, Z, y]
+        corresponding to each pair of dependent variables, so only the
+        coefficients and the entries of G^{-1} change with theta.
+        
+        Parameters
+        ----------
+        terms: list, default None
+            Precomputed cross products, as returned by _cross_terms
+        '''
+        n_fe, N = self.X.shape[1], self.XZY.shape[1]
+        if terms is None:
+            terms = self._cross_terms()
+        Ginv = sps.coo_matrix(self.gmats.Ginv)
+        Gp = sps.csc_matrix((np.arange(1, Ginv.nnz+1, dtype=float), 
+                             (Ginv.row+n_fe, Ginv.col+n_fe)), shape=(N, N))
+        # the row and column of y are kept dense so that the pattern does not
+        # depend on the values of the dependent variable
+        yrow = sps.csc_matrix((np.ones(2*N), (np.r_[np.arange(N), [N-1]*N],
+                                              np.r_[[N-1]*N, np.arange(N)])),
+                              shape=(N, N))
+        pattern = abs(Gp) + sps.eye(N) + yrow
+        for T in terms:
+            pattern = pattern + abs(T)
+        pattern = sps.csc_matrix(pattern)
+        pattern.sort_indices()
+        pattern.data[:] = 1.0
+        mme_terms = np.vstack([sparse_utils.pattern_data(T, pattern) 
+                               for T in terms])
+        # location of each entry of Ginv.data in the MME data
+        pos = sparse_utils.pattern_data(Gp, pattern)
+        ix = np.nonzero(pos)[0]
+        ginv_mpos = np.zeros(Ginv.nnz, dtype=int)
+        ginv_mpos[np.round(pos[ix]).astype(int) - 1] = ix
+        ginv_pos, ginv_vals = [], []
+        for key in self.re_struct.keys():
+            ginv_pos.append(ginv_mpos[self.gmats._ginvpos[key]])
+            ginv_vals.append(self.gmats._ainvvals[key])
+        perm = sparse_utils.fill_reducing_ordering(pattern[:-1, :-1])
+        perm = np.concatenate([perm, [N-1]])
+        self._mme_pattern = pattern
+        self._mme_terms = mme_terms
+        self._ginv_mpos = ginv_mpos
+        self._ginv_pos = ginv_pos
+        self._ginv_vals = ginv_vals
+        self._mme_chol = sparse_utils.SparseCholesky(pattern, perm=perm)
+    
+    def _mme_data(self, theta):
+        '''
+        Values of the augmented mixed model equations matrix, ordered 
+        according to the sparsity pattern computed in _setup_mme
+        
+        Parameters
+        ----------
+        theta: array
+            vector of parameters
+        '''
+        partitions = self.partitions
+        p1, p2 = int(partitions[-2]), int(partitions[-1])
+        Sinv = np.linalg.inv(linalg_utils.invech(theta[p1:p2]))
+        data = Sinv[np.triu_indices(self.n_vars)].dot(self._mme_terms)
+        data[self._ginv_mpos] += self.gmats.update(theta).Ginv.data
+        return data
+
+    def _check_profiled(self):
+        '''
+        Raises a ValueError unless the model is univariate with independent
+        units (identity acov) for every grouping factor, the cases in which
+        the residual variance can be profiled out of the likelihood
+        '''
+        if self.n_vars>1:
+            raise ValueError("method='profiled' is only available for "
+                             "univariate models")
+        for key in self.re_struct.keys():
+            A = self.re_struct[key]['acov']
+            if (A - sps.eye(A.shape[0])).nnz!=0:
+                raise ValueError("method='profiled' requires independent "
+                                 "units (identity acov) for grouping factor "
+                                 "%s"%key)
+
+    def _setup_profiled(self):
+        '''
+        Precomputes the structures used by the profiled likelihood.  With
+        G=\\sigma^{2}diag(I\\otimes\\Lambda_{i}\\Lambda_{i}') and
+        R=\\sigma^{2}I, the augmented mixed model equations multiplied by
+        \\sigma^{2} and transformed to the spherical random effects are
+
+        M^{*} = T'[X, Z, y]'[X, Z, y]T + diag(0, I, 0)
+
+        with T=diag(I, I\\otimes\\Lambda_{i}, 1), so only the congruence by T
+        changes with the parameters.  The pattern of M is filled in over the
+        random effect blocks so that it is preserved by T.
+        '''
+        self._check_profiled()
+        n_fe, N = self.X.shape[1], self.XZY.shape[1]
+        shapes, indices = collections.OrderedDict(), {}
+        for i, key in enumerate(self.re_struct.keys()):
+            shapes[key] = self.gmats.shapes[key]
+            indices[key] = np.arange(int(self.partitions[i]),
+                                     int(self.partitions[i+1]))
+        # the diagonal of each factor is kept slightly away from zero so
+        # that the fitted covariances remain invertible
+        factor = sparse_utils.RelativeCovarianceFactor(shapes, indices,
+                                                       n_fe, 1, lower=1e-4)
+        pattern = sparse_utils.block_closure(self._mme_pattern, factor.start,
+                                             factor.size)
+        perm = sparse_utils.fill_reducing_ordering(pattern[:-1, :-1])
+        perm = np.concatenate([perm, [N-1]])
+        D = np.zeros(N)
+        D[n_fe:N-1] = 1.0
+        self._prof_pattern = pattern
+        self._prof_cross = sps.csc_matrix(self.XZY.T.dot(self.XZY))
+        self._prof_diag = sparse_utils.pattern_data(sps.diags(D), pattern)
+        self._prof_chol = sparse_utils.SparseCholesky(pattern, perm=perm)
+        self._prof_factor = factor
+
+    def _profiled_data(self, theta):
+        '''
+        Values of M^{*} ordered according to the profiled sparsity pattern
+
+        Parameters
+        ----------
+        theta: array
+            vector of relative covariance factor parameters
+        '''
+        if self._prof_factor is None:
+            self._setup_profiled()
+        T = self._prof_factor.update(theta).T
+        M = sps.csc_matrix(T.T.dot(self._prof_cross).dot(T))
+        M.sort_indices()
+        P = self._prof_pattern
+        if (M.nnz==P.nnz) and np.array_equal(M.indices, P.indices):
+            data = M.data
+        else:
+            data = sparse_utils.pattern_data(M, P)
+        return data + self._prof_diag
+
+    def loglike_profiled(self, theta):
+        '''
+        Minus two times the restricted log likelihood with the residual
+        variance profiled out, as a function of the entries of the lower
+        triangular relative covariance factors \\Lambda_{i}, ordered as
+        vech(V_{i}).  With r^{2} the penalized residual sum of squares and
+        p the number of fixed effects
+
+        \\mathcal{L} = log|C^{*}| + (n-p)(1+log(r^{2}/(n-p)))
+
+        which equals loglike at V_{i}=\\sigma^{2}\\Lambda_{i}\\Lambda_{i}' and
+        the residual variance \\sigma^{2}=r^{2}/(n-p).
+
+        Parameters
+        ---------
+        theta: array
+            vector of relative covariance factor parameters
+        '''
+        theta = linalg_utils._check_1d(theta)
+        try:
+            L = self._prof_chol_factor(theta)
+        except np.linalg.LinAlgError:
+            return np.inf
+        nu = self.n_obs - self.X.shape[1]
+        r2 = L.diagonal()[-1]**2
+        LL = L.logdet(L.n-1) + nu * (1.0 + np.log(r2 / nu))
+        return LL
+
+    def _prof_chol_factor(self, theta):
+        '''
+        Factors M^{*} at theta and returns the cholesky factor
+        '''
+        data = self._profiled_data(theta)
+        return self._prof_chol.factor(data)
+
+    def gradient_profiled(self, theta):
+        '''
+        Gradient of loglike_profiled.  Writing K=[X, Z]'[X, Z], the
+        derivative of log|C^{*}| with respect to the entries of T is
+        2KTC^{*-1}, which within the diagonal blocks of T only requires the
+        entries of C^{*-1} on the sparsity pattern.  The penalized residual
+        sum of squares is minimized over the effects, so its derivative is
+        -2Z'e v' where e is the residual and v the spherical random effects.
+
+        Parameters
+        ----------
+        theta: array
+            vector of relative covariance factor parameters
+        '''
+        theta = linalg_utils._check_1d(theta)
+        L = self._prof_chol_factor(theta)
+        factor = self._prof_factor
+        N, n_fe = L.n, self.X.shape[1]
+        nu = self.n_obs - n_fe
+        r2 = L.diagonal()[-1]**2
+        P = self._prof_pattern
+        Cinv = sps.csc_matrix((L.sparse_inverse(N-1), P.indices, P.indptr),
+                              shape=P.shape)
+        T = factor.T
+        KT = sps.csr_matrix(self._prof_cross.dot(T)[:-1, :-1])
+        coefs = self._mme_coefs(L)
+        e = self._yw - self.XZ.dot(T[:-1, :-1].dot(coefs))
+        Zte = self.XZ.T.dot(e)
+        start, size = factor.start[:-1], factor.size[:-1]
+        D = np.zeros((N-1, np.max(size)))
+        for d in range(D.shape[1]):
+            ix = np.nonzero(size > d)[0]
+            ix = ix[ix>=n_fe]
+            jx = start[ix] + d
+            tr = np.asarray(KT[ix].multiply(Cinv[:-1, jx].T).sum(axis=1))
+            D[ix, d] = 2.0 * tr[:, 0] - 2.0 * nu / r2 * Zte[ix] * coefs[jx]
+        return factor.collect(D)
+
+    def _profiled_to_theta(self, theta):
+        '''
+        Converts relative covariance factor parameters to the parameters
+        used by loglike, [vech(V_{1}),...,vech(V_{r}), \\sigma^{2}]
+        '''
+        L = self._prof_chol_factor(linalg_utils._check_1d(theta))
+        s2 = L.diagonal()[-1]**2 / (self.n_obs - self.X.shape[1])
+        params = self._prof_factor.covariance_params(theta, s2)
+        return np.concatenate([params, [s2]])
 
     def params2mats(self, theta=None):
         '''
-        Create variance matrices from parameter vector
+        Create (sparse) variance matrices from parameter vector
         Parameters
         ------------
         theta: array
@@ -268,19 +838,18 @@ class LMM(object):
         error_struct = self.error_struct
         re_struct = self.re_struct
 
-        Glist, Ginvlist, SigA = [], [], []
-        for i, key in enumerate(re_struct.keys()):
-            a, b = int(partitions[i]), int(partitions[i+1])
-            Vi = linalg_utils.invech(theta[a:b])
-            Ai = re_struct[key]['acov']
-            Glist.append(np.kron(Ai, Vi))
-            Ginvlist.append(np.kron(Ai, np.linalg.pinv(Vi)))
-            SigA.append(Vi)
+        gmats = self.gmats.update(theta)
+        SigA = [gmats.V[key] for key in re_struct.keys()]
         p1, p2 = int(partitions[-2]), int(partitions[-1])
         Verr = linalg_utils.invech(theta[p1:p2])
-        R = np.kron(Verr, error_struct['acov'])
-        Rinv = np.kron(error_struct['acov'], np.linalg.inv(Verr))
-        G, Ginv = sp.linalg.block_diag(*Glist), sp.linalg.block_diag(*Ginvlist)
+        R = sps.kron(error_struct['acov'], Verr, format='csc')
+        Rinv = sps.kron(error_struct['acov'], np.linalg.inv(Verr), 
+                        format='csc')
+        Wd = sps.diags(np.repeat(self.weights, self.n_vars))
+        Wdinv = sps.diags(np.repeat(1.0 / self.weights, self.n_vars))
+        R = sps.csc_matrix(Wd.dot(R).dot(Wd))
+        Rinv = sps.csc_matrix(Wdinv.dot(Rinv).dot(Wdinv))
+        G, Ginv = gmats.G.copy(), gmats.Ginv.copy()
 
         SigE = Verr.copy()
         return G, Ginv, SigA, R, Rinv, SigE
@@ -290,100 +859,261 @@ class LMM(object):
         Mixed Model Equation Coefficient(MMEC) matrix construction
         Parameters
         ------------
-        Rinv: array
+        Rinv: sparse matrix
           Inverse error covariance
-        Ginv:
+        Ginv: sparse matrix
           Inverse random effect covariance
         '''
-        F = self.XZ
-        C = F.T.dot(Rinv).dot(F)
+        F = sps.csc_matrix(sps.hstack([sps.csc_matrix(self.X), self.Z]))
         k = Ginv.shape[0]
-        C[-k:, -k:] += Ginv
-        return C
+        C = F.T.dot(Rinv).dot(F)
+        C = C + sps.block_diag([sps.csc_matrix((F.shape[1]-k, F.shape[1]-k)),
+                                Ginv])
+        return sps.csc_matrix(C)
 
     def mme_aug(self, Rinv, Ginv, C=None):
         '''
         Augmented Mixed Model Equation Coefficient matrix construction
         Parameters
         ------------
-        Rinv: array
+        Rinv: sparse matrix
           Inverse error covariance
-        Ginv: array
+        Ginv: sparse matrix
           Inverse random effect covariance
-        C: array
+        C: sparse matrix
           MMEC coefficient matrix
 
         '''
         if C is None:
             C = self.mmec(Rinv, Ginv)
-        XZ, y = self.XZ, self.y
-        t = y.T.dot(Rinv)
-        b = t.dot(XZ)
-        yRy = linalg_utils._check_np(t).dot(y)
-        M = np.block([[C, b.T], [b, yRy]])
+        XZ = sps.csc_matrix(sps.hstack([sps.csc_matrix(self.X), self.Z]))
+        y = self.y
+        t = Rinv.dot(y).T
+        b = sps.csc_matrix(XZ.T.dot(t.T).T)
+        yRy = t.dot(y)
+        M = sps.bmat([[C, b.T], [b, yRy]], format='csc')
         return M
 
     def loglike(self, theta):
         '''
-        Minus two times the restricted log likelihood
+        Minus two times the restricted log likelihood, computed from the 
+        sparse cholesky factorization of the augmented mixed model equations
+        
         Parameters
         ---------
         theta: array
             vector of parameters
         '''
         theta = linalg_utils._check_1d(theta)
-        G, Ginv, SigA, R, Rinv, SigE = self.params2mats(theta)
-        re_struct, error_struct = self.re_struct, self.error_struct
-        C = self.mmec(Rinv, Ginv)
-        M = self.mme_aug(Rinv, Ginv, C=C)
-        L = linalg_utils.chol(M)
-        logdetC = 2*np.sum(np.log(np.diag(L)[:-1]))
-        yPy = L[-1, -1]**2
-        logdetG = 0.0
-        # This needs to be fixed for the more general case
-        for key, Vi in list(zip(re_struct.keys(), SigA)):
-            logdetG += re_struct[key]['n_units']*np.linalg.slogdet(Vi)[1]
-        logdetR = error_struct['acov'].shape[0]*np.linalg.slogdet(SigE)[1]
+        partitions, re_struct = self.partitions, self.re_struct
+        try:
+            L = self._mme_chol.factor(self._mme_data(theta))
+        except np.linalg.LinAlgError:
+            return np.inf
+        N = self._mme_chol.n
+        logdetC = L.logdet(N-1)
+        yPy = L.diagonal()[-1]**2
+        logdetG = self.gmats.logdet()
+        if not np.isfinite(logdetG):
+            return np.inf
+        p1, p2 = int(partitions[-2]), int(partitions[-1])
+        SigE = linalg_utils.invech(theta[p1:p2])
+        logdetR = self.n_obs*np.linalg.slogdet(SigE)[1]
         LL = logdetR+logdetC + logdetG + yPy
         return LL
 
-    def fit(self, optimizer_kwargs={}, optimizer_options=None,
-            maxiter=100, verbose=2, hess_opt=False):
-        if optimizer_options is None:
-            optimizer_options = {'verbose': verbose, 'maxiter': maxiter}
-        if hess_opt is False:
-            res = sp.optimize.minimize(self.loglike, self.theta,
-                                       bounds=self.bounds,
+    def _compute_effects(self, theta=None):
+        '''
+        Fixed and random effect estimates, and the standard errors of the
+        fixed effects, from the sparse mixed model equations
+        '''
+        if theta is None:
+            theta = self.params
+        L = self._mme_chol.factor(self._mme_data(theta))
+        N, n_fe = L.n, self.X.shape[1]
+        coefs = self._mme_coefs()
+        E = np.zeros((N, n_fe))
+        E[:n_fe] = np.eye(n_fe)
+        XtVX_inv = L.solve(E, n=N-1)[:n_fe]
+        self.b = coefs[:n_fe, None]
+        self.u = coefs[n_fe:, None]
+        self.SE_b = np.sqrt(np.diag(XtVX_inv))
+        self.r = self.y - self.X.dot(self.b)
+    
+    def _working_variates(self, theta):
+        '''
+        The working variates (\\partial V/\\partial\\theta_{i})Py, computed
+        from the current factorization of the mixed model equations using
+        Py = R^{-1}(y - Xb - Zu)
+        '''
+        partitions, m = self.partitions, self.n_vars
+        coefs = self._mme_coefs()
+        p1, p2 = int(partitions[-2]), int(partitions[-1])
+        Sinv = np.linalg.inv(linalg_utils.invech(theta[p1:p2]))
+        Py = (self._yw - self.XZ.dot(coefs)).reshape(-1, m).dot(Sinv)
+        Py = Py.reshape(-1)
+        F = np.vstack([op.dot(Py) for op in self.deriv_ops]).T
+        return F
+        
+    def average_information(self, theta):
+        '''
+        Average information matrix of minus two times the restricted log 
+        likelihood
+        
+        AI_{ij} = y'P(\\partial V_{i})P(\\partial V_{j})Py
+        
+        computed from one mixed model equation solve per working variate
+        
+        Parameters
+        ----------
+        theta: array
+          Vector of parameters
+
+        Returns
+        --------
+        AI: array
+          Average information matrix
+        '''
+        theta = linalg_utils._check_1d(theta)
+        partitions, m = self.partitions, self.n_vars
+        L = self._mme_chol.factor(self._mme_data(theta))
+        N = L.n
+        F = self._working_variates(theta)
+        p1, p2 = int(partitions[-2]), int(partitions[-1])
+        Sinv = np.linalg.inv(linalg_utils.invech(theta[p1:p2]))
+        q = F.shape[1]
+        RF = np.einsum('iaq,ab->ibq', F.reshape(-1, m, q), Sinv)
+        RF = RF.reshape(-1, q)
+        WRF = self.XZ.T.dot(RF)
+        sol = L.solve(np.vstack([WRF, np.zeros((1, q))]), n=N-1)[:-1]
+        AI = F.T.dot(RF) - WRF.T.dot(sol)
+        AI = (AI + AI.T) / 2.0
+        return AI
+    
+    def _fit_ai(self, maxiter=100, tol=1e-8, verbose=0, n_halvings=20):
+        '''
+        Average information REML; Newton steps using the average 
+        information matrix, with step halving and projection onto the 
+        bounds.  Parameters with equal upper and lower bounds are held fixed.
+        '''
+        lb = np.array([-np.inf if x[0] is None else x[0] for x in self.bounds])
+        ub = np.array([np.inf if x[1] is None else x[1] for x in self.bounds])
+        free = lb!=ub
+        theta = np.clip(self.theta.copy(), lb, ub)
+        ll = self.loglike(theta)
+        fit_hist, converged = [], False
+        for i in range(maxiter):
+            t_start = time.time()
+            g = self.gradient(theta)[free]
+            AI = self.average_information(theta)
+            H = AI[np.ix_(free, free)]
+            try:
+                step = np.linalg.solve(H, g)
+            except np.linalg.LinAlgError:
+                step = np.linalg.lstsq(H, g, rcond=None)[0]
+            decrement = g.dot(step)
+            alpha, theta_new, ll_new = 1.0, theta, ll
+            for j in range(n_halvings):
+                theta_new = theta.copy()
+                theta_new[free] = theta[free] - alpha * step
+                theta_new = np.clip(theta_new, lb, ub)
+                ll_new = self.loglike(theta_new)
+                if ll_new <= ll + 1e-12 * (1.0 + np.abs(ll)):
+                    break
+                alpha /= 2.0
+            else:
+                theta_new, ll_new = theta, ll
+            dtheta = np.max(np.abs(theta_new - theta))
+            fit_hist.append([ll_new, np.linalg.norm(g), decrement, alpha,
+                             dtheta, time.time() - t_start])
+            if verbose:
+                print("iter %i: -2LL=%.6f gnorm=%.3e decrement=%.3e "
+                      "step=%.3f time=%.3fs"%(i, ll_new, np.linalg.norm(g),
+                                              decrement, alpha, 
+                                              fit_hist[-1][-1]))
+            theta, ll = theta_new, ll_new
+            if (np.abs(decrement) < tol) or (dtheta < tol):
+                converged = True
+                break
+        self.fit_hist = pd.DataFrame(fit_hist, columns=['loglike', 'gnorm', 
+                                                        'decrement',
+                                                        'step_size',
+                                                        'max_change', 'time'])
+        AI = self.average_information(theta)
+        res = sp.optimize.OptimizeResult(x=theta, fun=ll, success=converged,
+                                         nit=len(fit_hist), hess=AI,
+                                         jac=self.gradient(theta),
+                                         message='converged' if converged 
+                                         else 'maximum iterations reached')
+        return res
+    
+    def _fit(self, optimizer_kwargs={}, optimizer_options=None, maxiter=100,
+             verbose=2, hess_opt=False, method='trust-constr', tol=1e-8):
+        if method=='ai':
+            res = self._fit_ai(maxiter=maxiter, tol=tol, verbose=verbose)
+        elif method=='profiled':
+            if self._prof_factor is None:
+                self._setup_profiled()
+            if optimizer_options is None:
+                optimizer_options = {'maxiter': maxiter, 'gtol': tol}
+            factor = self._prof_factor
+            res = sp.optimize.minimize(self.loglike_profiled, factor.theta0,
+                                       bounds=factor.bounds,
                                        options=optimizer_options,
-                                       method='trust-constr',
-                                       jac=self.gradient,
+                                       method='L-BFGS-B',
+                                       jac=self.gradient_profiled,
                                        **optimizer_kwargs)
+            res.x_profiled = res.x
+            res.x = self._profiled_to_theta(res.x)
         else:
-            res = sp.optimize.minimize(self.loglike, self.theta,
-                                       bounds=self.bounds,
-                                       options=optimizer_options,
-                                       method='trust-constr',
-                                       jac=self.gradient,
-                                       hess=self.hessian,
-                                       **optimizer_kwargs)
-
+            if optimizer_options is None:
+                optimizer_options = {'verbose': verbose, 'maxiter': maxiter}
+            if hess_opt is False:
+                res = sp.optimize.minimize(self.loglike, self.theta,
+                                           bounds=self.bounds,
+                                           options=optimizer_options,
+                                           method='trust-constr',
+                                           jac=self.gradient,
+                                           **optimizer_kwargs)
+            else:
+                res = sp.optimize.minimize(self.loglike, self.theta,
+                                           bounds=self.bounds,
+                                           options=optimizer_options,
+                                           method='trust-constr',
+                                           jac=self.gradient,
+                                           hess=self.hessian,
+                                           **optimizer_kwargs)
         self.params = res.x
+        self.optimizer = res
         G, Ginv, SigA, R, Rinv, SigE = self.params2mats(res.x)
         self.G, self.Ginv, self.R, self.Rinv = G, Ginv, R, Rinv
         self.SigA, self.SigE = SigA, SigE
-        W = linalg_utils.woodbury_inversion(self.Z, C=G, A=R)
+        self._compute_effects(self.params)
+        return res
+    
+    def _summarize(self, hessian_est=None, se_method='ai'):
+        '''
+        Standard errors, fit statistics and the summary table at the 
+        estimates.  Unless hessian_est is given, the standard errors of the
+        variance parameters are taken from the average information matrix 
+        (se_method='ai'), which needs q mixed model equation solves, or 
+        from the observed hessian (se_method='hessian'), which forms dense 
+        n by n matrices and is limited to hessian_max_obs observations
+        '''
+        if hessian_est is None:
+            if se_method=='ai':
+                hessian_est = self.average_information(self.params)
+            elif se_method=='hessian':
+                hessian_est = self.hessian(self.params)
+            else:
+                raise ValueError("se_method must be one of 'ai' or "
+                                 "'hessian'")
         X = self.X
-        XtW = X.T.dot(W)
-        self.optimizer = res
-        self.hessian_est = self.hessian(self.params)
+        self.hessian_est = hessian_est
         self.hessian_inv = np.linalg.pinv(self.hessian_est)
         self.SE_theta = np.sqrt(np.diag(self.hessian_inv))
         self.grd = self.gradient(self.params)
         self.gnorm = np.linalg.norm(self.grd) / len(self.params)
-        self.b = linalg_utils.einv(XtW.dot(X)).dot(XtW.dot(self.y))
-        self.SE_b = np.sqrt(np.diag(linalg_utils.einv(XtW.dot(X))))
-        self.r = self.y - self.X.dot(self.b)
-        self.u = G.dot(self.Z.T.dot(W).dot(self.r))
         res = pd.DataFrame(np.concatenate([self.params[:, None], self.b]),
                            columns=['Parameter Estimate'])
         res['Standard Error'] = np.concatenate([self.SE_theta, self.SE_b])
@@ -409,6 +1139,155 @@ class LMM(object):
                                                            'FixedEffectsR2',
                                                            'RandomEffectsR2', 
                                                            'R2'])
+    
+    def fit(self, optimizer_kwargs={}, optimizer_options=None,
+            maxiter=100, verbose=2, hess_opt=False, method='trust-constr',
+            tol=1e-8, se_method='ai'):
+        '''
+        Fit the model by restricted maximum likelihood
+        
+        Parameters
+        ----------
+        hess_opt: bool, default False
+            Whether trust-constr uses the observed hessian, which forms 
+            dense n by n matrices and is limited to hessian_max_obs 
+            observations
+        
+        method: str, default 'trust-constr'
+            One of 'trust-constr', in which case scipy's trust region 
+            optimizer is used, or 'ai' for average information REML.  With 
+            'ai' the per iteration history (including timing) is stored in
+            fit_hist, and the average information matrix is used in place 
+            of the hessian for the standard errors of the variance parameters
+            'profiled' concentrates the residual variance out of the 
+            likelihood and optimizes over the lower triangular relative
+            covariance factors of the random effects with L-BFGS-B 
+            (univariate models with independent units only; a ValueError 
+            is raised otherwise, before any fitting)
+        
+        tol: float, default 1e-8
+            Convergence tolerance for the Newton decrement and maximum change
+            in the parameters when method='ai'
+        
+        se_method: str, default 'ai'
+            Standard errors of the variance parameters from the average 
+            information matrix ('ai'), at the cost of one mixed model 
+            equation solve per parameter, or from the observed hessian 
+            ('hessian'), which forms dense n by n matrices and so is 
+            limited to hessian_max_obs observations (5000 by default)
+        '''
+        if se_method not in ['ai', 'hessian']:
+            raise ValueError("se_method must be one of 'ai' or 'hessian'")
+        if method=='profiled':
+            self._check_profiled()
+        res = self._fit(optimizer_kwargs=optimizer_kwargs,
+                        optimizer_options=optimizer_options, maxiter=maxiter,
+                        verbose=verbose, hess_opt=hess_opt, method=method,
+                        tol=tol)
+        if (method=='ai') and (se_method=='ai'):
+            self._summarize(res.hess)
+        else:
+            self._summarize(se_method=se_method)
+        
+    def bootstrap(self, n_boot=1000, n_jobs=1, seed=None, alpha=0.05, 
+                  method='ai', maxiter=100, tol=1e-8):
+        '''
+        Parametric bootstrap of the variance parameters and fixed effects.
+        Responses are simulated from the fitted model and refit, reusing the 
+        sparsity pattern and symbolic factorization of the mixed model 
+        equations.  Replicates run in a pool of n_jobs processes, which 
+        attach to the design matrices through shared memory, and each 
+        replicate draws from its own stream spawned from 
+        numpy.random.SeedSequence(seed), so that the results do not depend
+        on n_jobs.  
+        
+        Parameters
+        ----------
+        n_boot: int, default 1000
+            Number of bootstrap replicates
+        
+        n_jobs: int, default 1
+            Number of worker processes; with n_jobs=1 the replicates are run
+            in the current process
+        
+        seed: int or SeedSequence, default None
+            Entropy for the random streams
+        
+        alpha: float, default 0.05
+            The percentile intervals have coverage 1-alpha
+        
+        method: str, default 'ai'
+            Method used to refit each replicate (see fit)
+        
+        Returns
+        -------
+        boot_res: DataFrame
+            Estimates, bootstrap standard errors and percentile intervals, 
+            also stored as self.boot_res, while the replicates are stored in
+            self.boot_samples
+        '''
+        if not hasattr(self, 'params'):
+            raise ValueError("The model must be fit before bootstrapping")
+        if method=='profiled':
+            self._check_profiled()
+        theta = self.params
+        gmats = self.gmats.update(theta)
+        chol = []
+        for key in self.re_struct.keys():
+            A = self.re_struct[key]['acov']
+            if (A - sps.eye(A.shape[0])).nnz==0:
+                LA = sps.eye(A.shape[0], format='csc')
+            else:
+                LA = np.linalg.cholesky(A.toarray())
+            chol.append((LA, np.linalg.cholesky(gmats.V[key] + np.eye(
+                    gmats.V[key].shape[0]) * 1e-12)))
+        p1, p2 = int(self.partitions[-2]), int(self.partitions[-1])
+        chol_err = np.linalg.cholesky(linalg_utils.invech(theta[p1:p2]))
+        
+        Z = sps.csc_matrix(self.Z)
+        arrays = {'X': np.asarray(self.X, dtype=float), 'Z_data': Z.data,
+                  'Z_indices': Z.indices, 'Z_indptr': Z.indptr,
+                  'mu': self.X.dot(self.b).reshape(-1)}
+        exclude = ['X', 'Z', 'y', 'XZ', 'XZY', '_yw', 'deriv_ops', 'u', 'r',
+                   'G', 'Ginv', 'R', 'Rinv', '_fe_info', '_re_info', 'res',
+                   'fit_hist', 'hessian_est', 'hessian_inv', 'optimizer',
+                   'boot_samples', 'boot_res']
+        state = dict([(k, v) for k, v in self.__dict__.items() 
+                      if k not in exclude])
+        state.update(_Z_shape=Z.shape, _boot_chol=chol, 
+                     _boot_chol_err=chol_err, _boot_theta=theta.copy(),
+                     _boot_fit_kws={'method': method, 'maxiter': maxiter, 
+                                    'tol': tol})
+        seeds = np.random.SeedSequence(seed).spawn(n_boot)
+        blocks, specs = base_utils.share_arrays(arrays)
+        try:
+            if n_jobs==1:
+                _bootstrap_init(type(self), state, specs)
+                out = [_bootstrap_replicate(ss) for ss in seeds]
+            else:
+                chunksize = max(1, n_boot // (4 * n_jobs))
+                with concurrent.futures.ProcessPoolExecutor(
+                        max_workers=n_jobs, initializer=_bootstrap_init, 
+                        initargs=(type(self), state, specs)) as pool:
+                    out = list(pool.map(_bootstrap_replicate, seeds,
+                                        chunksize=chunksize))
+        finally:
+            _BOOT_STATE.clear()
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+        samples = np.vstack([x for x, _ in out])
+        self.boot_converged = np.array([c for _, c in out])
+        self.boot_samples = pd.DataFrame(samples, columns=self.res_names)
+        est = np.concatenate([theta, self.b[:, 0]])
+        q = np.percentile(samples, [100*alpha/2, 100*(1-alpha/2)], axis=0)
+        boot_res = pd.DataFrame(est, index=self.res_names,
+                                columns=['Parameter Estimate'])
+        boot_res['Bootstrap SE'] = samples.std(axis=0, ddof=1)
+        boot_res['%g%%'%(100*alpha/2)] = q[0]
+        boot_res['%g%%'%(100*(1-alpha/2))] = q[1]
+        self.boot_res = boot_res
+        return boot_res
         
     def predict(self, X=None, Z=None):
         '''
@@ -421,13 +1300,34 @@ class LMM(object):
             Z = self.Z
         return X.dot(self.b)+Z.dot(self.u)
 
+    def _mme_coefs(self, chol=None):
+        '''
+        Solution [b, u] of the mixed model equations from the current
+        factorization of the augmented MME matrix M.  The last column of
+        M^{-1} is proportional to [-C^{-1}X'R^{-1}y, 1], so a single solve
+        suffices
+        '''
+        chol = self._mme_chol if chol is None else chol
+        N = chol.n
+        e = np.zeros(N)
+        e[-1] = 1.0
+        z = chol.solve(e)
+        return -z[:-1] / z[-1]
+    
     def gradient(self, theta):
         '''
-        The gradient of minus two times the restricted log likelihood.  This is
-        equal to
-
-        \\partial\\mathcal{L}=vec(Py)'\\partial V-(vec(Py)\\otimes
-                              vec(Py))'\\partial V
+        The gradient of minus two times the restricted log likelihood, 
+        computed without forming the n by n projection matrix P.  For the
+        covariance V_{i} of the random effects of grouping factor i
+        
+        \\partial\\mathcal{L}/\\partial V_{i} = n_{i}V_{i}^{-1}-V_{i}^{-1}
+                     (S_{i}+U_{i}'A_{i}^{-1}U_{i})V_{i}^{-1}
+        
+        where S_{i}=\\sum_{ab}(A_{i}^{-1})_{ab}C^{ab}, the trace term 
+        tr(G^{-1}C^{ZZ}) arranged by block, and U_{i} is the matrix of random 
+        effect estimates.  The error covariance is handled analogously with
+        tr(C^{-1}W_{a}'W_{b}) and the residual cross products.  Only the 
+        entries of C^{-1} on the sparsity pattern of the MME are needed.
 
         Parameters
         ----------
@@ -441,37 +1341,62 @@ class LMM(object):
 
         '''
         theta = linalg_utils._check_1d(theta)
-        G, Ginv, SigA, R, Rinv, SigE = self.params2mats(theta)
-        deriv_mats = self.deriv_mats
-        X, Z, y = self.X, self.Z, self.y
-        W = linalg_utils.woodbury_inversion(Z, Cinv=Ginv, Ainv=Rinv) 
-        XtW = X.T.dot(W)
-        XtWX_inv = linalg_utils.einv(XtW.dot(X))
-        P = W - XtW.T.dot(XtWX_inv).dot(XtW)
-        dP = P.reshape(np.product(P.shape), 1, order='F')
-        Py = P.dot(y)
-        PyPy = np.kron(Py, Py)
-        # PyPy = vec(_check_2d(Py).dot(_check_2d(Py).T))[:, None] effecient
-        # only at large heterogenous n
+        partitions, re_struct = self.partitions, self.re_struct
+        try:
+            L = self._mme_chol.factor(self._mme_data(theta))
+        except np.linalg.LinAlgError:
+            # loglike is infinite at a theta for which the mixed model
+            # equations are not positive definite, so the step is rejected;
+            # the gradient must still be finite, as a nan leaves
+            # trust-constr unable to recover from the rejected step
+            return np.zeros(len(theta))
+        N, n_fe, m = L.n, self.X.shape[1], self.n_vars
+        coefs = self._mme_coefs()
+        Cinv = L.sparse_inverse(N-1)
         g = []
-        for key in deriv_mats.keys():
-            JF_Omega = deriv_mats[key]
-            g_i = JF_Omega.T.dot(dP) - JF_Omega.T.dot(PyPy)
-            g.append(g_i)
+        for i, key in enumerate(re_struct.keys()):
+            a, b = int(partitions[i]), int(partitions[i+1])
+            k, n_units = re_struct[key]['cov_re_dims'], re_struct[key]['n_units']
+            Vinv = self.gmats.Vinv[key]
+            Ainv = sps.csc_matrix(re_struct[key]['acov_inv'])
+            S = np.einsum('t,tjl->jl', self._ginv_vals[i],
+                          Cinv[self._ginv_pos[i]].reshape(-1, k, k))
+            off = n_fe + self.partitions2[i]
+            U = coefs[off:off+n_units*k].reshape(n_units, k)
+            Q = U.T.dot(Ainv.dot(U))
+            Gam = n_units * Vinv - Vinv.dot(S + Q).dot(Vinv)
+            g.append(linalg_utils.vech(Gam * (2.0 - np.eye(k))))
+        p1, p2 = int(partitions[-2]), int(partitions[-1])
+        Sinv = np.linalg.inv(linalg_utils.invech(theta[p1:p2]))
+        E = self._yw - self.XZ.dot(coefs)
+        E = E.reshape(-1, m)
+        ix = np.triu_indices(m)
+        T = np.zeros((m, m))
+        T[ix] = self._mme_terms.dot(Cinv) / (2.0 - (ix[0]==ix[1]))
+        T = T + np.triu(T, 1).T
+        Gam = self.n_obs * Sinv - Sinv.dot(T + E.T.dot(E)).dot(Sinv)
+        g.append(linalg_utils.vech(Gam * (2.0 - np.eye(m))))
         g = np.concatenate(g)
-        return linalg_utils._check_1d(g)
+        return g
 
     def hessian(self, theta):
         '''
         The hessian of minus two times the restricted log likelihood.  This is
         equal to
 
-        \\partial\\mathcal{L}=\partial V'(P\\otimes Pyy'P - P)\\partial V
+        \\partial\\mathcal{L}=\\partial V'(P\\otimes Pyy'P - P)\\partial V
         
         In scalar form this is
         
         H_{ij}=H_{ji}=2y'P(\\partial V_{i})P(\\partial V_{j})Py - 
-                      \tr{P(\\partial V_{i})P(\\partial V_{j})}
+                      \\tr{P(\\partial V_{i})P(\\partial V_{j})}
+        
+        The first term is twice the average information matrix, while the 
+        trace term requires the n by n matrix P, to which the derivative
+        operators are applied.  As this is O(n^{2}) in memory, a ValueError
+        is raised when the number of observations (times the number of 
+        responses) exceeds the class attribute hessian_max_obs; the average
+        information matrix is the scalable alternative.
 
         Parameters
         ----------
@@ -484,31 +1409,348 @@ class LMM(object):
           Hessian matrix
 
         '''
+        if self.n_obs * self.n_vars > self.hessian_max_obs:
+            raise ValueError("The observed hessian forms dense n by n "
+                             "matrices and is limited to hessian_max_obs=%i "
+                             "observations; use the average information "
+                             "matrix instead (se_method='ai')"
+                             %self.hessian_max_obs)
         theta = linalg_utils._check_1d(theta)
-        G, Ginv, SigA, R, Rinv, SigE = self.params2mats(theta)
-        jac_mats = self.jac_mats
-        X, Z, y = self.X, self.Z, self.y
-        W = linalg_utils.woodbury_inversion(Z, Cinv=Ginv, Ainv=Rinv)
-        XtW = X.T.dot(W)
-        XtWX_inv = linalg_utils.einv(XtW.dot(X))
-        P = W - XtW.T.dot(XtWX_inv).dot(XtW)
-        # P = W - np.linalg.multi_dot([XtW.T, XtWX_inv, XtW])
-        Py = P.dot(y)
-        H = []
-        #TODO Shit, just pre compute PJi and iterate over instead of current redundant matmuls
-        PJ, yPJ = [], []
-        for i, J in enumerate(jac_mats):
-            PJ.append((J.T.dot(P)).T)
-            yPJ.append((J.T.dot(Py)).T)
-        indices = np.triu_indices(len(jac_mats)) 
-        for i, j in list(zip(*indices)):
-            PJi, PJj = PJ[i], PJ[j]
-            yPJi, JjPy = yPJ[i], yPJ[j].T
-            Hij = -(PJi.dot(PJj)).diagonal().sum()\
-                        + (2 * (yPJi.dot(P)).dot(JjPy))[0]
-            H.append(Hij[0])
-        H = linalg_utils.invech(np.array(H))
+        partitions, m = self.partitions, self.n_vars
+        AI = self.average_information(theta)
+        L = self._mme_chol
+        p1, p2 = int(partitions[-2]), int(partitions[-1])
+        Sinv = np.linalg.inv(linalg_utils.invech(theta[p1:p2]))
+        Rinv = sps.kron(sps.eye(self.n_obs), Sinv, format='csc')
+        B = self.XZ.T.dot(Rinv).toarray()
+        CB = L.solve(np.vstack([B, np.zeros((1, B.shape[1]))]), n=L.n-1)[:-1]
+        P = Rinv.toarray() - B.T.dot(CB)
+        PV = [op.dot(P).T for op in self.deriv_ops]
+        q = len(PV)
+        T = np.zeros((q, q))
+        for i, j in list(zip(*np.triu_indices(q))):
+            T[i, j] = T[j, i] = np.sum(PV[i] * PV[j].T)
+        H = 2.0 * AI - T
         return H
     
 
 
+
+class KroneckerLMM(object):
+
+    def __init__(self, formula, data, acov=None):
+        '''
+        Multivariate Linear Mixed Model with Kronecker structured covariances
+        
+        vec(Y) = (I_{m}\\otimes X)vec(B) + (I_{m}\\otimes Z)vec(U) + vec(E)
+        
+        where Cov(vec(U))=\\Sigma_{u}\\otimes A and 
+        Cov(vec(E))=\\Sigma_{e}\\otimes I_{n}.  Y is kept as an n by m
+        matrix, and neither kron(X, I) nor the commutation matrices are 
+        formed.  Instead, the rows are rotated by the eigenvectors of ZAZ', 
+        computed from the q by q cross product, and the responses by the
+        simultaneous diagonalization of \\Sigma_{u} and \\Sigma_{e}, after 
+        which the mixed model equations decouple into m problems of the size
+        of X'X, and the REML criterion and its gradient cost O(qm(m+p^2))
+        per evaluation.
+
+        Parameters
+        ----------
+        formula: str
+            Formula with using the R style of denoting random effects, 
+            e.g., (y1, y2, y3)~x+(1|id).  A single random effect term with
+            one variate per level is supported
+            
+        data: DataFrame
+            Pandas DataFrame containing n_obs by n_features including the
+            relavent terms to the model
+            
+        acov: dict, default None
+            Dictionary with the grouping factor as the key and the covariance
+            among its levels (A) as the value.  Defaults to the identity
+        '''
+        fe_form, random_effects = parse_random_effects(formula)
+        fe_form = re.sub("\+$", "", fe_form)
+        yvars, fixed_effects = re.split("[~]", fe_form)
+        yvars = re.split(",", re.sub("\(|\)", "", yvars))
+        yvar = [x.strip() for x in yvars]
+        if len(random_effects)!=1:
+            raise ValueError("A single random effect term is required")
+        re_form, key = [x.strip() for x in random_effects[0]]
+        X = patsy.dmatrix(fixed_effects, data=data, return_type='dataframe')
+        Zij = patsy.dmatrix(re_form, data=data, return_type='dataframe')
+        if Zij.shape[1]!=1:
+            raise ValueError("Random effect term must have a single variate")
+        Z = sparse_utils.sparse_khatri_rao(data[key], Zij.values)
+        n_units = Z.shape[1]
+        if (acov is not None) and (acov.get(key) is not None):
+            A = acov[key]
+            A = A.toarray() if sps.issparse(A) else np.asarray(A)
+            LA = np.linalg.cholesky(A)
+            Zt = Z.dot(LA)
+        else:
+            LA = None
+            Zt = Z
+        
+        fe_names = [x+':'+yv for yv in yvar for x in X.columns]
+        X, Y = X.values.astype(float), data[yvar].values.astype(float)
+        n_obs, m = Y.shape
+        p = X.shape[1]
+        # Rotation U_{1}' = S^{-1/2}V'Z' from Z'Z=VSV'; the complement of
+        # U_{1} enters only through the residual cross products 
+        ZtZ = sps.csc_matrix(Zt.T.dot(Zt))
+        if (ZtZ - sps.diags(ZtZ.diagonal())).nnz==0:
+            s = ZtZ.diagonal()
+            keep = s > 1e-10 * np.max(s)
+            Zk = sps.csc_matrix(sps.csc_matrix(Zt)[:, keep].dot(
+                    sps.diags(1.0 / np.sqrt(s[keep]))))
+            s = s[keep]
+        else:
+            s, V = np.linalg.eigh(ZtZ.toarray())
+            keep = s > 1e-10 * np.max(s)
+            s, V = s[keep], V[:, keep]
+            Zk = Zt.dot(V / np.sqrt(s))
+        Xr, Yr = np.asarray(Zk.T.dot(X)), np.asarray(Zk.T.dot(Y))
+        
+        self._XtX_n = X.T.dot(X) - Xr.T.dot(Xr)
+        self._XtY_n = X.T.dot(Y) - Xr.T.dot(Yr)
+        self._YtY_n = Y.T.dot(Y) - Yr.T.dot(Yr)
+        self._s, self._Xr, self._Yr, self._Zk = s, Xr, Yr, Zk
+        self._LA, self._Zt = LA, Zt
+        self.X, self.Y, self.Z = X, Y, Z
+        self.n_obs, self.n_vars, self.n_fe = n_obs, m, p
+        self.n_units, self.yvar = n_units, yvar
+        
+        ix = np.triu_indices(m)
+        names = np.array([y+": "+x for y in yvar for x in Zij.columns])
+        res_names = [key+'|'+names[a]+' x '+names[b] for a, b in zip(*ix)]
+        res_names += [yvar[a]+": "+yvar[b]+" error_var" for a, b in zip(*ix)]
+        self.res_names = res_names + fe_names
+        
+        B = np.linalg.lstsq(X, Y, rcond=None)[0]
+        S = np.cov((Y - X.dot(B)).T).reshape(m, m) / 2.0
+        self.theta = np.concatenate([linalg_utils.vech(S)]*2)
+        self.n_params = len(self.theta)
+        self._ltri = np.tril_indices(m)
+        
+    def _transform(self, theta):
+        '''
+        Covariances, and the transform T with T'\\Sigma_{e}T=I and 
+        T'\\Sigma_{u}T=diag(\\lambda)
+        '''
+        k = self.n_params // 2
+        Su = linalg_utils.invech(theta[:k])
+        Se = linalg_utils.invech(theta[k:])
+        Le = np.linalg.cholesky(Se)
+        Lei = sp.linalg.solve_triangular(Le, np.eye(self.n_vars), lower=True)
+        lam, Q = np.linalg.eigh(Lei.dot(Su).dot(Lei.T))
+        T = Lei.T.dot(Q)
+        logdet_e = 2.0 * np.sum(np.log(np.diag(Le)))
+        return Su, Se, T, lam, logdet_e
+    
+    def _solve(self, theta):
+        '''
+        Solves the decoupled mixed model equations at theta, returning the
+        quantities shared by the likelihood, its gradient and the effect 
+        estimates
+        '''
+        Su, Se, T, lam, logdet_e = self._transform(theta)
+        Xr, s = self._Xr, self._s
+        Yt = self._Yr.dot(T)
+        XtY_n = self._XtY_n.dot(T)
+        D = 1.0 / (lam[None] * s[:, None] + 1.0)
+        H = np.einsum('ip,ij,iq->jpq', Xr, D, Xr) + self._XtX_n[None]
+        g = Xr.T.dot(D * Yt) + XtY_n
+        Bt = np.linalg.solve(H, g.T[:, :, None])[:, :, 0].T
+        Er = Yt - Xr.dot(Bt)
+        EtE_n = (T.T.dot(self._YtY_n).dot(T) - Bt.T.dot(XtY_n) 
+                 - XtY_n.T.dot(Bt) + Bt.T.dot(self._XtX_n).dot(Bt))
+        return dict(Su=Su, Se=Se, T=T, lam=lam, logdet_e=logdet_e, D=D, H=H,
+                    Bt=Bt, Er=Er, EtE_n=EtE_n)
+        
+    def loglike(self, theta):
+        '''
+        Minus two times the restricted log likelihood (omitting constants)
+        
+        (n-p)\\log|\\Sigma_{e}|+\\sum_{ij}\\log(1+\\lambda_{j}s_{i})
+        +\\sum_{j}\\log|H_{j}|+\\sum_{ij}d_{ij}\\tilde{e}_{ij}^{2}
+        
+        where s are the eigenvalues of ZAZ', d_{ij}=1/(1+\\lambda_{j}s_{i}),
+        H_{j} the X'V^{-1}X of the j-th transformed response, and the 
+        residuals in the complement of Z contribute with unit weight.
+
+        Parameters
+        ----------
+        theta: array
+          [vech(\\Sigma_{u}), vech(\\Sigma_{e})]
+        '''
+        theta = linalg_utils._check_1d(np.asarray(theta, dtype=float))
+        try:
+            q = self._solve(theta)
+        except np.linalg.LinAlgError:
+            return np.inf
+        if np.any(q['lam'] * np.max(self._s) <= -1.0):
+            return np.inf
+        ldh = np.linalg.slogdet(q['H'])[1].sum()
+        quad = np.sum(q['D'] * q['Er']**2) + np.trace(q['EtE_n'])
+        LL = ((self.n_obs - self.n_fe) * q['logdet_e'] - np.sum(np.log(q['D']))
+              + ldh + quad)
+        return LL
+    
+    def _gradient_mats(self, theta):
+        '''
+        Derivatives of the REML criterion with respect to \\Sigma_{u} and
+        \\Sigma_{e}, treated as unstructured matrices
+        '''
+        q = self._solve(theta)
+        T, D, Er, H = q['T'], q['D'], q['Er'], q['H']
+        Xr, s = self._Xr, self._s
+        Hinv = np.linalg.inv(H)
+        C = np.einsum('ip,jpq,iq->ij', Xr, Hinv, Xr)
+        F = D * Er
+        n_null = self.n_obs - len(s)
+        Cn = np.einsum('jpq,pq->j', Hinv, self._XtX_n)
+        Au = np.diag(s.dot(D - D**2 * C)) - F.T.dot(s[:, None] * F)
+        Ae = (np.diag(np.sum(D - D**2 * C, axis=0) + n_null - Cn) 
+              - F.T.dot(F) - q['EtE_n'])
+        Gu = T.dot(Au).dot(T.T)
+        Ge = T.dot(Ae).dot(T.T)
+        return Gu, Ge, q
+        
+    def gradient(self, theta):
+        '''
+        The gradient of minus two times the restricted log likelihood. 
+        With F=D\\circ\\tilde{E} and C_{ij}=x_{i}'H_{j}^{-1}x_{i}
+        
+        \\partial\\mathcal{L}/\\partial\\Sigma_{u} = T(diag(s'(D-D^{2}\\circ C))
+        -F'diag(s)F)T'
+        
+        and analogously for \\Sigma_{e}, with unit weights in place of s and
+        the contribution of the complement of Z
+        
+        Parameters
+        ----------
+        theta: array
+          [vech(\\Sigma_{u}), vech(\\Sigma_{e})]
+        '''
+        theta = linalg_utils._check_1d(np.asarray(theta, dtype=float))
+        Gu, Ge, _ = self._gradient_mats(theta)
+        m = self.n_vars
+        g = np.concatenate([linalg_utils.vech(Gu * (2.0 - np.eye(m))),
+                            linalg_utils.vech(Ge * (2.0 - np.eye(m)))])
+        return g
+    
+    def _chol_to_theta(self, x):
+        m, k = self.n_vars, len(x) // 2
+        Lu, Le = np.zeros((m, m)), np.zeros((m, m))
+        Lu[self._ltri], Le[self._ltri] = x[:k], x[k:]
+        theta = np.concatenate([linalg_utils.vech(Lu.dot(Lu.T)),
+                                linalg_utils.vech(Le.dot(Le.T))])
+        return theta, Lu, Le
+    
+    def _chol_loglike(self, x):
+        return self.loglike(self._chol_to_theta(x)[0])
+    
+    def _chol_gradient(self, x):
+        theta, Lu, Le = self._chol_to_theta(x)
+        Gu, Ge, _ = self._gradient_mats(theta)
+        return 2.0 * np.concatenate([Gu.dot(Lu)[self._ltri], 
+                                     Ge.dot(Le)[self._ltri]])
+    
+    def _compute_effects(self, theta=None):
+        '''
+        Fixed effects B (p by m), their standard errors, and the best linear
+        unbiased predictors U (q by m) of the random effects
+        '''
+        if theta is None:
+            theta = self.params
+        q = self._solve(theta)
+        T, D, Er = q['T'], q['D'], q['Er']
+        Tinv = np.linalg.inv(T)
+        Hinv = np.linalg.inv(q['H'])
+        self.B = q['Bt'].dot(Tinv)
+        self.SE_B = np.sqrt(np.einsum('ja,jkk->ka', Tinv**2, Hinv))
+        # Z'V^{-1}E = Z'U_{1}(D\circ\tilde{E})T'
+        P = (D * Er).dot(T.T)
+        U = np.asarray(self._Zt.T.dot(self._Zk.dot(P))).dot(q['Su'])
+        if self._LA is not None:
+            U = self._LA.dot(U)
+        self.U = U
+        self.b = linalg_utils.vec(self.B)[:, None]
+        self.SE_b = linalg_utils.vec(self.SE_B)
+        self.SigA, self.SigE = q['Su'], q['Se']
+    
+    def fit(self, optimizer_kwargs={}, optimizer_options=None, maxiter=500,
+            tol=1e-8, hess_opt=True):
+        '''
+        Fit the model by restricted maximum likelihood, using L-BFGS-B over
+        the lower triangular Cholesky factors of \\Sigma_{u} and 
+        \\Sigma_{e} with the analytic gradient
+        
+        Parameters
+        ----------
+        hess_opt: bool, default True
+            Whether to compute standard errors of the variance parameters 
+            from a hessian obtained by differencing the gradient
+        '''
+        m = self.n_vars
+        if optimizer_options is None:
+            optimizer_options = {'maxiter': maxiter, 'gtol': tol}
+        x0 = []
+        for S in np.split(self.theta, 2):
+            x0.append(np.linalg.cholesky(linalg_utils.invech(S))[self._ltri])
+        x0 = np.concatenate(x0)
+        diag = (self._ltri[0]==self._ltri[1])
+        bounds = [(0, None) if d else (None, None) for d in diag]
+        bounds += [(1e-8, None) if d else (None, None) for d in diag]
+        res = sp.optimize.minimize(self._chol_loglike, x0, 
+                                   jac=self._chol_gradient, bounds=bounds,
+                                   method='L-BFGS-B', options=optimizer_options,
+                                   **optimizer_kwargs)
+        self.optimizer = res
+        self.params = self._chol_to_theta(res.x)[0]
+        self._compute_effects(self.params)
+        self.ll = self.loglike(self.params)
+        if hess_opt:
+            k, eps = self.n_params, 1e-5
+            H = np.zeros((k, k))
+            for i in range(k):
+                h = eps * max(1.0, abs(self.params[i]))
+                dx = np.zeros(k)
+                dx[i] = h
+                H[i] = (self.gradient(self.params+dx) 
+                        - self.gradient(self.params-dx)) / (2 * h)
+            self.hessian_est = (H + H.T) / 2.0
+            # -2ll, so the covariance is twice the inverse hessian
+            self.SE_theta = np.sqrt(np.abs(np.diag(
+                                    2.0*np.linalg.pinv(self.hessian_est))))
+        else:
+            self.SE_theta = np.zeros(self.n_params) * np.nan
+        res = pd.DataFrame(np.concatenate([self.params, self.b[:, 0]]),
+                           columns=['Parameter Estimate'])
+        res['Standard Error'] = np.concatenate([self.SE_theta, self.SE_b])
+        res['t value'] = res['Parameter Estimate'] / res['Standard Error']
+        res['p value'] = sp.stats.t.sf(np.abs(res['t value']),
+                                       self.n_obs*m-len(self.params)) * 2.0
+        res.index = self.res_names
+        self.res = res
+        n_obs, k_params = self.n_obs * m, len(self.params)
+        self.aic = self.ll + (2 * k_params)
+        self.aicc = self.ll + 2*k_params*n_obs / (n_obs - k_params - 1)
+        self.bic = self.ll + k_params*np.log(n_obs)
+        self.caic = self.ll + k_params * np.log(n_obs+1)
+        self.sumstats = pd.DataFrame(np.array([self.aic, self.aicc, self.bic,
+                                               self.caic]), 
+                                     index=['AIC', 'AICC', 'BIC', 'CAIC'])
+        return res
+    
+    def predict(self, X=None, Z=None):
+        '''
+        Returns the n by m matrix of predicted values using both fixed and 
+        random effect estimates
+        '''
+        if X is None:
+            X = self.X
+        if Z is None:
+            Z = self.Z
+        return X.dot(self.B) + Z.dot(self.U)
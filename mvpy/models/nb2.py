@@ -20,8 +20,9 @@ def trigamma(x):
     
 class MinimalNB2:
     
-    def __init__(self, X, Y):
+    def __init__(self, X, Y, W=None):
         self.X, self.Y = X, Y
+        self.W = np.ones(X.shape[0]) if W is None else W
         self.n_obs, self.n_feats = X.shape
         self.beta = np.zeros(self.n_feats)
         self.varp = np.ones(1)/2.0
@@ -38,24 +39,24 @@ class MinimalNB2:
         u = 1.0 + a * mu
         lg = sp.special.gammaln(y + v) - sp.special.gammaln(v) - sp.special.gammaln(y + 1)
         ln = y * np.log(mu) + y * np.log(a) - (y + v) * np.log(u)
-        ll = np.sum(lg + ln)
+        ll = np.sum(self.W * (lg + ln))
         return -ll
     
     def gradient(self, params):
         params = linalg_utils._check_1d(params)
-        X, y = self.X, linalg_utils._check_1d(self.Y)
+        X, y, W = self.X, linalg_utils._check_1d(self.Y), self.W
         b, a = params[:-1], params[-1]
         v = 1.0 / a
         mu = np.exp(X.dot(b))
         u = 1 + a * mu
         r = y-mu
-        gb = X.T.dot(r / u)
-        ga = np.sum(np.log(u)+(a*r)/u + sp.special.digamma(v) - sp.special.digamma(y+v))
+        gb = X.T.dot(W * r / u)
+        ga = np.sum(W * (np.log(u)+(a*r)/u + sp.special.digamma(v) - sp.special.digamma(y+v)))
         ga /= a**2
         g = np.concatenate([gb, np.array([ga])])
         return -g
         
-    def var_deriv(self, a, mu, y):
+    def var_deriv(self, a, mu, y, W=1.0):
         v = 1/a
         u = 1+a*mu
         r = y-mu
@@ -68,22 +69,22 @@ class MinimalNB2:
         z = (dig + np.log(p) - (a * r) / u)
         trg = a4*(trigamma(vy)-trigamma(v) + a - 1/vm + r/(vm**2))
         res = 2*a3*z + trg
-        return -res.sum()
+        return -np.sum(W * res)
     
     def hessian(self, params):
-        X, y = self.X, linalg_utils._check_1d(self.Y)
+        X, y, W = self.X, linalg_utils._check_1d(self.Y), self.W
         b, a = params[:-1], params[-1]
 
         mu = np.exp(X.dot(b))
         u = 1 + a * mu
         r = y-mu
         
-        wbb = mu * (1.0 + a * y) / (u**2)
+        wbb = W * mu * (1.0 + a * y) / (u**2)
         Hb = -(X.T * wbb).dot(X)
         
-        Hab = -X.T.dot((mu * r) / (u**2))
+        Hab = -X.T.dot(W * (mu * r) / (u**2))
         
-        Ha = np.array([self.var_deriv(a, mu, y)]) 
+        Ha = np.array([self.var_deriv(a, mu, y, W)]) 
         H = np.block([[Hb, Hab[:, None]], [Hab[:, None].T, Ha]])
         return -H
     
@@ -113,44 +114,89 @@ class MinimalNB2:
 
 class NegativeBinomial:
     
-    def __init__(self, formula, data):
+    def __init__(self, formula, data, freq_weights=None, compress=False):
+        '''
+        Negative binomial (NB2) regression
+        
+        Parameters
+        ----------
+        formula : str
+            patsy formula
+        data : dataframe
+            data referenced by formula
+        freq_weights : array, optional
+            Frequency weights, i.e. the number of times each row is observed
+        compress : bool, default False
+            If True, duplicated rows of (X, Y) are collapsed into frequency
+            weights before fitting, giving the same estimates and standard 
+            errors at the cost of the unique rows
+        '''
         Y, X = patsy.dmatrices(formula, data, return_type='dataframe')
         self.X, self.xcols, self.xix, self.x_is_pd = base_utils.check_type(X)
         self.Y, self.ycols, self.yix, self.y_is_pd = base_utils.check_type(Y)
-        self.n_obs, self.n_feats = X.shape
+        if freq_weights is not None:
+            freq_weights = linalg_utils._check_1d(
+                    linalg_utils._check_np(freq_weights)).astype(float)
+        if compress:
+            (self.X, self.Y), counts, self.row_inverse = \
+                base_utils.compress_rows(self.X, self.Y)
+            if freq_weights is not None:
+                counts = np.bincount(self.row_inverse, weights=freq_weights)
+            freq_weights, self.xix, self.yix = counts, None, None
+        if freq_weights is None:
+            freq_weights = np.ones(self.X.shape[0])
+        self.W = freq_weights
+        self.n_obs, self.n_feats = np.sum(self.W), self.X.shape[1]
         self.beta = np.zeros(self.n_feats)
         self.varp = np.ones(1)/2.0
         self.params = np.concatenate([self.beta, self.varp])
         self.cnst = [(None, None) for i in range(self.n_feats)]+[(1e-16, None)]
     
-    def loglike(self, params, X=None):
+    def _compute_iterate(self, params, X=None):
         if X is None:
             X = self.X
-        y = linalg_utils._check_1d(self.Y)
         b, a = params[:-1], params[-1]
-        v = 1.0 / a
-        mu = np.exp(X.dot(b))
+        eta = X.dot(b)
+        mu = np.exp(eta)
         u = 1.0 + a * mu
+        return dict(b=b, a=a, eta=eta, mu=mu, u=u, var=mu * u)
+    
+    def _iterate(self, params, X=None):
+        '''
+        Linear predictor, mean, 1+a\\mu and variance at params, held in a 
+        small cache for the model's own X so that loglike, gradient and 
+        hessian compute them once per iterate
+        '''
+        params = linalg_utils._check_1d(params)
+        if X is not None:
+            return self._compute_iterate(params, X)
+        if not hasattr(self, '_cache'):
+            self._cache = base_utils.ParamCache(maxsize=2)
+        return self._cache.get(params, self._compute_iterate)
+    
+    def loglike(self, params, X=None):
+        y = linalg_utils._check_1d(self.Y)
+        it = self._iterate(params, X)
+        a, mu, u = it['a'], it['mu'], it['u']
+        v = 1.0 / a
         lg = sp.special.gammaln(y + v) - sp.special.gammaln(v) - sp.special.gammaln(y + 1)
         ln = y * np.log(mu) + y * np.log(a) - (y + v) * np.log(u)
-        ll = np.sum(lg + ln)
+        ll = np.sum(self.W * (lg + ln))
         return -ll
     
     def gradient(self, params):
-        params = linalg_utils._check_1d(params)
-        X, y = self.X, linalg_utils._check_1d(self.Y)
-        b, a = params[:-1], params[-1]
+        X, y, W = self.X, linalg_utils._check_1d(self.Y), self.W
+        it = self._iterate(params)
+        a, mu, u = it['a'], it['mu'], it['u']
         v = 1.0 / a
-        mu = np.exp(X.dot(b))
-        u = 1 + a * mu
         r = y-mu
-        gb = X.T.dot(r / u)
-        ga = np.sum(np.log(u)+(a*r)/u + sp.special.digamma(v) - sp.special.digamma(y+v))
+        gb = X.T.dot(W * r / u)
+        ga = np.sum(W * (np.log(u)+(a*r)/u + sp.special.digamma(v) - sp.special.digamma(y+v)))
         ga /= a**2
         g = np.concatenate([gb, np.array([ga])])
         return -g
         
-    def var_deriv(self, a, mu, y):
+    def var_deriv(self, a, mu, y, W=1.0):
         v, u, r = 1/a, 1+a*mu, y-mu
         p, vm, vy = 1/u, v+mu, v+y
         a2, a3 = a**-2, a**-3
@@ -159,53 +205,50 @@ class NegativeBinomial:
         z = (dig + np.log(p) - (a * r) / u)
         trg = a4*(trigamma(vy)-trigamma(v) + a - 1/vm + r/(vm**2))
         res = 2*a3*z + trg
-        return -res.sum()
+        return -np.sum(W * res)
     
     def hessian(self, params):
-        X, y = self.X, linalg_utils._check_1d(self.Y)
-        b, a = params[:-1], params[-1]
-
-        mu = np.exp(X.dot(b))
-        u = 1 + a * mu
+        X, y, W = self.X, linalg_utils._check_1d(self.Y), self.W
+        it = self._iterate(params)
+        a, mu, u = it['a'], it['mu'], it['u']
         r = y-mu
         
-        wbb = mu * (1.0 + a * y) / (u**2)
+        wbb = W * mu * (1.0 + a * y) / (u**2)
         Hb = -(X.T * wbb).dot(X)
         
-        Hab = -X.T.dot((mu * r) / (u**2))
+        Hab = -X.T.dot(W * (mu * r) / (u**2))
         
-        Ha = np.array([self.var_deriv(a, mu, y)]) 
+        Ha = np.array([self.var_deriv(a, mu, y, W)]) 
         H = np.block([[Hb, Hab[:, None]], [Hab[:, None].T, Ha]])
         return -H
     
     def deviance(self, params):
-        X, y = self.X, linalg_utils._check_1d(self.Y)
-        b, a = params[:-1], params[-1]
-        mu = np.exp(X.dot(b))
+        y = linalg_utils._check_1d(self.Y)
+        it = self._iterate(params)
+        a, mu = it['a'], it['mu']
         v = 1.0 / a
+        W = self.W
         ix = y>0
         dev1 = y[ix] * np.log(y[ix] / mu[ix])
         dev1 -= (y[ix]+v) * np.log((y[ix] + v) / (mu[ix] + v))
         
         dev2 = np.log(1 + a * mu[~ix]) / a
-        dev = 2.0 * (np.sum(dev1) + np.sum(dev2))
+        dev = 2.0 * (np.sum(W[ix] * dev1) + np.sum(W[~ix] * dev2))
         return dev
     
     def var_mu(self, params):
-        X = self.X
-        b, a = params[:-1], params[-1]
-        mu = np.exp(X.dot(b))
-        v = mu + a * mu**2
-        return v
+        return self._iterate(params)['var']
         
     
     def fit(self, optimizer_kwargs=None):
         if optimizer_kwargs is None:
             optimizer_kwargs = {'method':'trust-constr', 
                                 'options':{'verbose':0}}
-        intercept_model = MinimalNB2(np.ones((self.n_obs ,1)), self.Y)
+        intercept_model = MinimalNB2(np.ones((self.X.shape[0], 1)), self.Y, 
+                                     self.W)
         intercept_model.fit()
         self.LL0 = intercept_model.LLA
+        self._cache = base_utils.ParamCache(maxsize=2)
         params = self.params
         optimizer = sp.optimize.minimize(self.loglike, params,
                                          jac=self.gradient, 
@@ -232,14 +275,15 @@ class NegativeBinomial:
         self.yhat = self.predict(params=self.params)
         chi2 = (linalg_utils._check_1d(self.Y) - self.yhat)**2
         chi2/= self.var_mu(self.params)
-        self.chi2 = np.sum(chi2)
+        self.chi2 = np.sum(self.W * chi2)
         self.scchi2 = self.chi2 / (self.n_obs - self.n_feats)
         self.chi2_p = sp.stats.chi2.sf(self.chi2,  (self.n_obs - self.n_feats))
         self.dev_p = sp.stats.chi2.sf(self.dev,  (self.n_obs - self.n_feats))
         self.LLRp = sp.stats.chi2.sf(self.LLR,  (self.n_obs - self.n_feats))
-        n, p = self.X.shape
+        n, p = self.n_obs, self.n_feats
         yhat = self.predict(params=self.params)
-        self.ssr =np.sum((yhat - yhat.mean())**2)
+        ybar = np.sum(self.W * yhat) / n
+        self.ssr =np.sum(self.W * (yhat - ybar)**2)
         rmax =  (1 - np.exp(-2.0/n * (self.LL0)))
         rcs = 1 - np.exp(2.0/n*(self.LLA-self.LL0))
         rna = rcs / rmax
@@ -6,11 +6,17 @@ Created on Mon Jan 27 12:25:48 2020
 @author: lukepinkel
 """
 
+import time
+import concurrent.futures
 import numpy as np # analysis:ignore
 import scipy as sp # analysis:ignore
 import pandas as pd # analysis:ignore
 from ..utils import linalg_utils, base_utils # analysis:ignore
-from .glm3 import Binomial
+from .glm3 import Binomial, Gaussian, IdentityLink
+try:
+    import numba # analysis:ignore
+except ImportError:
+    numba = None
 
 def sft(x, t):
     y = np.maximum(np.abs(x) - t, 0) * np.sign(x)
@@ -18,7 +24,7 @@ def sft(x, t):
     
     
 def penalty_term(beta, lambda_=0.1, alpha=0.5):
-    p = np.sum(0.5 * (1 - alpha) * beta**2 + alpha*np.abs(beta))
+    p = lambda_ * np.sum(0.5 * (1 - alpha) * beta**2 + alpha*np.abs(beta))
     return p
 
 def working_variate(f, eta, y):
@@ -48,130 +54,1186 @@ def penalized_loglike(beta, X, y, lambda_=0.1, alpha=0.5):
     return pll
     
 
-def eln_coordinate_descent(X, y, lambda_=0.1, alpha=0.5, n_iters=20, tol=1e-9):
-    X, y = base_utils.csd(X), base_utils.csd(y)
-    G, Xty = X.T.dot(X),  X.T.dot(y)
-    beta = np.linalg.inv(G).dot(Xty)
+def _eln_gram_sweeps(G, c, beta, g, l1, l2, tol, max_sweeps):
+    '''
+    Coordinate descent for the elastic net in the covariance form, where G
+    is X'X/n with diagonal g and c the current gradient X'(y - X\\beta)/n.  An update of 
+    beta_{j} changes c by a multiple of the j-th column of G, so that each
+    step costs O(p), and nothing is done for coordinates that stay at 
+    zero.  beta and c are updated in place, and convergence is checked once
+    per sweep on the largest change of a coefficient weighted by its 
+    curvature.  Returns the number of sweeps made
+    '''
+    p = len(beta)
+    for i in range(max_sweeps):
+        dlx = 0.0
+        for j in range(p):
+            gjj = g[j]
+            if gjj<=0:
+                continue
+            u = c[j] + gjj * beta[j]
+            bn = np.sign(u) * max(abs(u) - l1, 0.0) / (gjj + l2)
+            d = bn - beta[j]
+            if d!=0:
+                beta[j] = bn
+                c -= d * G[j]
+                dlx = max(dlx, gjj * d**2)
+        if dlx < tol:
+            break
+    return i + 1
+
+
+def _eln_resid_sweeps(X, r, beta, xx, l1, l2, tol, max_sweeps):
+    '''
+    Coordinate descent for the elastic net in the residual form, where r is
+    the current residual y - X\\beta and xx the column sums of squares of X
+    divided by n.  Each step costs O(n), one inner product of a column with
+    r and, if beta_{j} changes, one update of r.  beta and r are updated in
+    place and convergence is checked once per sweep.  Returns the number 
+    of sweeps made
+    '''
     n, p = X.shape
-    active = np.ones(p).astype(bool)
-    la, dn = lambda_ * alpha, lambda_ * (1  - alpha) + 1.0
-    loglikes, llprev = [], penalized_loglike(beta, X, y, lambda_, alpha)
-    beta_paths = np.zeros(p)
-    for i in range(n_iters):
+    for i in range(max_sweeps):
+        dlx = 0.0
         for j in range(p):
-            active[j] = False
-            bj = sft((Xty[~active] - G[~active][:, active].dot(beta[active]))/n, la)
-            bj/= dn
-            
-            beta[j] = bj
-            active[j] = True
-            
-            loglikes.append((penalized_loglike(beta, X, y, lambda_, alpha)))
-        beta_paths = np.vstack([beta_paths, beta])        
-        llcurr = penalized_loglike(beta, X, y, lambda_, alpha)
-        
-        if np.abs(llprev - llcurr)<tol:
+            if xx[j]<=0:
+                continue
+            u = X[:, j].dot(r) / n + xx[j] * beta[j]
+            bn = np.sign(u) * max(abs(u) - l1, 0.0) / (xx[j] + l2)
+            d = bn - beta[j]
+            if d!=0:
+                beta[j] = bn
+                r -= d * X[:, j]
+                dlx = max(dlx, xx[j] * d**2)
+        if dlx < tol:
             break
-        if llcurr>llprev:
+    return i + 1
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _eln_gram_kernel(G, c, beta, g, l1, l2, tol, max_sweeps):
+        '''
+        Compiled equivalent of _eln_gram_sweeps, with G symmetric so that
+        its rows are read in place of its columns
+        '''
+        p = len(beta)
+        n_sweeps = 0
+        for i in range(max_sweeps):
+            n_sweeps += 1
+            dlx = 0.0
+            for j in range(p):
+                gjj = g[j]
+                if gjj<=0:
+                    continue
+                u = c[j] + gjj * beta[j]
+                if u > l1:
+                    bn = (u - l1) / (gjj + l2)
+                elif u < -l1:
+                    bn = (u + l1) / (gjj + l2)
+                else:
+                    bn = 0.0
+                d = bn - beta[j]
+                if d!=0:
+                    beta[j] = bn
+                    for k in range(p):
+                        c[k] -= d * G[j, k]
+                    dlx = max(dlx, gjj * d**2)
+            if dlx < tol:
+                break
+        return n_sweeps
+    
+    @numba.njit(cache=True)
+    def _eln_resid_kernel(X, r, beta, xx, l1, l2, tol, max_sweeps):
+        '''
+        Compiled equivalent of _eln_resid_sweeps, for X in column major 
+        order
+        '''
+        n, p = X.shape
+        n_sweeps = 0
+        for i in range(max_sweeps):
+            n_sweeps += 1
+            dlx = 0.0
+            for j in range(p):
+                if xx[j]<=0:
+                    continue
+                g = 0.0
+                for k in range(n):
+                    g += X[k, j] * r[k]
+                u = g / n + xx[j] * beta[j]
+                if u > l1:
+                    bn = (u - l1) / (xx[j] + l2)
+                elif u < -l1:
+                    bn = (u + l1) / (xx[j] + l2)
+                else:
+                    bn = 0.0
+                d = bn - beta[j]
+                if d!=0:
+                    beta[j] = bn
+                    for k in range(n):
+                        r[k] -= d * X[k, j]
+                    dlx = max(dlx, xx[j] * d**2)
+            if dlx < tol:
+                break
+        return n_sweeps
+else:
+    _eln_gram_kernel, _eln_resid_kernel = None, None
+
+
+def _eln_standardize(X):
+    '''
+    Centers and scales the columns of X to unit variance, leaving constant
+    columns at zero so that their coefficients stay at zero
+    '''
+    X = base_utils.center(np.asarray(X, dtype=float))
+    s = np.sqrt(np.einsum('ij,ij->j', X, X) / X.shape[0])
+    s[s<=0] = 1.0
+    return X / s
+
+
+def _eln_solver(X, Y, method='auto'):
+    '''
+    Sets up coordinate descent for the elastic net on X and each column of
+    Y, in the covariance form if method is 'gram' (or 'auto' and n >= p)
+    and the residual form otherwise.  Returns the sweep function, the 
+    matrix it operates on (X'X/n or X), the diagonal term, and the initial
+    state (X'Y/n or Y) at beta=0, one column per response
+    '''
+    n, p = X.shape
+    if method == 'auto':
+        method = 'gram' if n >= p else 'resid'
+    if method == 'gram':
+        sweep = _eln_gram_sweeps if _eln_gram_kernel is None else \
+                _eln_gram_kernel
+        A = X.T.dot(X) / n
+        d, state = np.diag(A).copy(), X.T.dot(Y) / n
+    elif method == 'resid':
+        sweep = _eln_resid_sweeps if _eln_resid_kernel is None else \
+                _eln_resid_kernel
+        A = np.asfortranarray(X, dtype=float)
+        d, state = np.einsum('ij,ij->j', A, A) / n, np.array(Y, dtype=float)
+    else:
+        raise ValueError("method must be one of 'auto', 'gram' or 'resid'")
+    return sweep, A, d, state
+
+
+def eln_coordinate_descent(X, y, lambda_=0.1, alpha=0.5, n_iters=20, tol=1e-9,
+                           method='auto'):
+    '''
+    Elastic net by coordinate descent on the standardized X and y, 
+    minimizing
+    
+    \\frac{1}{2n}||y-X\\beta||_{2}^{2} + \\lambda[(1-\\alpha)/2 ||\\beta||_{2}^{2}
+    + \\alpha ||\\beta||_{1}]
+    
+    from beta=0.  The gradient (method='gram') or the residual 
+    (method='resid') is updated after each coordinate rather than 
+    recomputed, and the objective is evaluated once per sweep.
+    
+    Parameters
+    ----------
+    X : array
+        n by p design matrix
+    y : array
+        response
+    lambda_ : float
+        penalty
+    alpha : float
+        mixing parameter between the l1 and l2 penalties
+    n_iters : int
+        maximum number of sweeps
+    tol : float
+        convergence tolerance on the largest change of a coefficient in a
+        sweep, weighted by its curvature
+    method : str
+        'gram', 'resid', or 'auto' to use the former if n >= p
+    
+    Returns
+    -------
+    beta : array
+        coefficients
+    beta_paths : array
+        coefficients at the start and after each sweep
+    loglikes : list
+        penalized objective after each sweep
+    '''
+    X, y = _eln_standardize(X), base_utils.csd(y)
+    y = linalg_utils._check_1d(y)
+    n, p = X.shape
+    sweep, A, d, state = _eln_solver(X, y, method)
+    la, l2 = lambda_ * alpha, lambda_ * (1.0 - alpha)
+    beta = np.zeros(p)
+    loglikes, beta_paths = [], [beta.copy()]
+    for i in range(n_iters):
+        sweep(A, state, beta, d, la, l2, 0.0, 1)
+        dlx = np.max(d * (beta - beta_paths[-1])**2)
+        beta_paths.append(beta.copy())
+        loglikes.append(penalized_loglike(beta, X, y, lambda_, alpha))
+        if dlx < tol:
             break
-        llprev = llcurr
-        
-    return beta, beta_paths, loglikes
+    return beta, np.vstack(beta_paths), loglikes
+
+
+def eln_path(X, y, alpha=0.5, lambdas=None, n_lambdas=100, 
+             lambda_min_ratio=None, tol=1e-9, max_sweeps=1000, method='auto'):
+    '''
+    Elastic net path by coordinate descent on the standardized X and each
+    standardized column of y, over a decreasing sequence of lambdas with 
+    warm starts.  In the covariance form (method='gram', the default when
+    n >= p) X'X and X'y are computed once for all lambdas and responses, 
+    and each coordinate update costs O(p); in the residual form each costs 
+    O(n).  The sweeps are compiled with numba when it is available.
     
- 
-def reorder_gram(G, ix, Cov, Cmax_j, m):
-    q = Cmax_j + m
-    Cov[[Cmax_j, 0]] = Cov[[0, Cmax_j]]
-    ix[q], ix[m] = ix[m], ix[q]
-    G[[m, q]] = G[[q, m]]
-    G[:, [m, q]] = G[:, [q, m]]
-    Cov = Cov[1:]
-    return G, Cov, ix
-        
-
-  
-def get_gamma(Cabsmax, Cov, A, aj):
-    if len(Cov)>0:
-        Cabsmax = np.atleast_1d(Cabsmax)
-        A = np.atleast_1d(A)
-        gamprops = np.concatenate([(Cabsmax - Cov) / (A - aj),
-                                   (Cabsmax + Cov) / (A + aj),
-                                   Cabsmax / A])
-        gamprops = gamprops[gamprops>0]
+    Parameters
+    ----------
+    X : array
+        n by p design matrix
+    y : array
+        response vector, or n by q matrix of responses
+    alpha : float
+        mixing parameter between the l1 and l2 penalties
+    lambdas : array, optional
+        sequence of penalties, used in decreasing order
+    n_lambdas : int
+        length of the default sequence, log spaced from the smallest 
+        lambda at which the coefficients of all responses are zero
+    lambda_min_ratio : float
+        ratio of the smallest to the largest default lambda; 1e-4 if n > p
+        and 1e-2 otherwise
+    tol : float
+        convergence tolerance, checked once per sweep
+    max_sweeps : int
+        maximum number of sweeps per lambda
+    method : str
+        'gram', 'resid', or 'auto'
+    
+    Returns
+    -------
+    betas : array
+        n_lambdas by p array of coefficients, or n_lambdas by p by q if y
+        is a matrix
+    lambdas : array
+        penalties along the path
+    n_sweeps : array
+        number of sweeps made at each lambda (and response)
+    '''
+    X, y = _eln_standardize(X), base_utils.csd(y)
+    Y = y.reshape(y.shape[0], -1)
+    n, p = X.shape
+    q = Y.shape[1]
+    sweep, A, d, state = _eln_solver(X, Y, method)
+    if lambdas is None:
+        lambda_max = np.max(np.abs(X.T.dot(Y))) / n / max(alpha, 1e-3)
+        if lambda_min_ratio is None:
+            lambda_min_ratio = 1e-4 if n > p else 1e-2
+        lambdas = lambda_max * np.logspace(0, np.log10(lambda_min_ratio), 
+                                           n_lambdas)
     else:
-        gamprops = Cabsmax / A
-    gamhat = np.min(gamprops)
-    return gamhat
+        lambdas = np.sort(np.asarray(lambdas, dtype=float))[::-1]
+    n_lambdas = len(lambdas)
+    betas = np.zeros((n_lambdas, p, q))
+    n_sweeps = np.zeros((n_lambdas, q), dtype=int)
+    for j in range(q):
+        beta, sj = np.zeros(p), np.array(state[:, j])
+        for k, lambda_ in enumerate(lambdas):
+            l1, l2 = lambda_ * alpha, lambda_ * (1.0 - alpha)
+            n_sweeps[k, j] = sweep(A, sj, beta, d, l1, l2, tol, 
+                                   max_sweeps)
+            betas[k, :, j] = beta
+    if y.ndim == 1:
+        betas, n_sweeps = betas[:, :, 0], n_sweeps[:, 0]
+    return betas, lambdas, n_sweeps
+    
+ 
+def cho_backsolve(L, b):
+    '''
+    Solves LL'x = b by forward and back substitution
+    '''
+    return sp.linalg.cho_solve((L, True), b)
+
 
+def lars_path(X, y, method='lasso', max_steps=None, lambda_min=0.0, 
+              eps=1e-12):
+    '''
+    Least angle regression path, or with method='lasso' the exact lasso 
+    path, for the objective
+    
+    \\frac{1}{2n}||y-X\\beta||_{2}^{2} + \\lambda||\\beta||_{1}
+    
+    At each step the coefficients of the active set move in the 
+    equiangular direction, solved for from the cholesky factor of the 
+    active Gram matrix, until another column attains the same absolute
+    correlation with the residual and joins the active set, the factor 
+    then being extended by a row.  For the lasso, a coefficient crossing 
+    zero ends the step early, and its column is dropped from the active set
+    and from the factor by a rank one update.  The knots are reached after
+    O(k^{2}) work on the factor, and O(pk) on the correlations, per step.
+    
+    Parameters
+    ----------
+    X : array
+        n by p design matrix
+    y : array
+        response
+    method : str
+        'lasso' or 'lar'
+    max_steps : int, optional
+        maximum number of steps; by default 8 * min(n, p) for the lasso 
+        and min(n, p) for lar
+    lambda_min : float
+        penalty at which the path stops
+    eps : float
+        relative tolerance below which a column is treated as linearly
+        dependent on the active set; such a column is passed over, without
+        taking a step, until a column is dropped from the active set.  The
+        path also ends once the largest absolute correlation falls below 
+        eps times its initial value
+    
+    Returns
+    -------
+    betas : array
+        coefficients at the knots of the path, starting from zero
+    lambdas : array
+        penalties at the knots, i.e. the largest absolute correlation 
+        divided by n
+    active : list
+        active set at the end of the path, in order of entry
+    '''
+    if method not in ['lasso', 'lar']:
+        raise ValueError("method must be one of 'lasso' or 'lar'")
+    X = np.asarray(X, dtype=float)
+    y = linalg_utils._check_1d(np.asarray(y, dtype=float))
+    n, p = X.shape
+    if max_steps is None:
+        max_steps = min(n, p) * (8 if method == 'lasso' else 1)
+    Gram, C = X.T.dot(X), X.T.dot(y)
+    beta = np.zeros(p)
+    active, signs, L = [], [], None
+    inactive = np.ones(p, dtype=bool)
+    # inactive columns found to be dependent on the active set, which may
+    # only enter again after a column has been dropped
+    rejected = np.zeros(p, dtype=bool)
+    betas, lambdas = [beta.copy()], [np.max(np.abs(C)) / n]
+    drop = None
+    for step in range(max_steps):
+        if drop is None:
+            # a column enters only once its correlation has reached that of
+            # the active set; otherwise the active set takes another step
+            Cmin = (1.0 - np.sqrt(eps)) * np.max(np.abs(C[active])) \
+                   if len(active) > 0 else 0.0
+            cand = np.flatnonzero(inactive & ~rejected)
+            while len(cand) > 0:
+                j = cand[np.argmax(np.abs(C[cand]))]
+                if np.abs(C[j]) < Cmin:
+                    break
+                Lj = linalg_utils.add_chol_row(Gram[j, j], Gram[j, active], L)
+                if Lj[-1, -1] > np.sqrt(eps * Gram[j, j]):
+                    L = Lj
+                    active.append(j)
+                    signs.append(np.sign(C[j]))
+                    inactive[j] = False
+                    break
+                rejected[j] = True
+                cand = cand[cand!=j]
+            if len(active) == 0:
+                break
+        Cmax = np.max(np.abs(C[active]))
+        if Cmax / n <= max(lambda_min, eps * lambdas[0]):
+            break
+        s = np.array(signs)
+        w = cho_backsolve(L, s)
+        AA = 1.0 / np.sqrt(np.dot(w, s))
+        w *= AA
+        a = Gram[:, active].dot(w)
+        gamma = Cmax / AA
+        cand = np.flatnonzero(inactive & ~rejected)
+        if len(cand) > 0:
+            # a column that duplicates an active one gives 0/0, and one 
+            # that cannot reach Cmax a nonpositive or infinite step; 
+            # neither limits gamma
+            with np.errstate(divide='ignore', invalid='ignore'):
+                g = np.concatenate([(Cmax - C[cand]) / (AA - a[cand]),
+                                    (Cmax + C[cand]) / (AA + a[cand])])
+            g = g[np.isfinite(g) & (g > eps * gamma)]
+            if len(g) > 0:
+                gamma = min(gamma, np.min(g))
+        gamma_end = (Cmax - n * lambda_min) / AA
+        gamma = min(gamma, gamma_end)
+        drop = None
+        if method == 'lasso':
+            z = -beta[active] / w
+            pos = np.flatnonzero(z > eps * gamma)
+            if len(pos) > 0 and np.min(z[pos]) < gamma:
+                drop = pos[np.argmin(z[pos])]
+                gamma = z[drop]
+        beta[active] += gamma * w
+        C -= gamma * a
+        if drop is not None:
+            j = active.pop(drop)
+            signs.pop(drop)
+            beta[j] = 0.0
+            inactive[j] = True
+            rejected[:] = False
+            L = linalg_utils.chol_delete(L, drop)
+        betas.append(beta.copy())
+        lambdas.append((Cmax - gamma * AA) / n)
+        if len(active) == 0 or (drop is None and gamma >= gamma_end):
+            break
+    return np.array(betas), np.array(lambdas), active
 
-def cho_backsolve(A, b):
-    return np.linalg.inv(A.dot(A.T)).dot(b)
 
 def lars(X, y):
-    n, p = X.shape
-    Cov, Gram = X.T.dot(y), X.T.dot(X)
-    L, betas = Gram.copy(), np.zeros((p, p))
-    active_set, ix = [], np.arange(p)
-    signs = np.zeros(p)
-    for i in range(p):
-        Cabs = np.abs(Cov)
-        Cmax_j = np.argmax(Cabs)
-        Cmax, Cabsmax = Cov[Cmax_j], Cabs[Cmax_j]
-
-        signs[i] = np.sign(Cmax)
-        Gram, Cov, ix = reorder_gram(Gram, ix, Cov, Cmax_j, i)
-        L = linalg_utils.add_chol_row(Gram[i, i], Gram[i, :i], L[:i, :i])
-        active_set.append(ix[i])
-        j, k = i-1, i+1
-        sign_i = signs[:k]
-        w = cho_backsolve(L[:k, :k], sign_i)
-        A = np.sqrt(1.0 / np.sum(w * sign_i))
-        w *= A
-        aj = np.dot(Gram[:k, k:].T, w)
-        gamhat = get_gamma(Cabsmax, Cov, A, aj)
-        betas[i, active_set] = betas[j, active_set] + gamhat * w
-
-        Cov -= gamhat * aj
-    return active_set, betas
+    '''
+    Least angle regression, returning the order in which the columns of X
+    enter and the coefficients after each step
+    '''
+    betas, _, active = lars_path(X, y, method='lar')
+    return active, betas[1:]
 
 
+def benchmark_lars(n_obs=1000, n_feats=(50, 100, 200, 400, 800), 
+                   n_nonzero=10, repeat=3, seed=0):
+    '''
+    Times the lasso path by lars_path and by coordinate descent 
+    (eln_path with alpha=1, at the penalties of the knots of the lars path)
+    on standardized simulated data, for a growing number of columns
+    
+    Parameters
+    ----------
+    n_obs : int
+        number of observations
+    n_feats : tuple
+        numbers of columns
+    n_nonzero : int
+        number of nonzero coefficients of the simulated model
+    repeat : int
+        number of timed calls, of which the minimum is reported
+    
+    Returns
+    -------
+    report : DataFrame
+        one row per number of columns with the number of knots, the times
+        in seconds of both methods, and the largest difference of the 
+        coefficients at the knots
+    '''
+    rng = np.random.default_rng(seed)
+    records = []
+    for p in n_feats:
+        X = base_utils.csd(rng.normal(size=(n_obs, p)))
+        b = np.zeros(p)
+        b[:n_nonzero] = rng.normal(size=min(n_nonzero, p))
+        y = base_utils.csd(X.dot(b) + rng.normal(size=n_obs))
+        tl = tc = np.inf
+        for i in range(repeat):
+            t = time.time()
+            betas, lambdas, _ = lars_path(X, y)
+            tl = min(tl, time.time() - t)
+            t = time.time()
+            betas_cd, _, _ = eln_path(X, y, alpha=1.0, lambdas=lambdas[1:],
+                                      tol=1e-14)
+            tc = min(tc, time.time() - t)
+        records.append(dict(n_obs=n_obs, n_feats=p, n_knots=len(lambdas), 
+                            lars=tl, coordinate_descent=tc, 
+                            lars_speedup=tc/tl, 
+                            max_abs_diff=np.max(np.abs(betas[1:]-betas_cd))))
+    report = pd.DataFrame(records)
+    return report
 
- 
 
 def penalized_glm_cd(X, y, f=None, lambda_=0.1, alpha=0.5, n_iters=20,
                      tol=1e-4, vocal=False):
+    '''
+    Elastic net penalized GLM at a single lambda, without an intercept, 
+    for the centered and standardized columns of X (base_utils.csd), 
+    minimizing
+    
+    D(\\beta)/(2n) + \\lambda[(1-\\alpha)/2 ||\\beta||_{2}^{2} 
+    + \\alpha ||\\beta||_{1}]
+    
+    where D is the deviance, by the penalized IRLS and coordinate descent
+    of penalized_glm_path started from zero coefficients.
+    
+    Parameters
+    ----------
+    X : array
+        n by p design matrix
+    y : array
+        response
+    f : ExponentialFamily
+        family of the response, by default Binomial
+    lambda_ : float
+        penalty
+    alpha : float
+        mixing parameter between the l1 and l2 penalties
+    n_iters : int
+        maximum number of IRLS steps
+    tol : float
+        convergence tolerance of IRLS, on the relative change of the 
+        deviance
+    vocal : bool
+        whether to print the objective at each IRLS step
+    
+    Returns
+    -------
+    loglikes : list
+        the penalized objective at the start of each IRLS step (and at the
+        solution for the Gaussian)
+    beta : array
+        coefficients of the standardized columns of X
+    '''
     if f is None:
         f = Binomial()
-    X = base_utils.csd(X)
+    X = np.asfortranarray(base_utils.csd(X), dtype=float)
+    y = linalg_utils._check_1d(np.asarray(y, dtype=float))
     n, p = X.shape
-    active = np.ones(p).astype(bool)
-    beta = np.linalg.pinv(X).dot(y)
-    la, dn = lambda_ * alpha, lambda_ * (1  - alpha) + 1.0
-    loglikes, llprev = [], 1e16
-    X2 = X**2
-    
-    for i in range(n_iters):
-        
-        for j in range(p):
-            
-            active[j] = False
-            eta = X[:, active].dot(beta[active])
-            z, w = working_variate(f, eta, y)
-            bj  = weighted_update(X, X2, w, z, eta, la, dn)[~active]
-            beta[j] = bj
-            active[j] = True
-            
-            if vocal:
-                print(i, j)
-                
-            llcurr = weighted_penalized_loglike(beta, X, w, z, lambda_, alpha)
-            
-            if np.abs(llprev - llcurr)<tol: 
-                break
-            
-            llprev = llcurr
-            loglikes.append(llcurr)
-            
+    exact = isinstance(f, Gaussian) and isinstance(f._link, IdentityLink)
+    s, usable = np.ones(p), np.ones(p, dtype=bool)
+    beta, xm, v = np.zeros(p), np.zeros(p), np.zeros(p)
+    loglikes = []
+    _penalized_irls(X, y, f, beta, 0.0, usable.copy(), usable, s, xm, v, 
+                    lambda_ * alpha, lambda_ * (1.0 - alpha), False, exact,
+                    1e-7, tol, 1000, n_iters, trace=loglikes)
+    if vocal:
+        for i, ll in enumerate(loglikes):
+            print(i, ll)
     return loglikes, beta
-       
 
+
+def _cd_sweep(X, ix, w, r, beta, s, xm, v, l1, l2):
+    '''
+    One cycle of coordinate descent over the columns ix for the weighted
+    least squares elastic net problem in the standardized coefficients 
+    beta, with the columns of X scaled by s and centered at xm.  The 
+    weighted residuals r and beta are updated in place.  Returns the 
+    change of the intercept implied by the centering and the largest 
+    change of a coefficient, weighted by its curvature v
+    '''
+    da, dlx = 0.0, 0.0
+    for j in ix:
+        den = v[j] + l2
+        if den<=0:
+            continue
+        xj, bj = X[:, j], beta[j]
+        u = xj.dot(r) / s[j] + v[j] * bj
+        bn = np.sign(u) * max(abs(u) - l1, 0.0) / den
+        d = bn - bj
+        if d!=0:
+            beta[j] = bn
+            c = d / s[j]
+            r -= c * (w * xj)
+            if xm[j]!=0:
+                r += (c * xm[j]) * w
+                da -= c * xm[j]
+            dlx = max(dlx, v[j] * d**2)
+    return da, dlx
+
+
+def _linear_predictor(X, ix, coef, a0):
+    '''
+    a0 + X[:, ix].dot(coef[ix]), accumulated column by column so that the
+    columns ix of X are not copied
+    '''
+    eta = np.full(X.shape[0], a0)
+    for j in ix:
+        eta += coef[j] * X[:, j]
+    return eta
+
+
+def _weighted_moments(X, ix, w, s, xm, v, intercept):
+    '''
+    Weighted means xm (if intercept) and weighted variances v, divided by 
+    s**2, of the columns ix of X, computed in place column by column.  
+    Returns the sum of the weights
+    '''
+    wsum = np.sum(w)
+    for j in ix:
+        xj = X[:, j]
+        wx = w * xj
+        if intercept:
+            xm[j] = np.sum(wx) / wsum
+        v[j] = (wx.dot(xj) - wsum * xm[j]**2) / s[j]**2
+    return wsum
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _cd_sweep_kernel(X, ix, w, r, beta, s, xm, v, l1, l2):
+        '''
+        Compiled equivalent of _cd_sweep, making one pass down the column
+        (of X in column major order) for its inner product with r and one 
+        for the update of r
+        '''
+        n = X.shape[0]
+        da, dlx = 0.0, 0.0
+        for j in ix:
+            den = v[j] + l2
+            if den<=0:
+                continue
+            g = 0.0
+            for i in range(n):
+                g += X[i, j] * r[i]
+            u = g / s[j] + v[j] * beta[j]
+            if u > l1:
+                bn = (u - l1) / den
+            elif u < -l1:
+                bn = (u + l1) / den
+            else:
+                bn = 0.0
+            d = bn - beta[j]
+            if d!=0:
+                beta[j] = bn
+                c = d / s[j]
+                cm = c * xm[j]
+                for i in range(n):
+                    r[i] -= (c * X[i, j] - cm) * w[i]
+                da -= cm
+                dlx = max(dlx, v[j] * d**2)
+        return da, dlx
+
+    @numba.njit(cache=True)
+    def _linear_predictor_kernel(X, ix, coef, a0):
+        '''
+        Compiled equivalent of _linear_predictor
+        '''
+        n = X.shape[0]
+        eta = np.full(n, a0)
+        for j in ix:
+            c = coef[j]
+            for i in range(n):
+                eta[i] += c * X[i, j]
+        return eta
+
+    @numba.njit(cache=True)
+    def _weighted_moments_kernel(X, ix, w, s, xm, v, intercept):
+        '''
+        Compiled equivalent of _weighted_moments, making one pass down each
+        column
+        '''
+        n = X.shape[0]
+        wsum = 0.0
+        for i in range(n):
+            wsum += w[i]
+        for j in ix:
+            sx, sxx = 0.0, 0.0
+            for i in range(n):
+                wx = w[i] * X[i, j]
+                sx += wx
+                sxx += wx * X[i, j]
+            if intercept:
+                xm[j] = sx / wsum
+            v[j] = (sxx - wsum * xm[j]**2) / s[j]**2
+        return wsum
+else:
+    _cd_sweep_kernel = None
+    _linear_predictor_kernel = None
+    _weighted_moments_kernel = None
+
+
+def _penalized_irls(X, y, f, beta, a0, strong, usable, s, xm, v, l1, l2, 
+                    intercept, exact, tol, irls_tol, max_sweeps, max_irls,
+                    trace=None):
+    '''
+    Penalized IRLS at a single lambda, with the weighted least squares 
+    problems solved by coordinate descent over the strong set, from the
+    standardized coefficients beta and the intercept a0.  beta, strong, xm
+    and v are updated in place, KKT violators being added to strong.  The
+    columns of X are only accessed through the compiled kernels when numba
+    is available, and never copied.  If trace is a list, the penalized 
+    objective D/(2n) + l1||beta||_{1} + l2/2||beta||_{2}^{2} at the start
+    of each IRLS step (and at the solution for the Gaussian) is appended 
+    to it.  Returns the intercept, the absolute gradient of the columns,
+    divided by s, and the deviance at the solution
+    '''
+    n = X.shape[0]
+    if _cd_sweep_kernel is None:
+        sweep, predict, moments = (_cd_sweep, _linear_predictor,
+                                   _weighted_moments)
+    else:
+        sweep, predict, moments = (_cd_sweep_kernel, 
+                                   _linear_predictor_kernel,
+                                   _weighted_moments_kernel)
+    objective = lambda dev: (dev / (2.0 * n) + l1 * np.sum(np.abs(beta)) 
+                             + l2 / 2.0 * np.sum(beta**2))
+    while True:
+        dev_prev = None
+        for it in range(max_irls):
+            eta = predict(X, np.flatnonzero(beta), beta / s, a0)
+            _, w, gw, dev = f.irls_weights(y, eta)
+            if trace is not None:
+                trace.append(objective(dev))
+            w, r = w / n, -gw / n
+            bad = ~np.isfinite(w) | ~np.isfinite(r)
+            w[bad], r[bad] = 0.0, 0.0
+            if dev_prev is not None and \
+                np.abs(dev - dev_prev) < irls_tol * (np.abs(dev) + 0.1):
+                break
+            S = np.flatnonzero(strong)
+            wsum = moments(X, S, w, s, xm, v, intercept)
+            if intercept:
+                da = np.sum(r) / wsum
+                a0, r = a0 + da, r - w * da
+            for i in range(max_sweeps):
+                da, dlx = sweep(X, S, w, r, beta, s, xm, v, l1, l2)
+                a0 += da
+                if dlx < tol:
+                    break
+                for t in range(max_sweeps):
+                    A = S[beta[S]!=0]
+                    da, dlx = sweep(X, A, w, r, beta, s, xm, v, l1, l2)
+                    a0 += da
+                    if dlx < tol:
+                        break
+            dev_prev = dev
+            if exact:
+                break
+        grad = np.abs(X.T.dot(r)) / s
+        grad[~usable] = 0.0
+        violators = ~strong & usable & (grad > l1)
+        if not np.any(violators):
+            break
+        strong |= violators
+    # the deviance at the final coefficients, computed as for the null
+    # deviance by the family for every family
+    dev = f.irls_weights(y, predict(X, np.flatnonzero(beta), beta / s, a0))[3]
+    if trace is not None and exact:
+        trace.append(objective(dev))
+    return a0, grad, dev
+
+
+
+
+def penalized_glm_path(X, y, f=None, alpha=0.5, lambdas=None, n_lambdas=100,
+                       lambda_min_ratio=None, intercept=True, standardize=True,
+                       tol=1e-7, irls_tol=1e-8, max_sweeps=1000, max_irls=50):
+    '''
+    Elastic net penalized GLM fit over a decreasing sequence of lambdas by
+    pathwise coordinate descent, minimizing
+    
+    -\\frac{1}{n}loglike(\\beta) + \\lambda[(1-\\alpha)/2 ||\\beta||_{2}^{2} + 
+    \\alpha ||\\beta||_{1}]
+    
+    Each lambda is warm started from the previous solution.  An outer 
+    IRLS loop forms the weights and working residuals of the family (from
+    its compiled kernel if any), and the penalized weighted least squares
+    problem is solved by coordinate descent restricted to the strong set,
+    i.e. the previously active columns and those whose gradient at the
+    previous lambda exceeds \\alpha(2\\lambda_{k}-\\lambda_{k-1}).  Full 
+    sweeps of the strong set alternate with cycles over its nonzero 
+    coefficients until neither changes, after which the KKT conditions are
+    checked for all columns and any violators added to the strong set.
+    The columns are standardized implicitly, and those of the strong set
+    and the active set are indexed in place, so X is not copied unless it
+    is not a float array in column major order.  The coordinate descent 
+    cycles, and the linear predictor and weighted column moments of each
+    IRLS step, are compiled with numba when it is available.  
+    
+    The deviance of every family, including the Gaussian, is that of the
+    family's irls_weights at the coefficients of each lambda, and the null
+    deviance that of the intercept only (or zero) model.  The path stops 
+    early, after the first lambda at which the fraction of the null 
+    deviance explained exceeds 0.999, as beyond it the fit changes little
+    while the solution becomes slow to compute; the returned arrays are
+    then shorter than n_lambdas.
+    
+    Parameters
+    ----------
+    X : array
+        n by p design matrix, without a column of ones
+    y : array
+        response
+    f : ExponentialFamily
+        family of the response, by default Binomial; Binomial, Poisson and
+        Gaussian with their canonical links are supported, in which case a
+        single weighted least squares problem is solved per lambda
+    alpha : float
+        mixing parameter between the l1 (alpha=1, lasso) and l2 (alpha=0,
+        ridge) penalties
+    lambdas : array, optional
+        sequence of penalties, used in decreasing order
+    n_lambdas : int
+        length of the default sequence, which is log spaced from the 
+        smallest lambda at which all coefficients are zero
+    lambda_min_ratio : float
+        ratio of the smallest to the largest default lambda; 1e-4 if n > p
+        and 1e-2 otherwise
+    intercept : bool
+        whether to fit an (unpenalized) intercept
+    standardize : bool
+        whether to penalize the coefficients of the columns scaled to unit
+        variance; coefficients are always returned on the scale of X
+    tol : float
+        convergence tolerance of coordinate descent, on the largest change
+        of a coefficient weighted by its curvature
+    irls_tol : float
+        convergence tolerance of IRLS, on the relative change of the 
+        deviance
+    max_sweeps : int
+        maximum number of coordinate descent cycles per IRLS step
+    max_irls : int
+        maximum number of IRLS steps per lambda
+    
+    Returns
+    -------
+    betas : array
+        n_lambdas by p array of coefficients
+    intercepts : array
+        intercepts along the path
+    lambdas : array
+        penalties along the path
+    dev_ratio : array
+        fraction of the null deviance explained along the path, 
+        1-D(\\beta)/D_{0}
+    '''
+    if f is None:
+        f = Binomial()
+    X = np.asfortranarray(X, dtype=float)
+    y = linalg_utils._check_1d(np.asarray(y, dtype=float))
+    n, p = X.shape
+    exact = isinstance(f, Gaussian) and isinstance(f._link, IdentityLink)
+    if standardize:
+        m = X.mean(axis=0)
+        s = np.sqrt(np.maximum(np.einsum('ij,ij->j', X, X) / n - m**2, 0.0))
+        usable = s>0
+        s[~usable] = 1.0
+    else:
+        s, usable = np.ones(p), np.ones(p, dtype=bool)
+    
+    a0 = f.link(np.mean(y)) if intercept else 0.0
+    beta, xm, v = np.zeros(p), np.zeros(p), np.zeros(p)
+    _, _, gw, null_dev = f.irls_weights(y, np.full(n, a0))
+    grad = np.abs(X.T.dot(-gw / n)) / s
+    grad[~usable] = 0.0
+    lambda_max = np.max(grad) / max(alpha, 1e-3)
+    if lambdas is None:
+        if lambda_min_ratio is None:
+            lambda_min_ratio = 1e-4 if n > p else 1e-2
+        lambdas = lambda_max * np.logspace(0, np.log10(lambda_min_ratio), 
+                                           n_lambdas)
+    else:
+        lambdas = np.sort(np.asarray(lambdas, dtype=float))[::-1]
+    n_lambdas = len(lambdas)
+    betas, intercepts = np.zeros((n_lambdas, p)), np.zeros(n_lambdas)
+    dev_ratio = np.zeros(n_lambdas)
+    ever_active = np.zeros(p, dtype=bool)
+    lambda_prev = max(lambda_max, lambdas[0])
+    for k, lambda_ in enumerate(lambdas):
+        l1, l2 = lambda_ * alpha, lambda_ * (1.0 - alpha)
+        strong = usable & (ever_active | (grad >= alpha * (2.0 * lambda_ - 
+                                                            lambda_prev)))
+        a0, grad, dev = _penalized_irls(X, y, f, beta, a0, strong, usable, s,
+                                        xm, v, l1, l2, intercept, exact, tol,
+                                        irls_tol, max_sweeps, max_irls)
+        ever_active |= beta!=0
+        lambda_prev = lambda_
+        betas[k], intercepts[k] = beta / s, a0
+        dev_ratio[k] = 1.0 - dev / null_dev
+        if dev_ratio[k] > 0.999:
+            betas, intercepts = betas[:k+1], intercepts[:k+1]
+            lambdas, dev_ratio = lambdas[:k+1], dev_ratio[:k+1]
+            break
+    return betas, intercepts, lambdas, dev_ratio
+
+
+# Shared arrays and settings held by each cross validation worker
+_CV_STATE = {}
+
+
+def _cv_folds(n, n_folds, folds=None, seed=None):
+    '''
+    Fold label of each observation, a random permutation of 0, ..., 
+    n_folds-1 repeated over the observations unless folds is given
+    '''
+    if folds is None:
+        rng = np.random.default_rng(seed)
+        folds = rng.permutation(np.arange(n) % n_folds)
+    folds = np.asarray(folds)
+    _, folds = np.unique(folds, return_inverse=True)
+    return folds
+
+
+def _cv_summary(errors, sizes, lambdas, n_nonzero):
+    '''
+    CV curve from the n_folds by n_lambdas errors, as the mean over the 
+    observations with the standard error of the fold means, and the 
+    lambdas minimizing it and the largest lambda within one standard 
+    error of the minimum
+    '''
+    w = sizes / np.sum(sizes)
+    cvm = w.dot(errors)
+    cvsd = np.sqrt(w.dot((errors - cvm)**2) / max(len(sizes) - 1, 1))
+    i = np.nanargmin(cvm)
+    lambda_min = lambdas[i]
+    lambda_1se = np.max(lambdas[cvm <= cvm[i] + cvsd[i]])
+    cv_res = pd.DataFrame(np.vstack([cvm, cvsd, cvm - cvsd, cvm + cvsd, 
+                                     n_nonzero]).T,
+                          index=pd.Index(lambdas, name='lambda'),
+                          columns=['cv_mean', 'cv_se', 'cv_lower', 
+                                   'cv_upper', 'n_nonzero'])
+    return cv_res, lambda_min, lambda_1se
+
+
+def _cv_map(fold_func, n_folds, state, arrays, n_jobs):
+    '''
+    Evaluates fold_func on each fold in a pool of n_jobs processes (or the
+    current process if n_jobs=1), which attach to arrays through shared 
+    memory
+    '''
+    blocks, specs = base_utils.share_arrays(arrays)
+    try:
+        if n_jobs==1:
+            _cv_init(state, specs)
+            out = [fold_func(k) for k in range(n_folds)]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=min(n_jobs, n_folds), initializer=_cv_init,
+                    initargs=(state, specs)) as pool:
+                out = list(pool.map(fold_func, range(n_folds)))
+    finally:
+        _CV_STATE.clear()
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    return out
+
+
+def _cv_init(state, specs):
+    '''
+    Attaches to the shared arrays and stores them with the settings
+    '''
+    arrays, blocks = base_utils.attach_arrays(specs)
+    _CV_STATE.update(state, arrays=arrays, blocks=blocks)
+
+
+def _cv_eln_fold(k):
+    '''
+    Elastic net path on the training observations of fold k, from its 
+    standardized Gram matrix (or standardized X if no Gram matrices are 
+    shared), and the mean squared error of the predictions of the held out
+    observations along the path
+    '''
+    arrays, lambdas = _CV_STATE['arrays'], _CV_STATE['lambdas']
+    alpha = _CV_STATE['alpha']
+    X, y, test = arrays['X'], arrays['y'], arrays['folds']==k
+    xm, xs, ym, ys = (arrays['xm'][k], arrays['xs'][k], arrays['ym'][k], 
+                      arrays['ys'][k])
+    if 'G' in arrays:
+        sweep = _eln_gram_sweeps if _eln_gram_kernel is None else \
+                _eln_gram_kernel
+        A, state = arrays['G'][k], arrays['c'][k].copy()
+        d = np.diag(A).copy()
+    else:
+        sweep = _eln_resid_sweeps if _eln_resid_kernel is None else \
+                _eln_resid_kernel
+        A = np.asfortranarray((X[~test] - xm) / xs)
+        d, state = np.einsum('ij,ij->j', A, A) / A.shape[0], \
+                   (y[~test] - ym) / ys
+    beta = np.zeros(len(xm))
+    betas = np.zeros((len(lambdas), len(xm)))
+    for i, lambda_ in enumerate(lambdas):
+        l1, l2 = lambda_ * alpha, lambda_ * (1.0 - alpha)
+        sweep(A, state, beta, d, l1, l2, _CV_STATE['tol'], 
+              _CV_STATE['max_sweeps'])
+        betas[i] = beta
+    B = betas / xs
+    yhat = ym + ys * (X[test].dot(B.T) - xm.dot(B.T))
+    err = np.mean((y[test][:, None] - yhat)**2, axis=0)
+    return err
+
+
+def _cv_glm_fold(k):
+    '''
+    Penalized GLM path on the training observations of fold k, and the 
+    mean deviance of the held out observations along the path.  Should 
+    the path stop early, the last solution is carried to the remaining 
+    lambdas
+    '''
+    arrays, lambdas, f = _CV_STATE['arrays'], _CV_STATE['lambdas'], \
+                         _CV_STATE['f']
+    X, y, test = arrays['X'], arrays['y'], arrays['folds']==k
+    betas, intercepts, _, _ = penalized_glm_path(X[~test], y[~test], f=f, 
+                                                 lambdas=lambdas, 
+                                                 **_CV_STATE['kws'])
+    m = len(intercepts)
+    eta = X[test].dot(betas.T) + intercepts
+    err = np.zeros(len(lambdas))
+    for i in range(len(lambdas)):
+        err[i] = f.irls_weights(y[test], eta[:, min(i, m-1)])[3]
+    return err / np.sum(test)
+
+
+def cv_eln(X, y, alpha=0.5, lambdas=None, n_lambdas=100, 
+           lambda_min_ratio=None, n_folds=10, folds=None, seed=None, 
+           n_jobs=1, tol=1e-9, max_sweeps=1000, method='auto'):
+    '''
+    K-fold cross validation of the elastic net path of eln_path, with the
+    folds run in a pool of n_jobs processes.  The standardization of each
+    training set, and in the covariance form its standardized Gram matrix
+    and gradient, are computed once in the calling process, by subtracting
+    the cross products of the held out fold from those of the whole data,
+    and shared with the workers, together with X and y, through shared 
+    memory.  The held out predictions are made on the original scale of 
+    y.
+    
+    Parameters
+    ----------
+    X : array
+        n by p design matrix
+    y : array
+        response vector
+    alpha : float
+        mixing parameter between the l1 and l2 penalties
+    lambdas : array, optional
+        sequence of penalties; by default that of eln_path on the whole 
+        data
+    n_lambdas : int
+        length of the default sequence
+    lambda_min_ratio : float
+        ratio of the smallest to the largest default lambda
+    n_folds : int
+        number of folds
+    folds : array, optional
+        fold label of each observation, overriding n_folds and seed
+    seed : int, optional
+        seed of the random assignment to folds
+    n_jobs : int
+        number of worker processes; with n_jobs=1 the folds are run in the
+        current process
+    tol : float
+        convergence tolerance of coordinate descent
+    max_sweeps : int
+        maximum number of sweeps per lambda
+    method : str
+        'gram', 'resid', or 'auto' to use the former if n >= p
+    
+    Returns
+    -------
+    cv_res : DataFrame
+        CV curve indexed by lambda, with the mean squared error, its 
+        standard error and one standard error band, and the number of 
+        nonzero coefficients of the fit to the whole data
+    lambda_min : float
+        lambda minimizing the CV error
+    lambda_1se : float
+        largest lambda whose CV error is within one standard error of the
+        minimum
+    betas : array
+        path of standardized coefficients fit to the whole data
+    '''
+    X = np.asarray(X, dtype=float)
+    y = linalg_utils._check_1d(np.asarray(y, dtype=float))
+    n, p = X.shape
+    betas, lambdas, _ = eln_path(X, y, alpha=alpha, lambdas=lambdas, 
+                                 n_lambdas=n_lambdas, 
+                                 lambda_min_ratio=lambda_min_ratio, tol=tol,
+                                 max_sweeps=max_sweeps, method=method)
+    folds = _cv_folds(n, n_folds, folds, seed)
+    n_folds = folds.max() + 1
+    sizes = np.bincount(folds).astype(float)
+    if method == 'auto':
+        method = 'gram' if n - sizes.max() >= p else 'resid'
+    gram = method == 'gram'
+    Sxx = X.T.dot(X) if gram else np.einsum('ij,ij->j', X, X)
+    Sx, Sxy, Sy, Syy = X.sum(axis=0), X.T.dot(y), y.sum(), y.dot(y)
+    xm, xs = np.zeros((n_folds, p)), np.zeros((n_folds, p))
+    ym, ys = np.zeros(n_folds), np.zeros(n_folds)
+    if gram:
+        G, c = np.zeros((n_folds, p, p)), np.zeros((n_folds, p))
+    for k in range(n_folds):
+        Xk, yk = X[folds==k], y[folds==k]
+        nt = n - sizes[k]
+        xm[k], ym[k] = (Sx - Xk.sum(axis=0)) / nt, (Sy - yk.sum()) / nt
+        ys[k] = np.sqrt((Syy - yk.dot(yk)) / nt - ym[k]**2)
+        if gram:
+            C = (Sxx - Xk.T.dot(Xk)) / nt - np.outer(xm[k], xm[k])
+            v = np.diag(C)
+        else:
+            v = (Sxx - np.einsum('ij,ij->j', Xk, Xk)) / nt - xm[k]**2
+        xs[k] = np.sqrt(np.maximum(v, 0.0))
+        xs[k][xs[k]<=1e-12 * (1.0 + np.abs(xm[k]))] = np.inf
+        if gram:
+            G[k] = C / np.outer(xs[k], xs[k])
+            c[k] = ((Sxy - Xk.T.dot(yk)) / nt - xm[k] * ym[k]) / (xs[k] * 
+                                                                  ys[k])
+    xs[np.isinf(xs)] = 1.0
+    arrays = {'X': X, 'y': y, 'folds': folds, 'xm': xm, 'xs': xs, 'ym': ym,
+              'ys': ys}
+    if gram:
+        arrays.update(G=G, c=c)
+    state = {'lambdas': lambdas, 'alpha': alpha, 'tol': tol, 
+             'max_sweeps': max_sweeps}
+    errors = np.vstack(_cv_map(_cv_eln_fold, n_folds, state, arrays, n_jobs))
+    n_nonzero = np.sum(betas!=0, axis=1)
+    cv_res, lambda_min, lambda_1se = _cv_summary(errors, sizes, lambdas, 
+                                                 n_nonzero)
+    return cv_res, lambda_min, lambda_1se, betas
+
+
+def cv_penalized_glm(X, y, f=None, alpha=0.5, lambdas=None, n_folds=10, 
+                     folds=None, seed=None, n_jobs=1, **kws):
+    '''
+    K-fold cross validation of the penalized GLM path of 
+    penalized_glm_path, with the folds run in a pool of n_jobs processes
+    that attach to X and y through shared memory.  The path is first fit
+    to the whole data, and its lambdas used for every fold, the error of 
+    which is the mean deviance of its held out observations.
+    
+    Parameters
+    ----------
+    X : array
+        n by p design matrix, without a column of ones
+    y : array
+        response
+    f : ExponentialFamily
+        family of the response, by default Binomial
+    alpha : float
+        mixing parameter between the l1 and l2 penalties
+    lambdas : array, optional
+        sequence of penalties; by default that of penalized_glm_path on the
+        whole data
+    n_folds : int
+        number of folds
+    folds : array, optional
+        fold label of each observation, overriding n_folds and seed
+    seed : int, optional
+        seed of the random assignment to folds
+    n_jobs : int
+        number of worker processes; with n_jobs=1 the folds are run in the
+        current process
+    kws : dict
+        further arguments of penalized_glm_path
+    
+    Returns
+    -------
+    cv_res : DataFrame
+        CV curve indexed by lambda, with the mean deviance, its standard
+        error and one standard error band, and the number of nonzero 
+        coefficients of the fit to the whole data
+    lambda_min : float
+        lambda minimizing the CV deviance
+    lambda_1se : float
+        largest lambda whose CV deviance is within one standard error of 
+        the minimum
+    betas : array
+        path of coefficients fit to the whole data
+    intercepts : array
+        intercepts of the path fit to the whole data
+    '''
+    if f is None:
+        f = Binomial()
+    X = np.asarray(X, dtype=float)
+    y = linalg_utils._check_1d(np.asarray(y, dtype=float))
+    n = X.shape[0]
+    kws.update(alpha=alpha)
+    betas, intercepts, lambdas, _ = penalized_glm_path(X, y, f=f, 
+                                                       lambdas=lambdas, 
+                                                       **kws)
+    folds = _cv_folds(n, n_folds, folds, seed)
+    n_folds = folds.max() + 1
+    sizes = np.bincount(folds).astype(float)
+    arrays = {'X': X, 'y': y, 'folds': folds}
+    state = {'lambdas': lambdas, 'f': f, 'kws': kws}
+    errors = np.vstack(_cv_map(_cv_glm_fold, n_folds, state, arrays, n_jobs))
+    n_nonzero = np.sum(betas!=0, axis=1)
+    cv_res, lambda_min, lambda_1se = _cv_summary(errors, sizes, lambdas, 
+                                                 n_nonzero)
+    return cv_res, lambda_min, lambda_1se, betas, intercepts
@@ -6,9 +6,11 @@ Created on Wed Sep 11 18:39:49 2019
 @author: lukepinkel
 """
 
+import collections
 import pandas as pd
 import numpy as np
 from numpy.ma import masked_invalid
+from multiprocessing import shared_memory
 
 
 def check_type(X):
@@ -147,3 +149,127 @@ def corr(X, Y=None):
         
     return R
 
+
+
+class ParamCache(object):
+    
+    def __init__(self, maxsize=1):
+        '''
+        Cache of the quantities a model computes at a parameter vector (e.g.
+        the linear predictor and mean), so that the loglikelihood, gradient
+        and hessian evaluated at the same iterate share them.  Entries are
+        keyed on the exact values of the parameter vector, and the least
+        recently used entry is evicted once maxsize are held.
+        
+        Parameters
+        ----------
+        maxsize : int, default 1
+            Number of parameter vectors held
+        '''
+        self.maxsize = maxsize
+        self._store = collections.OrderedDict()
+        self.hits, self.misses = 0, 0
+    
+    def get(self, params, func):
+        '''
+        Returns func(params), computed only if params is not held
+        '''
+        params = np.asarray(params, dtype=float)
+        key = (params.shape, params.tobytes())
+        if key in self._store:
+            self._store.move_to_end(key)
+            self.hits += 1
+            return self._store[key]
+        self.misses += 1
+        value = func(params.copy())
+        self._store[key] = value
+        if len(self._store) > self.maxsize:
+            self._store.popitem(last=False)
+        return value
+    
+    def clear(self):
+        self._store.clear()
+
+
+def compress_rows(*arrays):
+    '''
+    Collapses the rows that are duplicated across all of arrays into a 
+    single row carrying its frequency.  Rows are hashed and the hashes 
+    factorized, so that the cost is linear in the number of rows; the 
+    grouping is then checked against the data and, should two distinct 
+    rows share a hash, recomputed exactly by sorting.
+    
+    Parameters
+    ----------
+    arrays : arrays
+        One or more arrays (e.g. X and y) with the same number of rows
+    
+    Returns
+    -------
+    compressed : list
+        The first occurrence of each unique row of each array, in order 
+        of first appearance
+    counts : array
+        Number of times each unique row occurs, for use as frequency 
+        weights
+    inverse : array
+        Index of the unique row of each original row, such that 
+        compressed[i][inverse] reproduces arrays[i]
+    '''
+    arrays = [np.asarray(a) for a in arrays]
+    n = arrays[0].shape[0]
+    Z = np.column_stack([a.reshape(n, -1) for a in arrays]).astype(float)
+    h = pd.util.hash_pandas_object(pd.DataFrame(Z), index=False).values
+    inverse, _ = pd.factorize(h)
+    first = np.zeros(inverse.max()+1, dtype=int)
+    first[inverse[::-1]] = np.arange(n)[::-1]
+    if not np.array_equal(Z[first][inverse], Z, equal_nan=True):
+        Zv = np.ascontiguousarray(Z).view(np.dtype((np.void, 
+                                                   Z.dtype.itemsize*Z.shape[1])))
+        _, first, inverse = np.unique(Zv.ravel(), return_index=True, 
+                                      return_inverse=True)
+    counts = np.bincount(inverse).astype(float)
+    compressed = [a[first] for a in arrays]
+    return compressed, counts, inverse
+
+
+def share_arrays(arrays):
+    '''
+    Copies arrays into shared memory blocks, returning the blocks and the
+    (name, shape, dtype) specifications needed to attach to them.  The 
+    caller closes and unlinks the blocks once the workers are done
+    
+    Parameters
+    ----------
+    arrays : dict
+        Arrays keyed by name
+    
+    Returns
+    -------
+    blocks : list
+        SharedMemory blocks holding the arrays
+    specs : dict
+        (name, shape, dtype) of the block holding each array
+    '''
+    blocks, specs = [], {}
+    for key, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        blocks.append(shm)
+        specs[key] = (shm.name, arr.shape, arr.dtype.str)
+    return blocks, specs
+
+
+def attach_arrays(specs):
+    '''
+    Attaches to the shared memory blocks described by specs (as returned 
+    by share_arrays), returning the arrays viewing them and the blocks, 
+    which must be kept referenced for as long as the arrays are used
+    '''
+    arrays, blocks = {}, []
+    for key, (name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        blocks.append(shm)
+        arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    return arrays, blocks
@@ -1085,17 +1085,162 @@ def fastls(X, y):
 
 
 def add_chol_row(xnew, xold, L=None):
+    '''
+    Lower cholesky factor of the matrix LL' bordered by the row and column
+    [xold, xnew], from that of LL', by one triangular solve.  If the 
+    bordered matrix is (numerically) singular, i.e. the new column is 
+    linearly dependent on the old ones, the last diagonal entry is zero
+    '''
     xtx = xnew
-    norm_xnew = np.sqrt(xtx)
+    norm_xnew = np.sqrt(max(xtx, 0.0))
     if L is None:
         L = np.atleast_2d(norm_xnew)
         return L
     else:
         Xtx = xold
-        r = sp.linalg.solve(L, Xtx)
-        rpp = np.sqrt(xtx - np.sum(r**2))
+        r = sp.linalg.solve_triangular(L, Xtx, lower=True)
+        d = xtx - np.sum(r**2)
+        rpp = np.sqrt(d) if d > 0 else 0.0
         A = np.block([[L, np.zeros((L.shape[0], 1))],
                        [r, np.atleast_1d(rpp)]])
         return A
 
 
+def chol_update(L, x, overwrite=False):
+    '''
+    Rank one update of a cholesky factor, i.e. the lower triangular factor 
+    of LL' + xx', in O(k^{2}) operations by a sequence of rotations
+    
+    Parameters
+    ----------
+    L: array
+        k by k lower triangular cholesky factor
+    
+    x: array
+        Vector of length k
+    
+    overwrite: bool
+        Whether L may be overwritten with the result
+    
+    Returns
+    -------
+    L: array
+        Updated factor
+    '''
+    L = L if overwrite else L.copy()
+    x = np.array(x, dtype=float)
+    k = len(x)
+    for i in range(k):
+        r = np.hypot(L[i, i], x[i])
+        c, s = r / L[i, i], x[i] / L[i, i]
+        L[i, i] = r
+        if i < k-1:
+            L[i+1:, i] = (L[i+1:, i] + s * x[i+1:]) / c
+            x[i+1:] = c * x[i+1:] - s * L[i+1:, i]
+    return L
+
+
+def chol_downdate(L, x, overwrite=False):
+    '''
+    Rank one downdate of a cholesky factor, i.e. the lower triangular 
+    factor of LL' - xx', in O(k^{2}) operations by a sequence of 
+    hyperbolic rotations.  Raises LinAlgError if LL' - xx' is not positive 
+    definite
+    
+    Parameters
+    ----------
+    L: array
+        k by k lower triangular cholesky factor
+    
+    x: array
+        Vector of length k
+    
+    overwrite: bool
+        Whether L may be overwritten with the result
+    
+    Returns
+    -------
+    L: array
+        Downdated factor
+    '''
+    L = L if overwrite else L.copy()
+    x = np.array(x, dtype=float)
+    k = len(x)
+    for i in range(k):
+        r2 = (L[i, i] - x[i]) * (L[i, i] + x[i])
+        if r2 <= 0:
+            raise np.linalg.LinAlgError("Downdated matrix is not positive "
+                                        "definite")
+        r = np.sqrt(r2)
+        c, s = r / L[i, i], x[i] / L[i, i]
+        L[i, i] = r
+        if i < k-1:
+            L[i+1:, i] = (L[i+1:, i] - s * x[i+1:]) / c
+            x[i+1:] = c * x[i+1:] - s * L[i+1:, i]
+    return L
+
+
+def chol_delete(L, j):
+    '''
+    Cholesky factor of LL' with its j-th row and column removed.  Rows 
+    after j lose their j-th entry, and the trailing block is restored to
+    triangular form by a rank one update with the removed column
+    
+    Parameters
+    ----------
+    L: array
+        k by k lower triangular cholesky factor
+    
+    j: int
+        Index of the row and column to remove
+    
+    Returns
+    -------
+    L: array
+        k-1 by k-1 factor
+    '''
+    x = L[j+1:, j].copy()
+    L = np.delete(np.delete(L, j, axis=0), j, axis=1)
+    if len(x) > 0:
+        L[j:, j:] = chol_update(L[j:, j:], x)
+    return L
+
+
+def wcrossprod(X, w=None, chunksize=4096):
+    '''
+    Weighted cross product X'diag(w)X, accumulated with the BLAS symmetric
+    rank-k update over blocks of rows, so that neither diag(w) nor a 
+    weighted copy of X is formed.  Half the flops of X'(wX) are needed.
+    For sparse X the product is formed as a sparse matrix product, and the
+    weights need not be nonnegative.
+    
+    Parameters
+    ----------
+    X : array or sparse matrix
+        n by p matrix
+    
+    w : array, default None
+        n vector of nonnegative weights, defaulting to ones
+    
+    chunksize : int, default 4096
+        Number of rows per block
+    
+    Returns
+    -------
+    A : array or csc_matrix
+        p by p symmetric matrix, sparse if X is
+    '''
+    if sps.issparse(X):
+        Xw = X if w is None else sps.diags(w).dot(X)
+        return sps.csc_matrix(X.T.dot(Xw))
+    n, p = X.shape
+    dsyrk = sp.linalg.blas.get_blas_funcs('syrk', (X,))
+    A = np.zeros((p, p), dtype=X.dtype, order='F')
+    for i in range(0, n, chunksize):
+        Xi = X[i:i+chunksize]
+        if w is not None:
+            Xi = Xi * np.sqrt(w[i:i+chunksize])[:, None]
+        A = dsyrk(1.0, Xi.T, beta=1.0, c=A, trans=0, lower=1, 
+                  overwrite_c=1)
+    A = np.tril(A) + np.tril(A, -1).T
+    return A
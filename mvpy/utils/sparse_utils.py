@@ -0,0 +1,774 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun May 17 10:12:41 2020
+
+@author: lukepinkel
+"""
+
+import numba # analysis:ignore
+import patsy # analysis:ignore
+import numpy as np # analysis:ignore
+import scipy as sp # analysis:ignore
+import scipy.sparse as sps # analysis:ignore
+import scipy.sparse.linalg as spl # analysis:ignore
+import scipy.sparse.csgraph # analysis:ignore
+from patsy.categorical import categorical_to_int # analysis:ignore
+
+from . import linalg_utils
+
+
+def sparse_dummy(x):
+    '''
+    Sparse dummy encoding of a categorical variable, with one column for
+    every unique value of x (ordered as in np.unique)
+
+    Parameters
+    ----------
+    x : array
+        n_obs vector of categories
+
+    Returns
+    -------
+    J : csc_matrix
+        n_obs by n_levels indicator matrix
+    levels : array
+        the unique values of x
+    '''
+    x = np.asarray(x).reshape(-1)
+    levels, codes = np.unique(x, return_inverse=True)
+    n, k = len(x), len(levels)
+    J = sps.csc_matrix((np.ones(n), (np.arange(n), codes)), shape=(n, k))
+    return J, levels
+
+
+def sparse_khatri_rao(x, Zij, levels=None):
+    '''
+    Random effect design matrix for one grouping factor, i.e. the transpose
+    of the khatri rao product of the group indicators and the random effect
+    variates, constructed without forming the dense indicator matrix.
+
+    Parameters
+    ----------
+    x : array
+        n_obs vector of groupings
+    Zij : array
+        n_obs by k matrix of random effect variates
+    levels : array, default None
+        Levels of the grouping, in the order of the columns, which must
+        include every value of x.  Defaults to the unique values of x
+
+    Returns
+    -------
+    Zi : csc_matrix
+        n_obs by (n_levels * k) matrix whose columns are ordered by level
+        and then by effect
+    '''
+    x = np.asarray(x).reshape(-1)
+    Zij = np.asarray(Zij, dtype=float)
+    if Zij.ndim==1:
+        Zij = Zij[:, None]
+    n, k = Zij.shape
+    if levels is None:
+        levels, codes = np.unique(x, return_inverse=True)
+    else:
+        levels = np.asarray(levels)
+        order = np.argsort(levels, kind='mergesort')
+        pos = np.minimum(np.searchsorted(levels[order], x), len(levels)-1)
+        codes = order[pos]
+        if np.any(levels[codes]!=x):
+            raise ValueError("x contains values not found in levels")
+    row = np.repeat(np.arange(n), k)
+    col = (codes[:, None] * k + np.arange(k)[None]).reshape(-1)
+    Zi = sps.csc_matrix((Zij.reshape(-1), (row, col)),
+                        shape=(n, len(levels)*k))
+    return Zi
+
+
+def _rowwise_kron(A, B):
+    '''
+    Row wise kronecker product of sparse matrices A and B, with the columns
+    of B varying fastest
+    '''
+    a, b = A.shape[1], B.shape[1]
+    A = sps.csc_matrix(A)[:, np.repeat(np.arange(a), b)]
+    B = sps.csc_matrix(B)[:, np.tile(np.arange(b), a)]
+    return sps.csc_matrix(A.multiply(B))
+
+
+def sparse_dmatrices(frm, data):
+    '''
+    Sparse analogue of patsy.dmatrices.  The terms of the formula are coded
+    as patsy would code them, with the same contrasts and column order, but 
+    categorical factors are coded from their integer codes as sparse 
+    indicators, so that the dense design matrix is never formed.  Rows with
+    missing values in any factor are dropped.
+
+    Parameters
+    ----------
+    frm : str
+        formula with a left hand side
+    data : DataFrame
+        data in which the formula is evaluated
+
+    Returns
+    -------
+    y : array
+        n_obs by k matrix of the left hand side
+    X : csc_matrix
+        n_obs by p design matrix
+    design_info : DesignInfo
+        patsy design info of X, holding the column names
+    '''
+    y_info, x_info = patsy.incr_dbuilders(frm, lambda: iter([data]))
+    values, keep = {}, None
+    for info in (y_info, x_info):
+        for factor, finfo in info.factor_infos.items():
+            v = factor.eval(finfo.state, data)
+            if finfo.type=='numerical':
+                v = np.asarray(v, dtype=float)
+                v = v.reshape(v.shape[0], -1)
+                valid = ~np.any(np.isnan(v), axis=1)
+            else:
+                v = np.asarray(categorical_to_int(v, finfo.categories, 
+                                                  patsy.NAAction()))
+                valid = v>=0
+            keep = valid if keep is None else keep & valid
+            values[factor] = v
+    n = int(np.sum(keep))
+    mats = []
+    for info in (y_info, x_info):
+        blocks = []
+        for term in info.terms:
+            for subterm in info.term_codings[term]:
+                M = sps.csc_matrix(np.ones((n, 1)))
+                for factor in subterm.factors:
+                    v = values[factor][keep]
+                    if factor in subterm.contrast_matrices:
+                        C = subterm.contrast_matrices[factor].matrix
+                        J = sps.csc_matrix((np.ones(n), (np.arange(n), v)), 
+                                           shape=(n, C.shape[0]))
+                        F = J.dot(sps.csc_matrix(C))
+                    else:
+                        F = sps.csc_matrix(v)
+                    M = _rowwise_kron(F, M)
+                blocks.append(M)
+        mats.append(sps.hstack(blocks, format='csc'))
+    y = mats[0].toarray()
+    X = mats[1]
+    X.eliminate_zeros()
+    X.sort_indices()
+    return y, X, x_info
+
+
+def pattern_data(A, pattern):
+    '''
+    Data of the sparse matrix A arranged according to the sorted csc
+    pattern of another sparse matrix, whose pattern must contain that of A.
+    Entries of the pattern not present in A are returned as zeros.
+
+    Parameters
+    ----------
+    A : sparse matrix
+
+    pattern : csc_matrix
+        sparse matrix with sorted indices
+
+    Returns
+    -------
+    data : array
+        vector of length pattern.nnz
+    '''
+    A = sps.coo_matrix(A)
+    nr = pattern.shape[0]
+    cols = np.repeat(np.arange(pattern.shape[1]), np.diff(pattern.indptr))
+    keys = cols.astype(np.int64) * nr + pattern.indices
+    akeys = A.col.astype(np.int64) * nr + A.row
+    ix = np.searchsorted(keys, akeys)
+    ix = np.minimum(ix, len(keys)-1)
+    if np.any(keys[ix]!=akeys):
+        raise ValueError('Pattern does not contain the sparsity of A')
+    data = np.zeros(pattern.nnz)
+    np.add.at(data, ix, A.data)
+    return data
+
+
+def fill_reducing_ordering(A):
+    '''
+    Minimum degree ordering of the symmetric matrix A, obtained from
+    SuperLU's MMD_AT_PLUS_A column ordering of a diagonally dominant
+    matrix sharing the sparsity pattern of A.
+    '''
+    A = sps.csc_matrix(A)
+    B = abs(A)
+    B.data[:] = 1.0
+    B = sps.csc_matrix(B + sps.diags(np.asarray(B.sum(axis=1)).reshape(-1)+1.0))
+    try:
+        lu = spl.splu(B, permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0.0,
+                      options=dict(SymmetricMode=True))
+        perm = np.argsort(lu.perm_c).astype(np.int64)
+    except RuntimeError:
+        perm = sp.sparse.csgraph.reverse_cuthill_mckee(B, symmetric_mode=True)
+        perm = perm.astype(np.int64)
+    return perm
+
+
+@numba.jit(nopython=True)
+def _etree(Ap, Ai, n):
+    parent = -np.ones(n, dtype=np.int64)
+    ancestor = -np.ones(n, dtype=np.int64)
+    for k in range(n):
+        for p in range(Ap[k], Ap[k+1]):
+            i = Ai[p]
+            while i!=-1 and i<k:
+                inext = ancestor[i]
+                ancestor[i] = k
+                if inext==-1:
+                    parent[i] = k
+                i = inext
+    return parent
+
+
+@numba.jit(nopython=True)
+def _ereach(Ap, Ai, k, parent, s, w):
+    n = len(parent)
+    top = n
+    w[k] = k
+    for p in range(Ap[k], Ap[k+1]):
+        i = Ai[p]
+        if i>k:
+            continue
+        ln = 0
+        while w[i]!=k:
+            s[ln] = i
+            ln += 1
+            w[i] = k
+            i = parent[i]
+        while ln>0:
+            top -= 1
+            ln -= 1
+            s[top] = s[ln]
+    return top
+
+
+@numba.jit(nopython=True)
+def _symbolic_cholesky(Ap, Ai, parent, n):
+    counts = np.ones(n, dtype=np.int64)
+    s = np.zeros(n, dtype=np.int64)
+    w = -np.ones(n, dtype=np.int64)
+    for k in range(n):
+        top = _ereach(Ap, Ai, k, parent, s, w)
+        for t in range(top, n):
+            counts[s[t]] += 1
+    Lp = np.zeros(n+1, dtype=np.int64)
+    Lp[1:] = np.cumsum(counts)
+    Li = np.zeros(Lp[n], dtype=np.int64)
+    c = Lp[:-1].copy()
+    w[:] = -1
+    for k in range(n):
+        top = _ereach(Ap, Ai, k, parent, s, w)
+        for t in range(top, n):
+            i = s[t]
+            Li[c[i]] = k
+            c[i] += 1
+        Li[c[k]] = k
+        c[k] += 1
+    return Lp, Li
+
+
+@numba.jit(nopython=True)
+def _numeric_cholesky(Ap, Ai, Ax, parent, Lp, Li, Lx, n):
+    x = np.zeros(n)
+    s = np.zeros(n, dtype=np.int64)
+    w = -np.ones(n, dtype=np.int64)
+    c = Lp[:-1].copy()
+    for k in range(n):
+        top = _ereach(Ap, Ai, k, parent, s, w)
+        x[k] = 0.0
+        for p in range(Ap[k], Ap[k+1]):
+            if Ai[p]<=k:
+                x[Ai[p]] = Ax[p]
+        d = x[k]
+        x[k] = 0.0
+        for t in range(top, n):
+            i = s[t]
+            lki = x[i] / Lx[Lp[i]]
+            x[i] = 0.0
+            for p in range(Lp[i]+1, c[i]):
+                x[Li[p]] -= Lx[p] * lki
+            d -= lki * lki
+            Lx[c[i]] = lki
+            c[i] += 1
+        if d<=0.0 or not np.isfinite(d):
+            return k
+        Lx[c[k]] = np.sqrt(d)
+        c[k] += 1
+    return -1
+
+
+@numba.jit(nopython=True)
+def _lsolve(Lp, Li, Lx, x):
+    n = len(Lp) - 1
+    for r in range(x.shape[1]):
+        for j in range(n):
+            x[j, r] /= Lx[Lp[j]]
+            xj = x[j, r]
+            for p in range(Lp[j]+1, Lp[j+1]):
+                x[Li[p], r] -= Lx[p] * xj
+    return x
+
+
+@numba.jit(nopython=True)
+def _ltsolve(Lp, Li, Lx, x):
+    n = len(Lp) - 1
+    for r in range(x.shape[1]):
+        for j in range(n-1, -1, -1):
+            xj = x[j, r]
+            for p in range(Lp[j]+1, Lp[j+1]):
+                xj -= Lx[p] * x[Li[p], r]
+            x[j, r] = xj / Lx[Lp[j]]
+    return x
+
+
+@numba.jit(nopython=True)
+def _find_entry(Lp, Li, r, c):
+    lo, hi = Lp[c], Lp[c+1]
+    while lo<hi:
+        mid = (lo + hi) // 2
+        if Li[mid]<r:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo<Lp[c+1] and Li[lo]==r:
+        return lo
+    return -1
+
+
+@numba.jit(nopython=True)
+def _find_entries(Lp, Li, rows, cols):
+    pos = np.zeros(len(rows), dtype=np.int64)
+    for t in range(len(rows)):
+        pos[t] = _find_entry(Lp, Li, rows[t], cols[t])
+    return pos
+
+
+@numba.jit(nopython=True)
+def _sparse_inverse(Lp, Li, Lx, nc):
+    Zx = np.zeros(len(Lx))
+    for j in range(nc-1, -1, -1):
+        d = Lp[j]
+        ljj = Lx[d]
+        end = Lp[j+1]
+        while end>d+1 and Li[end-1]>=nc:
+            end -= 1
+        for p in range(d+1, end):
+            i = Li[p]
+            acc = 0.0
+            for q in range(d+1, end):
+                k = Li[q]
+                if i>=k:
+                    acc += Lx[q] * Zx[_find_entry(Lp, Li, i, k)]
+                else:
+                    acc += Lx[q] * Zx[_find_entry(Lp, Li, k, i)]
+            Zx[p] = -acc / ljj
+        acc = 0.0
+        for q in range(d+1, end):
+            acc += Lx[q] * Zx[q]
+        Zx[d] = 1.0 / (ljj * ljj) - acc / ljj
+    return Zx
+
+
+class SparseCholesky(object):
+
+    def __init__(self, A, perm=None):
+        '''
+        Sparse Cholesky factorization of symmetric positive definite
+        matrices sharing a fixed sparsity pattern. The fill reducing ordering
+        and the symbolic analysis (elimination tree and the pattern of L) are
+        computed once, after which factor only performs the numeric
+        factorization of a new data vector.
+
+        Parameters
+        ----------
+        A : sparse matrix
+            Symmetric matrix, with both triangles stored, whose sparsity
+            pattern is shared by all matrices to be factored
+
+        perm : array, default None
+            Fill reducing ordering; computed with fill_reducing_ordering if
+            not provided
+        '''
+        A = sps.csc_matrix(A, dtype=float)
+        A.sort_indices()
+        n = A.shape[0]
+        if perm is None:
+            perm = fill_reducing_ordering(A)
+        perm = np.asarray(perm, dtype=np.int64)
+        iperm = np.argsort(perm)
+        B = sps.csc_matrix((np.arange(1, A.nnz+1, dtype=float), A.indices,
+                            A.indptr), shape=A.shape)
+        B = sps.csc_matrix(sps.triu(B[perm][:, perm]))
+        B.sort_indices()
+        self.n = n
+        self.pattern = sps.csc_matrix((np.ones(A.nnz), A.indices, A.indptr),
+                                      shape=A.shape)
+        self.perm, self.iperm = perm, iperm
+        self._Ap = B.indptr.astype(np.int64)
+        self._Ai = B.indices.astype(np.int64)
+        self._amap = (np.round(B.data) - 1).astype(np.int64)
+        self.parent = _etree(self._Ap, self._Ai, n)
+        self.Lp, self.Li = _symbolic_cholesky(self._Ap, self._Ai,
+                                              self.parent, n)
+        self.Lx = np.zeros(len(self.Li))
+        cols = np.repeat(np.arange(n), np.diff(A.indptr))
+        pr, pc = iperm[A.indices], iperm[cols]
+        self._lpos = _find_entries(self.Lp, self.Li, np.maximum(pr, pc),
+                                   np.minimum(pr, pc))
+        self._lmax = np.maximum(pr, pc)
+        self.factored = False
+
+    @property
+    def nnz(self):
+        return len(self.Li)
+
+    def factor(self, data):
+        '''
+        Numeric factorization
+
+        Parameters
+        ----------
+        data : array
+            Values of the matrix to be factored, ordered according to the
+            (sorted csc) pattern supplied at construction
+        '''
+        Ax = np.ascontiguousarray(data[self._amap], dtype=float)
+        k = _numeric_cholesky(self._Ap, self._Ai, Ax, self.parent, self.Lp,
+                              self.Li, self.Lx, self.n)
+        if k!=-1:
+            self.factored = False
+            raise np.linalg.LinAlgError("Matrix is not positive definite"
+                                        " (pivot %i)"%k)
+        self.factored = True
+        return self
+
+    def diagonal(self):
+        '''
+        Diagonal of L, in the permuted ordering
+        '''
+        return self.Lx[self.Lp[:-1]]
+
+    def logdet(self, n=None):
+        '''
+        Log determinant of the leading n by n block of the permuted matrix
+        '''
+        d = self.diagonal()
+        if n is not None:
+            d = d[:n]
+        return 2.0 * np.sum(np.log(d))
+
+    def solve(self, b, n=None):
+        '''
+        Solve Ax=b for a vector or matrix b.  If n is provided, the system
+        involving only the leading n by n block of the permuted matrix is
+        solved, and the remaining entries of x are set to zero
+        '''
+        b = np.asarray(b, dtype=float)
+        is_1d = b.ndim==1
+        x = b.reshape(self.n, -1)[self.perm].copy()
+        if n is not None:
+            x[n:] = 0.0
+        x = _lsolve(self.Lp, self.Li, self.Lx, x)
+        if n is not None:
+            x[n:] = 0.0
+        x = _ltsolve(self.Lp, self.Li, self.Lx, x)
+        x = x[self.iperm]
+        if is_1d:
+            x = x[:, 0]
+        return x
+
+    def sparse_inverse(self, nc=None):
+        '''
+        Entries of the inverse of the leading nc by nc block (in the permuted
+        ordering) of the factored matrix that lie on the sparsity pattern
+        supplied at construction, computed with the Takahashi recurrences.
+
+        Returns
+        -------
+        data : array
+            Inverse entries ordered according to the pattern supplied at
+            construction; entries outside the leading block are set to zero
+        '''
+        if nc is None:
+            nc = self.n
+        Zx = _sparse_inverse(self.Lp, self.Li, self.Lx, nc)
+        data = Zx[self._lpos]
+        data[self._lmax>=nc] = 0.0
+        return data
+
+
+def _kron_pattern(A, k, offset):
+    '''
+    Row and column indices and values of the entries of A\\otimes 1_{k\\times k}
+    shifted by offset, with the entries ordered by the entries of A and then
+    by the k by k block
+    '''
+    A = sps.coo_matrix(A)
+    j, l = np.meshgrid(np.arange(k), np.arange(k), indexing='ij')
+    rows = offset + A.row[:, None, None] * k + j[None]
+    cols = offset + A.col[:, None, None] * k + l[None]
+    return rows.reshape(-1), cols.reshape(-1), A.data
+
+
+def _positions(rows, cols, shape):
+    '''
+    Constructs a csc matrix with the given pattern, and returns it along with
+    the location of each (row, col) entry in its data array
+    '''
+    n = len(rows)
+    M = sps.csc_matrix((np.arange(1, n+1, dtype=float), (rows, cols)),
+                       shape=shape)
+    M.sort_indices()
+    pos = np.zeros(n, dtype=np.int64)
+    pos[np.round(M.data).astype(np.int64) - 1] = np.arange(M.nnz)
+    M.data[:] = 0.0
+    return M, pos
+
+
+class BlockDiagonalCovariance(object):
+    
+    def __init__(self, shapes, indices, acov=None):
+        '''
+        Block diagonal random effect covariance G = diag(A_{i}\\otimes V_{i}),
+        and its inverse, stored as sparse matrices whose sparsity pattern is 
+        computed once.  Updating the parameters writes directly into the data
+        arrays, inverting only the k_{i} by k_{i} matrices V_{i}, and keeps 
+        track of the log determinant of each block.
+        
+        Parameters
+        ----------
+        shapes: dict
+            Ordered dictionary mapping each grouping factor to a tuple 
+            (n_units, k) of the number of units and the dimension of V_{i}
+        
+        indices: dict
+            Dictionary mapping each grouping factor to the indices of 
+            vech(V_{i}) in the parameter vector
+        
+        acov: dict, default None
+            Dictionary of sparse n_units by n_units covariance matrices
+            among the units of each grouping factor, which default to the
+            identity
+        '''
+        acov = {} if acov is None else acov
+        self.shapes, self.indices = shapes, indices
+        self.acov, self.acov_inv, self.lndet_acov = {}, {}, {}
+        grows, gcols, ginvrows, ginvcols = [], [], [], []
+        self._avals, self._ainvvals, gslices, ginvslices = {}, {}, {}, {}
+        offset, gstart, ginvstart = 0, 0, 0
+        for key, (n_units, k) in shapes.items():
+            A = acov.get(key, None)
+            A = sps.eye(n_units, format='csc') if A is None else \
+                sps.csc_matrix(A)
+            if (A - sps.diags(A.diagonal())).nnz==0:
+                Ainv = sps.diags(1.0 / A.diagonal(), format='csc')
+                lndet = np.sum(np.log(A.diagonal()))
+            else:
+                Ainv = sps.csc_matrix(spl.inv(A))
+                lu = spl.splu(A)
+                lndet = np.sum(np.log(np.abs(lu.U.diagonal())))
+            self.acov[key], self.acov_inv[key] = A, Ainv
+            self.lndet_acov[key] = lndet
+            r, c, v = _kron_pattern(A, k, offset)
+            grows.append(r)
+            gcols.append(c)
+            self._avals[key] = v
+            gslices[key] = np.arange(gstart, gstart+len(r))
+            gstart += len(r)
+            r, c, v = _kron_pattern(Ainv, k, offset)
+            ginvrows.append(r)
+            ginvcols.append(c)
+            self._ainvvals[key] = v
+            ginvslices[key] = np.arange(ginvstart, ginvstart+len(r))
+            ginvstart += len(r)
+            offset += n_units * k
+        self.shape = (offset, offset)
+        self.G, gpos = _positions(np.concatenate(grows),
+                                  np.concatenate(gcols), self.shape)
+        self.Ginv, ginvpos = _positions(np.concatenate(ginvrows), 
+                                        np.concatenate(ginvcols), self.shape)
+        self._gpos = dict([(key, gpos[gslices[key]]) for key in shapes])
+        self._ginvpos = dict([(key, ginvpos[ginvslices[key]]) 
+                              for key in shapes])
+        self.V, self.Vinv, self.lndet = {}, {}, {}
+    
+    def update(self, theta):
+        '''
+        Writes the covariance blocks implied by the parameter vector theta
+        into G and Ginv
+        '''
+        for key, (n_units, k) in self.shapes.items():
+            V = linalg_utils.invech(theta[self.indices[key]])
+            try:
+                Vinv = np.linalg.inv(V)
+            except np.linalg.LinAlgError:
+                Vinv = np.linalg.pinv(V)
+            vals = self._avals[key][:, None, None] * V[None]
+            self.G.data[self._gpos[key]] = vals.reshape(-1)
+            vals = self._ainvvals[key][:, None, None] * Vinv[None]
+            self.Ginv.data[self._ginvpos[key]] = vals.reshape(-1)
+            self.V[key], self.Vinv[key] = V, Vinv
+            self.lndet[key] = n_units * np.linalg.slogdet(V)[1]
+        return self
+    
+    def logdet(self, include_acov=False):
+        '''
+        Log determinant of G, optionally omitting the terms k_{i}\\log|A_{i}|
+        that do not depend on the parameters
+        '''
+        lnd = np.sum(list(self.lndet.values()))
+        if include_acov:
+            lnd += np.sum([self.shapes[key][1] * self.lndet_acov[key] 
+                           for key in self.shapes])
+        return lnd
+
+
+def block_closure(A, start, size):
+    '''
+    Sparsity pattern obtained by filling in every block of A that contains a
+    nonzero, where the blocks are contiguous ranges of indices.  Congruence
+    transformations by block diagonal matrices with the same blocking
+    preserve this pattern.
+
+    Parameters
+    ----------
+    A : sparse matrix
+        Square sparse matrix
+    
+    start : array
+        Index of the first element of the block each index belongs to
+    
+    size : array
+        Size of the block each index belongs to
+
+    Returns
+    -------
+    pattern : csc_matrix
+        Pattern with sorted indices and unit data
+    '''
+    A = sps.coo_matrix(A)
+    n = A.shape[0]
+    keys = np.unique(start[A.row].astype(np.int64) * n + start[A.col])
+    br, bc = keys // n, keys % n
+    rows, cols = [], []
+    for sa in np.unique(size):
+        for sb in np.unique(size):
+            sel = (size[br]==sa) & (size[bc]==sb)
+            if not np.any(sel):
+                continue
+            j, l = np.meshgrid(np.arange(sa), np.arange(sb), indexing='ij')
+            rows.append((br[sel][:, None] + j.reshape(1, -1)).reshape(-1))
+            cols.append((bc[sel][:, None] + l.reshape(1, -1)).reshape(-1))
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    pattern = sps.csc_matrix((np.ones(len(rows)), (rows, cols)), 
+                             shape=A.shape)
+    pattern.sort_indices()
+    pattern.data[:] = 1.0
+    return pattern
+
+
+class RelativeCovarianceFactor(object):
+    
+    def __init__(self, shapes, indices, n_lead=0, n_trail=0, lower=0.0):
+        '''
+        Block diagonal relative covariance factor, in the sense of lme4's
+        \\Lambda_{\\theta}, embedded in T = diag(I, I\\otimes\\Lambda_{1}, ..., 
+        I\\otimes\\Lambda_{r}, I).  Each \\Lambda_{i} is a k_{i} by k_{i} lower
+        triangular matrix, parameterized by its nonzero entries in the same
+        order as vech(V_{i}), so that V_{i}=\\sigma^{2}\\Lambda_{i}\\Lambda_{i}'.
+        
+        Parameters
+        ----------
+        shapes: dict
+            Ordered dictionary mapping each grouping factor to a tuple 
+            (n_units, k) of the number of units and the dimension of V_{i}
+        
+        indices: dict
+            Dictionary mapping each grouping factor to the indices of 
+            the entries of \\Lambda_{i} in the parameter vector
+        
+        n_lead: int, default 0
+            Number of leading (fixed effect) indices left untransformed
+        
+        n_trail: int, default 0
+            Number of trailing indices left untransformed
+        
+        lower: float, default 0.0
+            Lower bound on the diagonal elements of each \\Lambda_{i}
+        '''
+        self.shapes, self.indices = shapes, indices
+        n_params = np.max(np.concatenate(list(indices.values()))) + 1
+        self.theta0 = np.zeros(n_params)
+        self.bounds = [(None, None)] * n_params
+        rows, cols, slices = [], [], {}
+        start, size = [np.arange(n_lead)], [np.ones(n_lead, dtype=int)]
+        offset, tstart = n_lead, 0
+        for key, (n_units, k) in shapes.items():
+            r, c = np.triu_indices(k)
+            units = offset + np.arange(n_units)[:, None] * k
+            rows.append((units + c[None]).reshape(-1))
+            cols.append((units + r[None]).reshape(-1))
+            slices[key] = np.arange(tstart, tstart + n_units * len(r))
+            tstart += n_units * len(r)
+            start.append(np.repeat(units[:, 0], k))
+            size.append(np.full(n_units * k, k))
+            self.theta0[indices[key]] = linalg_utils.vech(np.eye(k))
+            for t in np.asarray(indices[key])[r==c]:
+                self.bounds[t] = (lower, None)
+            offset += n_units * k
+        n = offset + n_trail
+        fixed = np.concatenate([np.arange(n_lead), np.arange(offset, n)])
+        start.append(np.arange(offset, n))
+        size.append(np.ones(n_trail, dtype=int))
+        self.start = np.concatenate(start).astype(np.int64)
+        self.size = np.concatenate(size).astype(np.int64)
+        self.n_lead, self.n_trail, self.shape = n_lead, n_trail, (n, n)
+        self.T, pos = _positions(np.concatenate(rows + [fixed]), 
+                                 np.concatenate(cols + [fixed]), self.shape)
+        self.T.data[pos[tstart:]] = 1.0
+        self._tpos = dict([(key, pos[slices[key]]) for key in shapes])
+        self.Lambda = {}
+    
+    def update(self, theta):
+        '''
+        Writes the factors implied by the parameter vector theta into T
+        '''
+        for key, (n_units, k) in self.shapes.items():
+            lam = np.asarray(theta)[self.indices[key]]
+            self.T.data[self._tpos[key]] = np.tile(lam, n_units)
+            self.Lambda[key] = np.tril(linalg_utils.invech(lam))
+        return self
+    
+    def covariance_params(self, theta, scale=1.0):
+        '''
+        Parameters vech(V_{i}) of the covariances V_{i}=s\\Lambda_{i}
+        \\Lambda_{i}' arranged in the same order as theta
+        '''
+        params = np.zeros(len(self.theta0))
+        for key, (n_units, k) in self.shapes.items():
+            L = np.tril(linalg_utils.invech(np.asarray(theta)[self.indices[key]]))
+            params[self.indices[key]] = linalg_utils.vech(scale * L.dot(L.T))
+        return params
+    
+    def collect(self, D):
+        '''
+        Gradient with respect to theta from the derivatives D[i, d] of a
+        function with respect to the entries T[i, start[i]+d] of T
+        '''
+        g = np.zeros(len(self.theta0))
+        offset = self.n_lead
+        for key, (n_units, k) in self.shapes.items():
+            r, c = np.triu_indices(k)
+            Dk = D[offset:offset+n_units*k, :k].reshape(n_units, k, k).sum(0)
+            g[self.indices[key]] = Dk[c, r]
+            offset += n_units * k
+        return g